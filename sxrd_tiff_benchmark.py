@@ -0,0 +1,220 @@
+'''Benchmark the summing, subtraction and mapping functions on a synthetic experiment.
+
+    python sxrd_tiff_benchmark.py --shape-x 10 --shape-y 10
+    python sxrd_tiff_benchmark.py --shape-x 10 --shape-y 10 --compare benchmark-results/baseline.json
+    python sxrd_tiff_benchmark.py --shape-x 10 --shape-y 10 --frames 2000 --functions avg_tiff_images
+
+A synthetic series of Pilatus-sized (1475 x 1679) int32 images is written in the detector
+naming scheme, so no example data is needed. There is one image per measurement point by
+default, and the number of images can be set separately to time long series (skipping the
+functions that plot intensity maps, which need one image per point). Each function is timed in a fresh process,
+reporting frames/s, MB/s of input read and the peak resident memory, and the results are
+saved as a JSON file which a later run can be compared with to find regressions.
+'''
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import sxrd_tiff_synthetic_functions as synthetic
+
+FUNCTIONS = ("avg_tiff_images", "subtract_tiff_images", "grid_tiff_intensity", "avg_tiff_images_grid", "run_pipeline")
+# functions plotting intensity maps, which need one image per measurement point
+MAP_FUNCTIONS = ("grid_tiff_intensity", "run_pipeline")
+
+def get_samples(shape_x: int, shape_y: int):
+    '''Split the measurement grid into four quadrant samples, as numbers, start and end points.'''
+    half_x = max(shape_x // 2, 1)
+    half_y = max(shape_y // 2, 1)
+    start_points = [[0, 0], [half_x, 0], [0, half_y], [half_x, half_y]]
+    end_points = [[half_x - 1, half_y - 1], [shape_x - 1, half_y - 1], [half_x - 1, shape_y - 1], [shape_x - 1, shape_y - 1]]
+    return [1, 2, 3, 4], start_points, end_points
+
+def run_function(function: str, paths: dict, output_filepath: str, shape_x: int, shape_y: int) -> float:
+    '''Run a single function on the synthetic experiment and return the wall time in seconds.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import sxrd_tiff_summer_functions as analysis
+    import sxrd_tiff_mapper_functions as grid_analysis
+    import sxrd_tiff_pipeline_functions as pipeline
+    from sxrd_tiff_manifest_functions import MANIFEST_FOLDER
+
+    # the frame manifest would otherwise let a repeat skip reading the images
+    for input_filepath in (paths["tiff"], paths["tif"]):
+        shutil.rmtree(os.path.join(input_filepath, MANIFEST_FOLDER), ignore_errors=True)
+    sample_numbers, start_points, end_points = get_samples(shape_x, shape_y)
+
+    start = time.perf_counter()
+    if function == "avg_tiff_images":
+        analysis.avg_tiff_images("000001", paths["tiff"], output_filepath, 500)
+    elif function == "subtract_tiff_images":
+        analysis.subtract_tiff_images("000001", paths["background"], 1, paths["tif"], output_filepath, 500)
+    elif function == "grid_tiff_intensity":
+        grid_analysis.grid_tiff_intensity("000001", paths["tiff"], output_filepath, shape_x, shape_y)
+    elif function == "avg_tiff_images_grid":
+        grid_analysis.avg_tiff_images_grid("000001", paths["tiff"], output_filepath, 500,
+                                           sample_numbers, start_points, end_points, shape_x)
+    elif function == "run_pipeline":
+        grid_input = (shape_x, shape_y, sample_numbers, start_points, end_points)
+        subtract_image_array = pipeline.get_background(paths["background"], 1)
+        pipeline.pipeline_experiment("000001", paths["tiff"], output_filepath, 500, subtract_image_array, grid_input)
+    else:
+        raise ValueError(f"Unknown function '{function}', choose from {FUNCTIONS}.")
+    return time.perf_counter() - start
+
+def benchmark_process(function: str, paths: dict, output_filepath: str, shape_x: int, shape_y: int, queue):
+    '''Run a function in a fresh process, silencing its output, and report the wall time and peak memory.'''
+    import resource
+    os.environ["TQDM_DISABLE"] = "1"
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            seconds = run_function(function, paths, output_filepath, shape_x, shape_y)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_megabytes = peak_rss / 2**20 if platform.system() == "Darwin" else peak_rss / 2**10
+        queue.put({"seconds": seconds, "peak_rss_megabytes": peak_rss_megabytes})
+    except Exception as error:
+        queue.put({"error": repr(error)})
+
+def get_git_commit() -> str:
+    '''Return the current git commit of the repository, or None outside a git checkout.'''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def folder_size(input_filepath: str) -> int:
+    '''Return the total size in bytes of the tiff images in a folder.'''
+    return sum(entry.stat().st_size for entry in os.scandir(input_filepath) if entry.name.startswith("0"))
+
+def run_benchmarks(functions: list, shape_x: int, shape_y: int, shape: tuple, repeats: int, data_filepath: str,
+                   number_of_frames: int = None) -> list:
+    '''Write a synthetic experiment and time each function on it, in a fresh process per repeat.
+    The series has number_of_frames images, one per measurement point (shape_x * shape_y) by default.'''
+    number_of_frames = shape_x * shape_y if number_of_frames is None else number_of_frames
+    print(f"Writing {number_of_frames} synthetic {shape[1]} x {shape[0]} images to '{data_filepath}'...")
+    paths = synthetic.write_synthetic_experiment(data_filepath, shape_x, shape_y, shape, number_of_frames)
+    input_megabytes = folder_size(paths["tiff"]) / 1e6
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for function in functions:
+        runs = []
+        for repeat in range(repeats):
+            output_filepath = os.path.join(data_filepath, "output", function) + "/"
+            shutil.rmtree(output_filepath, ignore_errors=True)
+            queue = context.Queue()
+            process = context.Process(target=benchmark_process, args=(function, paths, output_filepath, shape_x, shape_y, queue))
+            process.start()
+            run = queue.get()
+            process.join()
+            if "error" in run:
+                raise RuntimeError(f"{function} failed: {run['error']}")
+            runs.append(run)
+
+        seconds = statistics.median(run["seconds"] for run in runs)
+        result = {
+            "function": function,
+            "seconds": seconds,
+            "all_seconds": [run["seconds"] for run in runs],
+            "frames": number_of_frames,
+            "frames_per_second": number_of_frames / seconds,
+            "megabytes_per_second": input_megabytes / seconds,
+            "peak_rss_megabytes": max(run["peak_rss_megabytes"] for run in runs),
+        }
+        print(f"{function:<24} {seconds:8.2f} s {result['frames_per_second']:9.1f} frames/s "
+              f"{result['megabytes_per_second']:9.1f} MB/s {result['peak_rss_megabytes']:9.1f} MB peak RSS")
+        results.append(result)
+    return results
+
+def compare_results(results: list, baseline_filepath: str, threshold: float) -> bool:
+    '''Print the change in time and memory of each function against a baseline results file.
+
+    :return: True if any function is slower than the baseline by more than the threshold.
+    '''
+    with open(baseline_filepath) as baseline_file:
+        baseline = {result["function"]: result for result in json.load(baseline_file)["results"]}
+    regression = False
+    print(f"\nCompared with '{baseline_filepath}':")
+    for result in results:
+        if result["function"] not in baseline:
+            continue
+        previous = baseline[result["function"]]
+        time_ratio = result["seconds"] / previous["seconds"]
+        memory_ratio = result["peak_rss_megabytes"] / previous["peak_rss_megabytes"]
+        flag = "REGRESSION" if time_ratio > 1 + threshold else ""
+        regression = regression or bool(flag)
+        print(f"{result['function']:<24} time x{time_ratio:5.2f}   memory x{memory_ratio:5.2f}   {flag}")
+    return regression
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape-x", type=int, default=10, help="number of measurement points along X")
+    parser.add_argument("--shape-y", type=int, default=10, help="number of measurement points along Y")
+    parser.add_argument("--frames", type=int,
+                        help="number of images in the series, one per measurement point (shape-x * shape-y) by default")
+    parser.add_argument("--rows", type=int, default=synthetic.PILATUS_SHAPE[0], help="number of rows in each image")
+    parser.add_argument("--columns", type=int, default=synthetic.PILATUS_SHAPE[1], help="number of columns in each image")
+    parser.add_argument("--functions", nargs="+", choices=FUNCTIONS,
+                        help="functions to benchmark, all of them by default")
+    parser.add_argument("--repeats", type=int, default=3, help="number of timed runs of each function")
+    parser.add_argument("--data-dir", help="folder for the synthetic images, a temporary folder by default")
+    parser.add_argument("--results-dir", default="benchmark-results", help="folder to save the JSON results to")
+    parser.add_argument("--label", default="", help="label added to the results file name")
+    parser.add_argument("--compare", help="JSON results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="fractional slow down reported as a regression")
+    arguments = parser.parse_args()
+    if arguments.frames is not None and arguments.frames < 1:
+        parser.error("--frames must be at least 1")
+
+    shape = (arguments.rows, arguments.columns)
+    number_of_frames = arguments.shape_x * arguments.shape_y if arguments.frames is None else arguments.frames
+    functions = arguments.functions
+    if number_of_frames != arguments.shape_x * arguments.shape_y:
+        if functions is not None and set(functions).intersection(MAP_FUNCTIONS):
+            parser.error(f"{', '.join(MAP_FUNCTIONS)} need one image per measurement point, so --frames must be "
+                         f"{arguments.shape_x * arguments.shape_y} to benchmark them")
+        if functions is None:
+            functions = [function for function in FUNCTIONS if function not in MAP_FUNCTIONS]
+            print(f"Skipping {', '.join(MAP_FUNCTIONS)}, which need one image per measurement point.")
+    functions = list(FUNCTIONS) if functions is None else functions
+    with contextlib.ExitStack() as stack:
+        data_filepath = arguments.data_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        results = run_benchmarks(functions, arguments.shape_x, arguments.shape_y, shape,
+                                 arguments.repeats, data_filepath, number_of_frames)
+
+    import numpy as np
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    report = {
+        "timestamp": timestamp,
+        "label": arguments.label,
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"shape_x": arguments.shape_x, "shape_y": arguments.shape_y, "frames": number_of_frames,
+                   "image_shape": list(shape), "repeats": arguments.repeats},
+        "results": results,
+    }
+    os.makedirs(arguments.results_dir, exist_ok=True)
+    label = f"_{arguments.label}" if arguments.label else ""
+    results_filepath = os.path.join(arguments.results_dir, f"{timestamp}{label}.json")
+    with open(results_filepath, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"\nWritten results to: '{results_filepath}'.")
+
+    if arguments.compare and compare_results(results, arguments.compare, arguments.threshold):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+'''Run the summing, subtraction and mapping functions over one or more yaml configuration
+files without the notebooks, for batch jobs on a cluster node.
+
+    python sxrd_tiff_cli.py sum yaml/config_diamond_2021.yaml yaml/config_diamond_2022.yaml --v-max 500
+    python sxrd_tiff_cli.py subtract yaml/config_diamond_2021_fast_det.yaml --output-format stack
+    python sxrd_tiff_cli.py map yaml/config_diamond_2022_additional_112748.yaml
+    python sxrd_tiff_cli.py sum yaml/config_diamond_2021_fast_det.yaml --subtract-background
+    python sxrd_tiff_cli.py pipeline yaml/config_diamond_2022.yaml --timing timings/
+    python sxrd_tiff_cli.py sum yaml/config_diamond_2022.yaml --previews 2 4 8
+    python sxrd_tiff_cli.py grid yaml/config_diamond_2022_additional_112748.yaml --method median
+    srun python sxrd_tiff_cli.py sum yaml/config_diamond_2022.yaml --job-dir /shared/jobs/
+
+With --job-dir, every process started with the same command shares the experiments of each
+configuration file through a job folder on a shared filesystem, claiming experiments until all
+are done and retrying those abandoned by crashed workers (see sxrd_tiff_shard_functions).
+
+Figures are drawn with the non-interactive Agg backend, and the plots of the summed and
+subtracted images shown in the notebooks are skipped, so only the intensity maps are rendered.
+numpy, matplotlib and scikit-image are only imported by the operations that need them.
+'''
+import argparse
+import os
+import pathlib
+import sys
+
+OPERATIONS = ("sum", "subtract", "map", "grid", "pipeline")
+
+def get_timing_filepath(timing_folder: str, config_path: str, operation: str, worker_name: str = None) -> str:
+    '''Return the path of the timing summary for a configuration file, or None if timing is off.'''
+    if timing_folder is None:
+        return None
+    worker = f"_{worker_name}" if worker_name else ""
+    return os.path.join(timing_folder, f"{pathlib.Path(config_path).stem}_{operation}{worker}.json")
+
+def get_experiment_function(operation: str, config_path: str, arguments: argparse.Namespace):
+    '''Return the experiment numbers of a yaml configuration file and a function running
+    a single operation for one of those experiments, called with the experiment number.'''
+    import sxrd_tiff_summer_functions as analysis
+    import sxrd_tiff_mapper_functions as grid_analysis
+    import sxrd_tiff_pipeline_functions as pipeline
+    import sxrd_tiff_region_functions as region_analysis
+    import sxrd_tiff_subtracted_functions as subtracted
+
+    experiment_numbers, input_path, output_path, background_scatter_path, background_scatter_multiple = analysis.extract_input(config_path)
+    workers = arguments.workers if arguments.workers is not None else analysis.extract_processing_input(config_path)
+
+    grid_input = None
+    regions = None
+    if operation in ("map", "grid", "pipeline") and "grid_info" in analysis.get_config(config_path):
+        grid_input = grid_analysis.extract_grid_input(config_path)
+        if operation != "grid":
+            regions = region_analysis.extract_region_input(config_path)
+    elif operation in ("map", "grid"):
+        raise ValueError(f"'{config_path}' has no grid_info block for the {operation} operation.")
+    subtract_background = operation == "subtract" or (arguments.subtract_background and operation in ("sum", "map", "grid"))
+    if subtract_background and background_scatter_path in (None, "None"):
+        raise ValueError(f"'{config_path}' has no background_scatter_path to subtract.")
+    subtract_image_array = None
+    if operation == "pipeline" or (subtract_background and operation != "subtract"):
+        subtract_image_array = pipeline.get_background(background_scatter_path, background_scatter_multiple)
+
+    def run_experiment(experiment_number: str):
+        input_filepath = input_path.format(experiment_number = experiment_number)
+        output_filepath = output_path.format(experiment_number = experiment_number)
+        if subtract_background and operation != "subtract":
+            # subtract the background from each image as it is read, rather than from saved images
+            input_filepath = subtracted.SubtractedDataset(input_filepath, subtract_image_array)
+        if operation == "sum":
+            analysis.avg_tiff_images(experiment_number, input_filepath, output_filepath, arguments.v_max,
+                                     workers, arguments.statistics, plot = False, previews = arguments.previews,
+                                     method = arguments.method, stacking_memory = arguments.stacking_memory * 2**20,
+                                     spill_directory = arguments.spill_dir)
+        elif operation == "subtract":
+            analysis.subtract_tiff_images(experiment_number, background_scatter_path, background_scatter_multiple,
+                                          input_filepath, output_filepath, arguments.v_max, workers,
+                                          arguments.output_format, plot = False, previews = arguments.previews)
+        elif operation == "map":
+            shape_x, shape_y = grid_input[:2]
+            grid_analysis.grid_tiff_intensity(experiment_number, input_filepath, f"{output_filepath}{pipeline.INTENSITY_MAP_FOLDER}",
+                                              shape_x, shape_y, arguments.c_map, regions)
+        elif operation == "grid":
+            shape_x, shape_y, sample_numbers, start_points, end_points = grid_input
+            grid_analysis.avg_tiff_images_grid(experiment_number, input_filepath, output_filepath, arguments.v_max,
+                                               sample_numbers, start_points, end_points, shape_x,
+                                               arguments.statistics, plot = False, previews = arguments.previews,
+                                               method = arguments.method, stacking_memory = arguments.stacking_memory * 2**20,
+                                               spill_directory = arguments.spill_dir)
+        elif operation == "pipeline":
+            pipeline.pipeline_experiment(experiment_number, input_filepath, output_filepath, arguments.v_max,
+                                         subtract_image_array, grid_input, arguments.c_map, arguments.save_subtracted,
+                                         arguments.statistics, plot = False, regions = regions, previews = arguments.previews)
+
+        if "matplotlib.pyplot" in sys.modules:
+            # release the figures, as nothing displays them
+            sys.modules["matplotlib.pyplot"].close('all')
+
+    return experiment_numbers, run_experiment
+
+def run_sharded_config(operation: str, config_path: str, arguments: argparse.Namespace):
+    '''Run a single operation for the experiments of a yaml configuration file claimed by this
+    worker, from a job folder shared with the other workers.'''
+    import sxrd_tiff_shard_functions as shard
+    import sxrd_tiff_timing_functions as timing
+
+    experiment_numbers, run_experiment = get_experiment_function(operation, config_path, arguments)
+    job_filepath = os.path.join(arguments.job_dir, f"{pathlib.Path(config_path).stem}_{operation}")
+    worker_name = shard.get_worker_name()
+    timing_filepath = get_timing_filepath(arguments.timing, config_path, operation, worker_name)
+
+    with timing.TimedRun(operation, timing_filepath):
+        processed = shard.run_shard_worker(job_filepath, experiment_numbers, run_experiment,
+                                           arguments.lease_timeout, arguments.heartbeat_interval,
+                                           arguments.max_attempts, worker_name = worker_name)
+    if processed["failed"]:
+        raise RuntimeError(f"{len(processed['failed'])} experiment(s) failed: {', '.join(processed['failed'])}")
+
+def run_config(operation: str, config_path: str, arguments: argparse.Namespace):
+    '''Run a single operation for every experiment in a yaml configuration file.'''
+    import sxrd_tiff_summer_functions as analysis
+    import sxrd_tiff_timing_functions as timing
+
+    timing_filepath = get_timing_filepath(arguments.timing, config_path, operation)
+
+    if operation in ("map", "grid") or (operation == "sum" and arguments.subtract_background):
+        experiment_numbers, run_experiment = get_experiment_function(operation, config_path, arguments)
+        with timing.TimedRun(operation, timing_filepath):
+            for experiment_number in experiment_numbers:
+                run_experiment(str(experiment_number))
+        return
+
+    if operation == "pipeline":
+        import sxrd_tiff_pipeline_functions as pipeline
+        pipeline.run_pipeline(config_path, arguments.v_max, arguments.c_map, arguments.save_subtracted,
+                              arguments.statistics, timing_filepath = timing_filepath, plot = False,
+                              previews = arguments.previews)
+        return
+
+    experiment_numbers, input_path, output_path, background_scatter_path, background_scatter_multiple = analysis.extract_input(config_path)
+    workers = arguments.workers if arguments.workers is not None else analysis.extract_processing_input(config_path)
+
+    if operation == "sum":
+        analysis.multiple_avg_tiff_images(experiment_numbers, input_path, output_path, arguments.v_max,
+                                          workers, arguments.statistics, timing_filepath, plot = False,
+                                          previews = arguments.previews, method = arguments.method,
+                                          stacking_memory = arguments.stacking_memory * 2**20,
+                                          spill_directory = arguments.spill_dir)
+
+    elif operation == "subtract":
+        if background_scatter_path in (None, "None"):
+            raise ValueError(f"'{config_path}' has no background_scatter_path to subtract.")
+        analysis.multiple_subtract_tiff_images(experiment_numbers, background_scatter_path, background_scatter_multiple,
+                                               input_path, output_path, arguments.v_max, workers,
+                                               arguments.output_format, timing_filepath, plot = False,
+                                               previews = arguments.previews)
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("operation", choices=OPERATIONS,
+                        help="sum: summed/averaged images, subtract: background subtraction, map: intensity maps, "
+                             "grid: summed/averaged image of each sample, pipeline: all of them in a single pass")
+    parser.add_argument("configs", nargs="+", help="yaml configuration files")
+    parser.add_argument("--v-max", type=int, default=500, help="intensity maxima for plotting the diffraction pattern images")
+    parser.add_argument("--c-map", default="Reds", help="colour scale for the intensity maps")
+    parser.add_argument("--workers", type=int, help="number of worker processes, from the configuration file by default")
+    parser.add_argument("--statistics", nargs="*", default=[], choices=("sum", "max", "min", "variance"),
+                        help="additional images to save from the same pass")
+    parser.add_argument("--output-format", default="tif", choices=("tif", "stack"), help="format of the subtracted images")
+    parser.add_argument("--save-subtracted", choices=("tif", "stack"), help="also save the subtracted images in the pipeline")
+    parser.add_argument("--subtract-background", action="store_true",
+                        help="sum or map the images with the background scatter image subtracted as they are read, "
+                             "without saving the subtracted images")
+    parser.add_argument("--previews", nargs="*", type=int, default=[],
+                        help="binning factors of preview levels to save alongside the summed and subtracted images, such as 2 4 8")
+    parser.add_argument("--method", default="mean", choices=("mean", "median", "sigma_clip"),
+                        help="per-pixel average of the summed and grid images, median and sigma_clip reject outlying frames")
+    parser.add_argument("--stacking-memory", type=int, default=1024,
+                        help="megabytes of image rows held at once by the median and sigma_clip methods in each process")
+    parser.add_argument("--spill-dir",
+                        help="folder for the temporary copy of a series larger than the stacking memory, "
+                             "made by the median and sigma_clip methods, the output folder of each experiment by default")
+    parser.add_argument("--prefetch-frames", type=int, default=8,
+                        help="images read ahead while each image is processed, 0 to read and write the images serially")
+    parser.add_argument("--prefetch-memory", type=int, default=512,
+                        help="megabytes of images held by the read-ahead and write-behind queues of each process")
+    parser.add_argument("--timing", help="folder to save a JSON timing summary for each configuration file")
+    parser.add_argument("--job-dir", help="shared job folder, to split the experiments between every process run with it")
+    parser.add_argument("--lease-timeout", type=float, default=600.0,
+                        help="seconds after which the claim of a crashed worker is retried")
+    parser.add_argument("--heartbeat-interval", type=float, default=30.0, help="seconds between refreshes of a claim")
+    parser.add_argument("--max-attempts", type=int, default=3, help="attempts at an experiment before it is left as failed")
+    arguments = parser.parse_args(argv)
+    if arguments.method != "mean" and arguments.operation not in ("sum", "grid"):
+        # the pipeline sums each experiment in the same single pass as its other outputs
+        parser.error(f"--method {arguments.method} is only available for the sum and grid operations")
+
+    # no display is needed for the figures, which are only saved to file
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    import sxrd_tiff_prefetch_functions as prefetch
+    prefetch.set_prefetch(frames = arguments.prefetch_frames, memory_limit = arguments.prefetch_memory * 2**20)
+
+    failed = []
+    for config_path in arguments.configs:
+        print(f"Running {arguments.operation} for '{config_path}'.", end = '\n\n')
+        try:
+            if arguments.job_dir is not None:
+                run_sharded_config(arguments.operation, config_path, arguments)
+            else:
+                run_config(arguments.operation, config_path, arguments)
+        except Exception as error:
+            print(f"'{config_path}' failed: {error!r}", file=sys.stderr)
+            failed.append(config_path)
+
+    if failed:
+        print(f"{len(failed)} of {len(arguments.configs)} configuration file(s) failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import numpy as np
+import pathlib
+import os
+import json
+import time
+import hashlib
+import fnmatch
+import tempfile
+import tifffile
+from tqdm import tqdm
+from typing import List
+
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_timing_functions as timing
+
+# the manifest is kept in a sub-folder, so that writing it does not modify the experiment folder itself
+MANIFEST_FOLDER = ".sxrd_tiff_cache"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+# glob pattern covering every diffraction pattern image the functions can select
+MANIFEST_PATTERN = "0*.tif*"
+# a directory listing is only trusted when the folder was last modified this long before it was listed
+MTIME_MARGIN_NS = 2 * 10**9
+
+FRAME_STATISTICS = {
+    "max": lambda image_array: np.max(image_array).item(),
+    "mean": lambda image_array: np.average(image_array).item(),
+}
+
+def get_frame_number(name: str):
+    '''Return the frame number from the leading digits of an image file name,
+    such as 12 for '00012.tif', or None if the name does not start with a digit.'''
+    digits = ""
+    for character in name:
+        if not character.isdigit():
+            break
+        digits += character
+    return int(digits) if digits else None
+
+def get_cache_filepath(input_filepath: str, cache_dir: str = None) -> pathlib.Path:
+    '''Return the path of the manifest file for an experiment folder.
+    The manifest is kept in the experiment folder, unless a cache directory is given
+    or the experiment folder is read-only, in which case the user cache directory is used.
+
+    :param input_filepath: input path to the series of tiff images.
+    :param cache_dir: optional directory to keep the manifest files in.
+
+    :return: path of the manifest file.
+    '''
+    input_folder = pathlib.Path(input_filepath).resolve()
+    if cache_dir is None and os.access(input_folder, os.W_OK):
+        return input_folder / MANIFEST_FOLDER / MANIFEST_NAME
+    if cache_dir is None:
+        cache_dir = pathlib.Path(os.environ.get("XDG_CACHE_HOME", pathlib.Path.home() / ".cache")) / "sxrd-tiff-summer"
+    folder_hash = hashlib.sha1(str(input_folder).encode()).hexdigest()[:16]
+    return pathlib.Path(cache_dir) / f"{input_folder.name}_{folder_hash}.json"
+
+class FrameManifest:
+    '''On-disk manifest of the diffraction pattern images in an experiment folder.
+    Records the frame number, size and modification time of each image, the image shape
+    and dtype, and cached per-frame statistics. The folder is only re-listed when it has
+    been modified, and entries are only invalidated when their size or modification time changes.
+    '''
+    def __init__(self, input_filepath: str, cache_dir: str = None):
+        '''
+        :param input_filepath: input path to the series of tiff images.
+        :param cache_dir: optional directory to keep the manifest file in.
+        '''
+        self.input_filepath = input_filepath
+        self.folder = pathlib.Path(input_filepath)
+        self.manifest_filepath = get_cache_filepath(input_filepath, cache_dir)
+        self.directory_mtime_ns = None
+        self.listed_at_ns = None
+        self.shape = None
+        self.dtype = None
+        self.frames = {}
+        self.changed = False
+        self._load()
+
+    def _load(self):
+        '''Load the manifest file, ignoring a missing, unreadable or outdated manifest.'''
+        try:
+            with open(self.manifest_filepath) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != MANIFEST_VERSION:
+            return
+        self.directory_mtime_ns = manifest["directory_mtime_ns"]
+        self.listed_at_ns = manifest["listed_at_ns"]
+        self.shape = tuple(manifest["shape"]) if manifest["shape"] is not None else None
+        self.dtype = manifest["dtype"]
+        self.frames = manifest["frames"]
+
+    def save(self):
+        '''Write the manifest file atomically, if it has changed. A manifest that cannot
+        be written, such as on a read-only file system, is kept in memory only.'''
+        if not self.changed:
+            return
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "folder": str(self.folder.resolve()),
+            "directory_mtime_ns": self.directory_mtime_ns,
+            "listed_at_ns": self.listed_at_ns,
+            "shape": list(self.shape) if self.shape is not None else None,
+            "dtype": self.dtype,
+            "frames": self.frames,
+        }
+        try:
+            os.makedirs(self.manifest_filepath.parent, exist_ok=True)
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.manifest_filepath.parent, suffix=".tmp")
+            with os.fdopen(file_descriptor, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(temporary_path, self.manifest_filepath)
+            self.changed = False
+        except OSError as error:
+            print(f"Could not write the frame manifest '{self.manifest_filepath}': {error}")
+
+    def refresh(self):
+        '''Update the manifest to match the experiment folder. The folder is only listed
+        if it has been modified since the last listing, and only new or changed images are added.'''
+        if not self.folder.is_dir():
+            # a missing folder has no images, in the same way as an empty glob
+            self.frames = {}
+            self.changed = False
+            return
+        directory_mtime_ns = os.stat(self.folder).st_mtime_ns
+        if (directory_mtime_ns == self.directory_mtime_ns and self.listed_at_ns is not None
+                and directory_mtime_ns < self.listed_at_ns - MTIME_MARGIN_NS):
+            return
+
+        listed_at_ns = time.time_ns()
+        frames = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not fnmatch.fnmatchcase(entry.name, MANIFEST_PATTERN) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                frame = self.frames.get(entry.name)
+                if frame is None or frame["size"] != stat.st_size or frame["mtime_ns"] != stat.st_mtime_ns:
+                    frame = {"frame_number": get_frame_number(entry.name),
+                             "size": stat.st_size,
+                             "mtime_ns": stat.st_mtime_ns,
+                             "statistics": {}}
+                frames[entry.name] = frame
+
+        self.frames = dict(sorted(frames.items()))
+        self.directory_mtime_ns = directory_mtime_ns
+        self.listed_at_ns = listed_at_ns
+        self.changed = True
+        if self.shape is None and self.frames:
+            self._read_header(next(iter(self.frames)))
+
+    def _read_header(self, name: str):
+        '''Record the image shape and dtype, read from the header of a single image.'''
+        with tifffile.TiffFile(self.folder / name) as tiff:
+            self.shape = tuple(tiff.pages[0].shape)
+            self.dtype = str(tiff.pages[0].dtype)
+        self.changed = True
+
+    def image_list(self, pattern: str = MANIFEST_PATTERN) -> List[pathlib.Path]:
+        '''Return the sorted list of image paths matching a glob pattern, such as '0*.tiff'.'''
+        return [self.folder / name for name in self.frames if fnmatch.fnmatchcase(name, pattern)]
+
+    def frame_numbers(self, pattern: str = MANIFEST_PATTERN) -> List[int]:
+        '''Return the frame numbers of the images matching a glob pattern, in sorted order.'''
+        return [frame["frame_number"] for name, frame in self.frames.items() if fnmatch.fnmatchcase(name, pattern)]
+
+    def frame_statistics(self, image_list: list, statistics: List[str] = ("max", "mean")) -> dict:
+        '''Return per-frame statistics for a list of images, reading only the images
+        whose statistics are not cached or whose size or modification time has changed.
+
+        :param image_list: list of image paths from this experiment folder.
+        :param statistics: statistics to return, from 'max' and 'mean'.
+
+        :return: dictionary of statistic name to a list of values, in the order of the image list.
+        '''
+        frames = []
+        reads = {}
+        for image_path in image_list:
+            name = pathlib.Path(image_path).name
+            stat = os.stat(image_path)
+            frame = self.frames.get(name)
+            if frame is None or frame["size"] != stat.st_size or frame["mtime_ns"] != stat.st_mtime_ns:
+                frame = {"frame_number": get_frame_number(name),
+                         "size": stat.st_size,
+                         "mtime_ns": stat.st_mtime_ns,
+                         "statistics": {}}
+                self.frames[name] = frame
+                self.changed = True
+            frames.append(frame)
+
+            missing = [statistic for statistic in statistics if statistic not in frame["statistics"]]
+            if missing:
+                reads[image_path] = (frame, missing)
+
+        # only the images without cached statistics are read, ahead of computing their statistics
+        for image_path, image_array in tqdm(prefetch.prefetch_frames(list(reads)), total=len(reads)):
+            frame, missing = reads[image_path]
+            if self.shape is None:
+                self.shape = tuple(np.shape(image_array))
+                self.dtype = str(image_array.dtype)
+            with timing.stage("statistics"):
+                for statistic in missing:
+                    frame["statistics"][statistic] = FRAME_STATISTICS[statistic](image_array)
+            self.changed = True
+
+        values = {statistic: [frame["statistics"][statistic] for frame in frames] for statistic in statistics}
+        self.save()
+        return values
+
+def get_manifest(input_filepath: str, cache_dir: str = None) -> FrameManifest:
+    '''Load the frame manifest of an experiment folder and bring it up to date.
+
+    :param input_filepath: input path to the series of tiff images.
+    :param cache_dir: optional directory to keep the manifest file in.
+
+    :return: up to date frame manifest.
+    '''
+    manifest = FrameManifest(input_filepath, cache_dir)
+    manifest.refresh()
+    manifest.save()
+    return manifest
+
+def list_tiff_images(input_filepath: str, pattern: str, cache_dir: str = None) -> List[pathlib.Path]:
+    '''Return the sorted list of image paths in an experiment folder matching a glob pattern,
+    using the frame manifest in place of re-listing the folder.
+
+    :param input_filepath: input path to the series of tiff images.
+    :param pattern: glob pattern, such as '0*.tiff'.
+    :param cache_dir: optional directory to keep the manifest file in.
+
+    :return: sorted list of image paths.
+    '''
+    return get_manifest(input_filepath, cache_dir).image_list(pattern)
@@ -1,9 +1,6 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import warnings
 warnings.simplefilter('ignore')
-from skimage import io
-import pathlib
 from tqdm import tqdm
 import os
 import yaml
@@ -11,6 +8,13 @@ from typing import Tuple
 from typing import List
 
 import sxrd_tiff_summer_functions as analysis
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_preview_functions as preview
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_region_functions as region_analysis
+import sxrd_tiff_stacking_functions as stacking
+import sxrd_tiff_timing_functions as timing
+from sxrd_tiff_reducer_functions import ImageReducer
 
 def extract_grid_input(config_path: str):
     """Extract additional user inputs from yaml configuration file. 
@@ -40,9 +44,11 @@ def extract_grid_input(config_path: str):
     return shape_x, shape_y, sample_numbers, start_points, end_points
     
 def grid_tiff_intensity(experiment_number: str, input_filepath: str, output_filepath: str, 
-                        shape_x: int, shape_y: int, c_map: str = "Reds"):
+                        shape_x: int, shape_y: int, c_map: str = "Reds", regions: List[dict] = None):
     '''Calculate the maximum and average intensity from a series of diffraction
     pattern images and plot the values as a grid of spatial (X,Y) measurement points.
+    If detector regions are given, such as rings around the beam centre, the maximum and
+    average intensity of each region are also mapped, from the same read of each image.
     
     :param experiment_number: input experiment number.
     :param input_filepath: input path to the series of tiff images.
@@ -50,20 +56,9 @@ def grid_tiff_intensity(experiment_number: str, input_filepath: str, output_file
     :param shape_x: number of diffraction measurement points along X.
     :param shape_y: number of diffraction measurement points along Y.
     :param c_map: colour scale for the intensity map.
+    :param regions: optional list of detector regions, as returned by extract_region_input.
     '''
-    
-    # define the plot parameters
-    plt.rc('xtick', labelsize = 24)
-    plt.rc('ytick', labelsize = 24)
-    plt.rc('legend', fontsize = 20)
-    plt.rc('axes', linewidth = 2)
-    plt.rc('xtick.major', width = 2, size = 10)
-    plt.rc('xtick.minor', width = 2, size = 5)
-    plt.rc('ytick.major', width = 2, size = 10)
-    plt.rc('ytick.minor', width = 2, size = 5)
-    
-    max_list = []
-    avg_list = []
+    timing.set_experiment(experiment_number)
     
     # check if the output directory exists and if not create it
     CHECK_FOLDER = os.path.isdir(f"{output_filepath}")
@@ -75,57 +70,112 @@ def grid_tiff_intensity(experiment_number: str, input_filepath: str, output_file
     else:
         print(f"'{output_filepath}' folder already exists.")
     
-    # load the diffraction pattern images and calculate the maximum and average intensity for each
-    image_list = sorted(pathlib.Path(input_filepath).glob("0*.tif*"))
+    if regions is not None:
+        # the regions need every image to be read, so the whole detector statistics come from the same pass
+        max_list, avg_list, region_max, region_avg = region_analysis.get_region_intensity_lists(input_filepath, "0*.tif*", regions)
+        plot_region_intensity_maps(experiment_number, output_filepath, regions, region_max, region_avg, shape_x, shape_y, c_map)
     
-    for image_path in tqdm(image_list):
-        image_array = io.imread(image_path)
-        max_image = np.max(image_array)
-        avg_image = np.average(image_array)
-        
-        max_list.append(max_image)
-        avg_list.append(avg_image)
+    else:
+        # load the maximum and average intensity for each diffraction pattern image,
+        # only reading the images without cached statistics in the frame manifest
+        frame_statistics = frame_reader.get_frame_statistics(input_filepath, "0*.tif*", ["max", "mean"])
+        max_list = frame_statistics["max"]
+        avg_list = frame_statistics["mean"]
+    
+    plot_intensity_maps(experiment_number, output_filepath, max_list, avg_list, shape_x, shape_y, c_map)
+
+def plot_region_intensity_maps(experiment_number: str, output_filepath: str, regions: List[dict],
+                               region_max: np.ndarray, region_avg: np.ndarray,
+                               shape_x: int, shape_y: int, c_map: str = "Reds"):
+    '''Plot and save the maximum and average intensity maps of each detector region,
+    named such as '{experiment_number}_{region name}_MAX_intensity_map.png'.
+    
+    :param experiment_number: input experiment number.
+    :param output_filepath: output path to save the intensity maps.
+    :param regions: list of detector regions, in the order of the columns of the intensity arrays.
+    :param region_max: maximum intensity of each region in each image, with one row per image.
+    :param region_avg: average intensity of each region in each image, with one row per image.
+    :param shape_x: number of diffraction measurement points along X.
+    :param shape_y: number of diffraction measurement points along Y.
+    :param c_map: colour scale for the intensity maps.
+    '''
+    for index, region in enumerate(regions):
+        print(f"Intensity maps for region '{region['name']}':")
+        plot_intensity_maps(f"{experiment_number}_{region['name']}", output_filepath,
+                            region_max[:, index], region_avg[:, index], shape_x, shape_y, c_map)
+    
+def plot_intensity_maps(experiment_number: str, output_filepath: str, max_list: list, avg_list: list,
+                        shape_x: int, shape_y: int, c_map: str = "Reds"):
+    '''Plot the maximum and average intensity of a series of diffraction pattern images
+    as a grid of spatial (X,Y) measurement points, and save the intensity maps.
+    
+    :param experiment_number: input experiment number.
+    :param output_filepath: output path to save the intensity map.
+    :param max_list: maximum intensity of each diffraction pattern image, with NaN for points not yet measured.
+    :param avg_list: average intensity of each diffraction pattern image, with NaN for points not yet measured.
+    :param shape_x: number of diffraction measurement points along X.
+    :param shape_y: number of diffraction measurement points along Y.
+    :param c_map: colour scale for the intensity map.
+    '''
+    # imported when needed, as matplotlib is slow to import
+    import matplotlib.pyplot as plt
+    
+    # define the plot parameters
+    plt.rc('xtick', labelsize = 24)
+    plt.rc('ytick', labelsize = 24)
+    plt.rc('legend', fontsize = 20)
+    plt.rc('axes', linewidth = 2)
+    plt.rc('xtick.major', width = 2, size = 10)
+    plt.rc('xtick.minor', width = 2, size = 5)
+    plt.rc('ytick.major', width = 2, size = 10)
+    plt.rc('ytick.minor', width = 2, size = 5)
         
     # set max and min intensities for the maximum intensity map    
-    v_min = min(max_list)
-    v_max = max(max_list)
+    v_min = np.nanmin(max_list)
+    v_max = np.nanmax(max_list)
     
     # plot and save the maximum intensity map
-    fig, ax = plt.subplots(figsize=(20, 10))
-    max_array = np.array(max_list)
-    shape = (shape_y, shape_x)
-    image = ax.imshow(max_array.reshape(shape), interpolation='nearest', cmap = c_map, vmin = v_min, vmax = v_max, extent=[0,shape_x,shape_y,0])
-    ax.minorticks_on()
-    ax.set_xlabel("X", fontsize = 25)
-    ax.set_ylabel("Y", fontsize = 25, rotation = 0, labelpad=50)
-    ax.set_title("Maximum Intensity Map \n", fontsize = 25)
-    plt.colorbar(image, ax=ax, location = 'bottom', shrink = 0.4)
-    fig.tight_layout()
-    fig.savefig(f"{output_filepath}{experiment_number}_MAX_intensity_map.png")
+    with timing.stage("plot"):
+        fig, ax = plt.subplots(figsize=(20, 10))
+        max_array = np.array(max_list)
+        shape = (shape_y, shape_x)
+        image = ax.imshow(max_array.reshape(shape), interpolation='nearest', cmap = c_map, vmin = v_min, vmax = v_max, extent=[0,shape_x,shape_y,0])
+        ax.minorticks_on()
+        ax.set_xlabel("X", fontsize = 25)
+        ax.set_ylabel("Y", fontsize = 25, rotation = 0, labelpad=50)
+        ax.set_title("Maximum Intensity Map \n", fontsize = 25)
+        plt.colorbar(image, ax=ax, location = 'bottom', shrink = 0.4)
+        fig.tight_layout()
+    with timing.stage("save") as save_stage:
+        fig.savefig(f"{output_filepath}{experiment_number}_MAX_intensity_map.png")
+        save_stage.written(f"{output_filepath}{experiment_number}_MAX_intensity_map.png")
     
     print(f"Figure saved to: {output_filepath}{experiment_number}_MAX_intensity_map.png")
 
     # set max and min intensities for the average intensity map 
-    v_min_avg = min(avg_list)
-    v_max_avg = max(avg_list)
+    v_min_avg = np.nanmin(avg_list)
+    v_max_avg = np.nanmax(avg_list)
     
     # plot and save the average intensity map
-    fig, ax = plt.subplots(figsize=(20, 10))
-    avg_array = np.array(avg_list)
-    shape = (shape_y, shape_x)
-    image = ax.imshow(avg_array.reshape(shape), interpolation='nearest', cmap = c_map, vmin = v_min_avg, vmax = v_max_avg, extent=[0,shape_x,shape_y,0])
-    ax.minorticks_on()
-    ax.set_xlabel("X", fontsize = 25)
-    ax.set_ylabel("Y", fontsize = 25, rotation = 0, labelpad=50)
-    ax.set_title("Average Intensity Map \n", fontsize = 25)
-    plt.colorbar(image, ax=ax, location = 'bottom', shrink = 0.4)
-    fig.tight_layout()
-    fig.savefig(f"{output_filepath}{experiment_number}_AVG_intensity_map.png")
+    with timing.stage("plot"):
+        fig, ax = plt.subplots(figsize=(20, 10))
+        avg_array = np.array(avg_list)
+        shape = (shape_y, shape_x)
+        image = ax.imshow(avg_array.reshape(shape), interpolation='nearest', cmap = c_map, vmin = v_min_avg, vmax = v_max_avg, extent=[0,shape_x,shape_y,0])
+        ax.minorticks_on()
+        ax.set_xlabel("X", fontsize = 25)
+        ax.set_ylabel("Y", fontsize = 25, rotation = 0, labelpad=50)
+        ax.set_title("Average Intensity Map \n", fontsize = 25)
+        plt.colorbar(image, ax=ax, location = 'bottom', shrink = 0.4)
+        fig.tight_layout()
+    with timing.stage("save") as save_stage:
+        fig.savefig(f"{output_filepath}{experiment_number}_AVG_intensity_map.png")
+        save_stage.written(f"{output_filepath}{experiment_number}_AVG_intensity_map.png")
     
     print(f"Figure saved to: {output_filepath}{experiment_number}_AVG_intensity_map.png")
     
     # calculate average intensity of all diffraction pattern images
-    avg_mean = np.mean(avg_list)
+    avg_mean = np.nanmean(avg_list)
     print(f"The average intensity of all diffraction pattern images in the series is: {avg_mean}")
     
 def plot_grid_points(experiment_number: str, output_filepath: str,
@@ -142,6 +192,8 @@ def plot_grid_points(experiment_number: str, output_filepath: str,
     :param shape_x: length of the diffraction pattern measurement grid along X
     :param shape_y: length of the diffraction pattern measurement grid along Y
     '''
+    # imported when needed, as matplotlib is slow to import
+    import matplotlib.pyplot as plt
     
     # define the plot parameters
     plt.rc('xtick', labelsize = 24)
@@ -180,15 +232,182 @@ def plot_grid_points(experiment_number: str, output_filepath: str,
     fig.savefig(f"{output_filepath}{experiment_number}_start-end_points_map.png")
     print(f"Figure saved to: {output_filepath}{experiment_number}_AVG_intensity_map.png")
     
+def index_tiff_numbers(image_list: list, tiff_strings: list) -> dict:
+    '''Build an index from each zero-padded tiff number string to the image paths
+    that contain it, in the order of the image list. A path is matched by the same rule
+    as a string search of the full path, so each path is scanned only once.
+    
+    :param image_list: sorted list of image paths.
+    :param tiff_strings: zero-padded tiff number strings to index.
+    
+    :return: dictionary of tiff number string to list of image paths.
+    '''
+    index = {tiff_string: [] for tiff_string in tiff_strings}
+    lengths = {len(tiff_string) for tiff_string in index}
+    
+    for image_path in image_list:
+        path_string = str(image_path)
+        found = set()
+        for length in lengths:
+            for i in range(len(path_string) - length + 1):
+                window = path_string[i:i + length]
+                if window in index and window not in found:
+                    found.add(window)
+                    index[window].append(image_path)
+    
+    return index
+
+def get_sample_image_lists(image_list: list, start_points: list, end_points: list, shape_x: int) -> List[list]:
+    '''Select the image paths for each sample, using the start and end points
+    of the spatial (X,Y) measurement points contained within each sample.
+    
+    :param image_list: sorted list of image paths for the entire measurement grid.
+    :param start_points: list of starting measurement points (X,Y) for each of the numbered samples.
+    :param end_points: list of ending measurement points (X,Y) for each of the numbered samples.
+    :param shape_x: length of the diffraction pattern measurement grid along X
+    
+    :return: list of image path lists, one for each sample.
+    '''
+    sample_tiff_strings = []
+    for start_point, end_point in zip(start_points, end_points):
+        tiff_strings = []
+        for start_y in range(start_point[1],end_point[1]+1):
+            for start_x in range(start_point[0],end_point[0]+1):
+                # as tiffs are numbered sequentially along horizontal, calculate tiff number for each position
+                width = shape_x
+                tiff_number = (start_x+1)+(start_y*width)
+                tiff_strings.append(f"{tiff_number:05}")
+        sample_tiff_strings.append(tiff_strings)
+    
+    index = index_tiff_numbers(image_list, {tiff_string for tiff_strings in sample_tiff_strings for tiff_string in tiff_strings})
+    
+    return [[image_path for tiff_string in tiff_strings for image_path in index[tiff_string]]
+            for tiff_strings in sample_tiff_strings]
+
+def get_image_samples(reducers: List[ImageReducer], sample_image_lists: List[list]) -> dict:
+    '''Map each image path to the reducers of the samples whose list of images contains it.
+    An image listed more than once for a sample is mapped to its reducer more than once.
+    
+    :param reducers: list of reducers, one for each sample.
+    :param sample_image_lists: list of image path lists, one for each sample.
+    
+    :return: dictionary of image path to a list of reducers.
+    '''
+    image_samples = {}
+    for reducer, sample_image_list in zip(reducers, sample_image_lists):
+        for image_path in sample_image_list:
+            image_samples.setdefault(image_path, []).append(reducer)
+    return image_samples
+
+def reduce_sample_images(image_list: list, sample_image_lists: List[list], statistics: List[str] = ()) -> List[ImageReducer]:
+    '''Read each image in the series once, in order, and add it to the reducer
+    of every sample whose list of images contains it.
+    
+    :param image_list: sorted list of image paths for the entire measurement grid.
+    :param sample_image_lists: list of image path lists, one for each sample.
+    :param statistics: additional statistics to track, from 'sum', 'max', 'min' and 'variance'.
+    
+    :return: list of reducers, one for each sample.
+    '''
+    reducers = [ImageReducer(statistics) for _ in sample_image_lists]
+    image_samples = get_image_samples(reducers, sample_image_lists)
+    
+    # only the images in a sample are read
+    sample_images = [image_path for image_path in image_list if image_path in image_samples]
+    for image_path, image_array in tqdm(prefetch.prefetch_frames(sample_images), total=len(sample_images)):
+        with timing.stage("reduce"):
+            for reducer in image_samples[image_path]:
+                reducer.update(image_array)
+    
+    return reducers
+
+def save_sample_image(experiment_number: str, output_filepath: str, v_max: int, sample_number: int,
+                      reducer: ImageReducer, sample_image_list: list, statistics: List[str] = (), plot: bool = True,
+                      previews: List[int] = (), image_array: np.ndarray = None):
+    '''Save the average tiff image of a single sample to its output folder, along with
+    a text file of the contributory images.
+    
+    :param experiment_number: input experiment number.
+    :param output_filepath: output path to save single summed/averaged tiff images for each sample.
+    :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param sample_number: reference number of the sample.
+    :param reducer: reducer holding the accumulated intensity of the sample images, or None if the image is given.
+    :param sample_image_list: list of image paths contributing to the sample.
+    :param statistics: additional images to save for the sample, from 'sum', 'max', 'min' and 'variance'.
+    :param plot: plot the summed/averaged image, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged image, such as (2, 4, 8).
+    :param image_array: integer 32 bit summed/averaged intensity array of the sample, in place of the mean of the reducer.
+    '''
+    # check if the output directory exists and if not create it
+    output_filepath_sample = f"{output_filepath}sample_{sample_number}/"
+    CHECK_FOLDER = os.path.isdir(output_filepath_sample)
+
+    if not CHECK_FOLDER:
+        os.makedirs(output_filepath_sample)
+        print(f"Created folder : '{output_filepath_sample}'.")
+
+    else:
+        print(f"'{output_filepath_sample}' folder already exists.")
+
+    if not sample_image_list:
+        print(f"No diffraction pattern images were found for sample {sample_number}.")
+    
+    else:
+        if image_array is None:
+            with timing.stage("reduce"):
+                # normalise the image array intensity
+                image_array = reducer.mean()
+                # convert to integer 32 bit array
+                image_array = image_array.astype('int32')
+
+        preview_arrays = {}
+        if previews:
+            with timing.stage("preview"):
+                preview_arrays = preview.bin_images(image_array, previews)
+
+        if plot:
+            with timing.stage("plot"):
+                preview.plot_preview(image_array, preview_arrays, v_max)
+
+        # save the image
+        with timing.stage("save") as save_stage:
+            frame_reader.write_tiff(f"{output_filepath_sample}{experiment_number}_summed1.tiff", image_array)
+            save_stage.written(f"{output_filepath_sample}{experiment_number}_summed1.tiff")
+        preview.save_previews(output_filepath_sample, f"{experiment_number}_summed1.tiff", preview_arrays)
+
+        print(f"Written .tiff image to: '{output_filepath_sample}'.")
+        
+        analysis.save_statistic_images(experiment_number, reducer, statistics, output_filepath_sample)
+    
+    # write out a text file of contributory images
+    output_text = f"{output_filepath_sample}sample_{sample_number}_image_list.txt"
+    
+    with open(output_text, 'w') as output_file:
+        
+        # write description header
+        output_file.write(f"The summed tiff image for sample {sample_number} was created from the average intensity of the following diffraction pattern images... \n")
+
+        # write image paths
+        for i in range(0, len(sample_image_list)):
+            output_file.write(f"{sample_image_list[i]}\n")
+
+    print(f"Written .txt file to: '{output_text}'.")
+
 def avg_tiff_images_grid(experiment_number: str, input_filepath: str, output_filepath: str, v_max: int,
                         sample_numbers: list, start_points: list, end_points: list, 
-                        shape_x: int):
+                        shape_x: int, statistics: List[str] = (), plot: bool = True, previews: List[int] = (),
+                        method: str = "mean", stacking_memory: int = None, spill_directory: str = None):
     '''Use a list of start and end points, defining the spatial (X,Y) 
     measurement points, to select different samples. Using these points, sum up 
     the intensities of different series of tiff images, for different samples, 
     from an input folder. Save a single average tiff image, for each sample, 
     to the output folders.
     
+    Each image is read once and added to every sample containing it, so one
+    accumulator per sample is held in memory at the same time. The 'median' and
+    'sigma_clip' methods instead stack the images of each sample in turn, in tiles
+    of rows fitting the stacking memory.
+    
     :param experiment_number: input experiment number.
     :param input_filepath: input path to the entire series of tiff images.
     :param output_filepath: output path to save single summed/averaged tiff images for each sample.
@@ -197,64 +416,37 @@ def avg_tiff_images_grid(experiment_number: str, input_filepath: str, output_fil
     :param start_points: list of starting measurement points (X,Y) for each of the numbered samples.
     :param end_points: list of ending measurement points (X,Y) for each of the numbered samples.
     :param shape_x: length of the diffraction pattern measurement grid along X 
+    :param statistics: additional images to save for each sample, from 'sum', 'max', 'min' and 'variance'.
+    :param plot: plot the summed/averaged image of each sample, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged image of each sample, such as (2, 4, 8).
+    :param method: per-pixel average of the images of each sample, from 'mean', 'median' and 'sigma_clip'.
+    :param stacking_memory: memory in bytes for the tiles of rows held by the 'median' and 'sigma_clip' methods, 1 GiB by default.
+    :param spill_directory: folder of the temporary file a series larger than the stacking memory is copied to by the 'median' and 'sigma_clip' methods, the output folder by default.
     '''
+    stacking.check_method(method, statistics)
+    timing.set_experiment(experiment_number)
     
-    image_list = sorted(pathlib.Path(input_filepath).glob("0*.tif*"))
-
-    # segment each sample in turn
-    for sample_number, start_point, end_point in tqdm(zip(sample_numbers, start_points, end_points), 
-                                                      total=len(sample_numbers)):
-
-        # set the image arrays to zero to prevent unusual memory allocation
-        image_example = io.imread(image_list[1])
-        image_array = np.zeros(shape=np.shape(image_example), dtype='int32')
-        sample_image_list = []
-
-        for start_y in range(start_point[1],end_point[1]+1):
-            for start_x in range(start_point[0],end_point[0]+1):
-                # as tiffs are numbered sequentially along horizontal, calculate tiff number for each position
-                width = shape_x
-                tiff_number = (start_x+1)+(start_y*width)
-                tiff_string = f"{tiff_number:05}"
-                
-                # find tiff number in path list and add it to the image array
-                for image_path in image_list:
-                     if str(image_path).find(tiff_string) != -1:
-                            sample_image_list.append(image_path)
-                            image_array = image_array + np.array(io.imread(image_path))
-        
-        # normalise the image array intensity
-        image_array = image_array / len(sample_image_list)
-        # convert to integer 32 bit array
-        image_array = image_array.astype('int32')
-        plt.imshow(image_array, cmap='gray', vmin = 0, vmax = v_max)
-
-        # check if the output directory exists and if not create it
-        output_filepath_sample = f"{output_filepath}sample_{sample_number}/"
-        CHECK_FOLDER = os.path.isdir(output_filepath_sample)
-
-        if not CHECK_FOLDER:
-            os.makedirs(output_filepath_sample)
-            print(f"Created folder : '{output_filepath_sample}'.")
-
-        else:
-            print(f"'{output_filepath_sample}' folder already exists.")
-
-        # save the image
-        io.imsave(f"{output_filepath_sample}{experiment_number}_summed1.tiff", image_array)
+    image_list = frame_reader.list_frames(input_filepath, "0*.tif*")
+    
+    sample_image_lists = get_sample_image_lists(image_list, start_points, end_points, shape_x)
 
-        print(f"Written .tiff image to: '{output_filepath_sample}'.")
-        
-        # write out a text file of contributory images
-        output_text = f"{output_filepath_sample}sample_{sample_number}_image_list.txt"
-        
-        with open(output_text, 'w') as output_file:
-            
-            # write description header
-            output_file.write(f"The summed tiff image for sample {sample_number} was created from the average intensity of the following diffraction pattern images... \n")
+    if method != "mean":
+        # spill to the output folder, as the system temporary folder can be held in memory on cluster nodes
+        spill_directory = output_filepath if spill_directory is None else spill_directory
+        for sample_number, sample_image_list in zip(sample_numbers, sample_image_lists):
+            image_array = None
+            if sample_image_list:
+                image_array = stacking.stack_tiff_images(experiment_number, sample_image_list, method, stacking_memory,
+                                                         spill_directory = spill_directory)
+                # convert to integer 32 bit array
+                image_array = image_array.astype('int32')
+            save_sample_image(experiment_number, output_filepath, v_max, sample_number,
+                              None, sample_image_list, statistics, plot, previews, image_array)
+        return
 
-            # write image paths
-            for i in range(0, len(sample_image_list)):
-                output_file.write(f"{sample_image_list[i]}\n")
+    reducers = reduce_sample_images(image_list, sample_image_lists, statistics)
 
-        print(f"Written .txt file to: '{output_text}'.")
\ No newline at end of file
+    # save each sample in turn
+    for sample_number, reducer, sample_image_list in zip(sample_numbers, reducers, sample_image_lists):
+        save_sample_image(experiment_number, output_filepath, v_max, sample_number,
+                          reducer, sample_image_list, statistics, plot, previews)
\ No newline at end of file
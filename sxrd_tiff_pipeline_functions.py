@@ -0,0 +1,181 @@
+import numpy as np
+import os
+from tqdm import tqdm
+from typing import List
+
+import sxrd_tiff_summer_functions as analysis
+import sxrd_tiff_mapper_functions as grid_analysis
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_preview_functions as preview
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_region_functions as region_analysis
+import sxrd_tiff_stack_functions as stack
+import sxrd_tiff_timing_functions as timing
+from sxrd_tiff_manifest_functions import FRAME_STATISTICS
+from sxrd_tiff_reducer_functions import ImageReducer
+
+# sub-folders of the experiment output path, matching those used in the notebooks
+INTENSITY_MAP_FOLDER = "intensity_maps/"
+SUBTRACTED_FOLDER = "subtract-background/"
+
+def get_background(background_scatter_path: str, background_scatter_multiple: int):
+    '''Return the scaled background scattering intensity array, or None if the
+    configuration has no background scatter image (written as 'None' in the yaml files).
+
+    :param background_scatter_path: path to the background scatter tiff image.
+    :param background_scatter_multiple: value to multiply the background scatter intensity, to match the acquisition frequency of the data.
+    '''
+    if background_scatter_path in (None, "None"):
+        return None
+    return analysis.get_subtract_image_array(background_scatter_path, background_scatter_multiple)
+
+def pipeline_experiment(experiment_number: str, input_filepath: str, output_filepath: str, v_max: int,
+                        subtract_image_array: np.ndarray = None, grid_input: tuple = None, c_map: str = "Reds",
+                        save_subtracted: str = None, statistics: List[str] = (), pattern: str = "0*.tif*",
+                        plot: bool = True, regions: List[dict] = None, previews: List[int] = ()):
+    '''Read each diffraction pattern image of an experiment once, subtract the background
+    and, in the same pass, accumulate the summed/averaged image, the averaged image of
+    each sample in the grid and the maximum and average intensity of each image.
+    Outputs are saved with the same names as the separate summing and mapping functions.
+
+    :param experiment_number: input experiment number.
+    :param input_filepath: input path to the series of tiff images, or to a tiff stack.
+    :param output_filepath: output path to save the summed/averaged image, sample images and intensity maps.
+    :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param subtract_image_array: scaled background scattering intensity array to subtract, or None.
+    :param grid_input: shape_x, shape_y, sample_numbers, start_points and end_points, as returned by extract_grid_input, or None.
+    :param c_map: colour scale for the intensity maps.
+    :param save_subtracted: None, or 'tif' or 'stack' to also save the subtracted images.
+    :param statistics: additional images to save from the same pass, from 'sum', 'max', 'min' and 'variance'.
+    :param pattern: glob pattern selecting the images in the input folder.
+    :param plot: plot the summed/averaged images, which can be turned off for batch runs.
+    :param regions: optional list of detector regions to also map, as returned by extract_region_input.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged and subtracted images, such as (2, 4, 8).
+    '''
+    if save_subtracted is not None:
+        analysis.check_output_format(save_subtracted)
+        if subtract_image_array is None:
+            raise ValueError("Subtracted images can only be saved when a background scatter image is given.")
+
+    timing.set_experiment(experiment_number)
+    image_list = frame_reader.list_frames(input_filepath, pattern)
+    if not image_list:
+        raise FileNotFoundError(f"No tiff images found in '{input_filepath}'.")
+
+    reducer = ImageReducer(statistics)
+    max_list = []
+    avg_list = []
+    region_max = []
+    region_avg = []
+    region_statistics = None
+
+    image_samples = {}
+    if grid_input is not None:
+        shape_x, shape_y, sample_numbers, start_points, end_points = grid_input
+        sample_image_lists = grid_analysis.get_sample_image_lists(image_list, start_points, end_points, shape_x)
+        sample_reducers = [ImageReducer(statistics) for _ in sample_image_lists]
+        image_samples = grid_analysis.get_image_samples(sample_reducers, sample_image_lists)
+
+    writer = None
+    preview_writer = None
+    if save_subtracted is not None:
+        output_filepath_subtracted = f"{output_filepath}{SUBTRACTED_FOLDER}"
+        os.makedirs(output_filepath_subtracted, exist_ok=True)
+        if save_subtracted == "stack":
+            names = [image_path.name for image_path in image_list]
+            writer = stack.TiffStackWriter(analysis.get_stack_filepath(experiment_number, output_filepath_subtracted), names)
+            if previews:
+                preview_writer = preview.PreviewStackWriter(writer.stack_filepath, names, previews)
+
+    # the images are read ahead, and the subtracted images saved, while each image is processed
+    frame_writer = prefetch.FrameWriter()
+    try:
+        for image_path, image_array in tqdm(prefetch.prefetch_frames(image_list), total=len(image_list)):
+
+            if subtract_image_array is not None:
+                image_array = analysis.subtract_image(image_array, subtract_image_array)
+                if writer is not None:
+                    frame_writer.submit(analysis.save_stack_image, writer, preview_writer, image_array)
+                elif save_subtracted == "tif":
+                    frame_writer.submit(analysis.save_subtracted_image, experiment_number, image_path, image_array,
+                                        output_filepath_subtracted, previews)
+
+            with timing.stage("reduce"):
+                reducer.update(image_array)
+                for sample_reducer in image_samples.get(image_path, ()):
+                    sample_reducer.update(image_array)
+
+            if regions is not None and region_statistics is None:
+                region_statistics = region_analysis.get_region_statistics(image_array.shape, regions)
+
+            with timing.stage("statistics"):
+                max_list.append(FRAME_STATISTICS["max"](image_array))
+                avg_list.append(FRAME_STATISTICS["mean"](image_array))
+                if region_statistics is not None:
+                    frame_region_statistics = region_statistics(image_array)
+                    region_max.append(frame_region_statistics["max"])
+                    region_avg.append(frame_region_statistics["mean"])
+    finally:
+        try:
+            frame_writer.close()
+        finally:
+            if preview_writer is not None:
+                preview_writer.close()
+            if writer is not None:
+                writer.close()
+                with timing.stage("save") as save_stage:
+                    save_stage.written(writer.stack_filepath)
+
+    if save_subtracted is not None:
+        print(f"Written {len(image_list)} subtracted tiff images to: '{output_filepath_subtracted}'.")
+
+    analysis.save_avg_tiff_image(experiment_number, [reducer], output_filepath, v_max, statistics, plot, previews)
+
+    if grid_input is not None:
+        for sample_number, sample_reducer, sample_image_list in zip(sample_numbers, sample_reducers, sample_image_lists):
+            grid_analysis.save_sample_image(experiment_number, output_filepath, v_max, sample_number,
+                                            sample_reducer, sample_image_list, statistics, plot, previews)
+
+        output_filepath_maps = f"{output_filepath}{INTENSITY_MAP_FOLDER}"
+        os.makedirs(output_filepath_maps, exist_ok=True)
+        grid_analysis.plot_intensity_maps(experiment_number, output_filepath_maps, max_list, avg_list, shape_x, shape_y, c_map)
+        if regions is not None:
+            grid_analysis.plot_region_intensity_maps(experiment_number, output_filepath_maps, regions,
+                                                     np.array(region_max), np.array(region_avg), shape_x, shape_y, c_map)
+
+def run_pipeline(config_path: str, v_max: int, c_map: str = "Reds", save_subtracted: str = None,
+                 statistics: List[str] = (), pattern: str = "0*.tif*", timing_filepath: str = None,
+                 plot: bool = True, previews: List[int] = ()):
+    '''Run the single pass pipeline for every experiment in a yaml configuration file.
+    The background scatter image is subtracted if the configuration gives one, and the
+    sample images and intensity maps are made if the configuration has a 'grid_info' block,
+    with maps of each detector region if it also has a 'regions' block.
+
+    :param config_path: path to the configuration file.
+    :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param c_map: colour scale for the intensity maps.
+    :param save_subtracted: None, or 'tif' or 'stack' to also save the subtracted images.
+    :param statistics: additional images to save from the same pass, from 'sum', 'max', 'min' and 'variance'.
+    :param pattern: glob pattern selecting the images in each input folder.
+    :param timing_filepath: optional path to save a JSON summary of the time spent in each stage of each experiment.
+    :param plot: plot the summed/averaged images, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged and subtracted images, such as (2, 4, 8).
+    '''
+    experiment_numbers, input_path, output_path, background_scatter_path, background_scatter_multiple = analysis.extract_input(config_path)
+    subtract_image_array = get_background(background_scatter_path, background_scatter_multiple)
+
+    grid_input = None
+    regions = None
+    if "grid_info" in analysis.get_config(config_path):
+        grid_input = grid_analysis.extract_grid_input(config_path)
+        regions = region_analysis.extract_region_input(config_path)
+
+    with timing.TimedRun("run_pipeline", timing_filepath):
+        for experiment_number in experiment_numbers:
+
+            experiment_number = str(experiment_number)
+            input_filepath = input_path.format(experiment_number = experiment_number)
+            output_filepath = output_path.format(experiment_number = experiment_number)
+
+            pipeline_experiment(experiment_number, input_filepath, output_filepath, v_max,
+                                subtract_image_array, grid_input, c_map, save_subtracted, statistics, pattern, plot, regions, previews)
@@ -0,0 +1,147 @@
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_timing_functions as timing
+
+# default number of frames read ahead of the frame being processed, 0 to read and write serially
+PREFETCH_FRAMES = 8
+# default memory in bytes held by the read-ahead and write-behind queues of a loop, half each
+PREFETCH_MEMORY = 512 * 2**20
+# default number of threads reading frames ahead
+PREFETCH_THREADS = 4
+
+_settings = {"frames": PREFETCH_FRAMES, "memory_limit": PREFETCH_MEMORY, "threads": PREFETCH_THREADS}
+# marks the end of the image list
+_END = object()
+
+def set_prefetch(frames: int = None, memory_limit: int = None, threads: int = None):
+    '''Set the read-ahead and write-behind limits used by every per-frame loop in this process.
+    Worker processes started with 'spawn' use the defaults.
+
+    :param frames: number of frames read ahead of the frame being processed, 0 to read and write serially.
+    :param memory_limit: memory in bytes held by the read-ahead and write-behind queues of a loop, half each.
+    :param threads: number of threads reading frames ahead.
+    '''
+    for name, value in (("frames", frames), ("memory_limit", memory_limit), ("threads", threads)):
+        if value is not None:
+            _settings[name] = value
+
+def get_prefetch() -> dict:
+    '''Return the read-ahead and write-behind limits in use.'''
+    return dict(_settings)
+
+def prefetch_frames(image_list, frames: int = None, memory_limit: int = None, threads: int = None):
+    '''Read the images of a series on background threads, ahead of the frame being processed,
+    and yield them in order. Frames are read ahead into a bounded queue, holding no more than
+    the number of frames and half of the memory limit, so the storage latency of each read is
+    hidden behind the processing of the frames before it. The pixels of memory-mapped images are
+    read into the page cache by the reading threads. The 'read' stage records the time spent
+    waiting for each frame.
+
+    :param image_list: list of image paths, or of references to images with a 'read' method.
+    :param frames: number of frames read ahead, 0 to read each frame when it is needed, the setting by default.
+    :param memory_limit: memory in bytes held by the read-ahead and write-behind queues, the setting by default.
+    :param threads: number of threads reading frames ahead, the setting by default.
+
+    :return: generator of (image path, intensity array).
+    '''
+    frames = _settings["frames"] if frames is None else frames
+    memory_limit = _settings["memory_limit"] if memory_limit is None else memory_limit
+    threads = _settings["threads"] if threads is None else threads
+
+    if frames < 1:
+        for image_path in image_list:
+            yield image_path, frame_reader.read_frame(image_path)
+        return
+
+    image_iterator = iter(image_list)
+    pending = collections.deque()
+    # a single frame is read until the size of a frame is known
+    depth = None
+    exhausted = False
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="sxrd-prefetch")
+    try:
+        while True:
+            while not exhausted and len(pending) < (depth or 1):
+                image_path = next(image_iterator, _END)
+                if image_path is _END:
+                    exhausted = True
+                else:
+                    pending.append((image_path, executor.submit(frame_reader.load_frame, image_path)))
+            if not pending:
+                break
+
+            image_path, future = pending.popleft()
+            with timing.stage("read") as read_stage:
+                image_array = future.result()
+                read_stage.read(image_array)
+            if depth is None:
+                depth = max(1, min(frames, memory_limit // 2 // max(image_array.nbytes, 1)))
+            yield image_path, image_array
+    finally:
+        # frames still queued when the loop stops early are not read
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+class FrameWriter:
+    '''Save output images on a background thread, in the order they are submitted, so the
+    next frame is read and processed while the previous one is written. The arrays waiting
+    to be saved are held in a bounded queue of no more than half of the memory limit, and
+    submitting blocks until there is room. An error raised by a save is raised again by the
+    next call to submit, or by close.
+
+        with FrameWriter() as writer:
+            for image_path, image_array in prefetch_frames(image_list):
+                writer.submit(save_subtracted_image, experiment_number, image_path, image_array, output_filepath)
+    '''
+    def __init__(self, frames: int = None, memory_limit: int = None):
+        '''
+        :param frames: 0 to save each image when it is submitted, the setting by default.
+        :param memory_limit: memory in bytes held by the read-ahead and write-behind queues, the setting by default.
+        '''
+        frames = _settings["frames"] if frames is None else frames
+        self.memory_limit = (_settings["memory_limit"] if memory_limit is None else memory_limit) // 2
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        # a single thread saves the images, so they are written in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sxrd-writer") if frames >= 1 else None
+
+    def submit(self, save_function, *arguments):
+        '''Queue a call saving an output image, such as save_subtracted_image.
+
+        :param save_function: function saving the image.
+        :param arguments: arguments of the function, whose arrays are counted against the memory limit.
+        '''
+        if self._executor is None:
+            save_function(*arguments)
+            return
+        nbytes = sum(argument.nbytes for argument in arguments if isinstance(argument, np.ndarray))
+        self._collect(self.memory_limit - nbytes)
+        self._pending.append((self._executor.submit(save_function, *arguments), nbytes))
+        self._pending_bytes += nbytes
+
+    def _collect(self, pending_limit: int):
+        '''Wait for the oldest saves until no more than a number of bytes are pending,
+        collecting any saves that have already completed.'''
+        while self._pending and (self._pending[0][0].done() or self._pending_bytes > pending_limit):
+            future, nbytes = self._pending.popleft()
+            self._pending_bytes -= nbytes
+            future.result()
+
+    def close(self):
+        '''Wait for every queued save to complete.'''
+        if self._executor is None:
+            return
+        try:
+            self._collect(-1)
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
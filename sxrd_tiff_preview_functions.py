@@ -0,0 +1,188 @@
+import numpy as np
+import os
+import tifffile
+from typing import List
+
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_stack_functions as stack
+import sxrd_tiff_timing_functions as timing
+
+# binning factors of the preview levels written alongside the full resolution images
+PREVIEW_BINNINGS = (2, 4, 8)
+# longest side in pixels of the display previews are chosen for by default, that of a default matplotlib figure
+PREVIEW_DISPLAY_SIZE = 640
+
+def get_preview_folder(output_filepath: str, binning: int) -> str:
+    '''Return the folder of the preview level with a given binning, inside an output folder.'''
+    return f"{output_filepath}preview_bin{binning}/"
+
+def bin_sums(sums: np.ndarray, factor: int, accumulator) -> np.ndarray:
+    '''Sum square blocks of pixels, padding the image with zeros to a whole number of blocks.
+    The blocks are summed by adding strided slices, which is much faster than a reshape or reduceat.'''
+    rows = -(-sums.shape[0] // factor) * factor
+    columns = -(-sums.shape[1] // factor) * factor
+    padded = np.zeros((rows, columns), dtype=accumulator)
+    padded[:sums.shape[0], :sums.shape[1]] = sums
+    padded = sum(padded[offset::factor] for offset in range(factor))
+    return sum(padded[:, offset::factor] for offset in range(factor))
+
+def bin_images(image_array: np.ndarray, binnings: List[int] = PREVIEW_BINNINGS) -> dict:
+    '''Bin an image into preview levels, each pixel of a level being the average intensity of
+    a square block of pixels. Edge blocks that do not fill a whole square are averaged over the
+    pixels they hold. Each level is binned from the sums of the previous level where the binning
+    is a multiple of it, so the full resolution image is only read once.
+
+    :param image_array: diffraction pattern intensity array.
+    :param binnings: binning factors, such as (2, 4, 8).
+
+    :return: dictionary of binning factor to float32 average intensity array.
+    '''
+    accumulator = np.float64 if image_array.dtype.kind == 'f' else np.int64
+    previews = {}
+    sums = None
+    previous = 1
+    for binning in sorted(binnings):
+        if sums is None or binning % previous:
+            # bin the full resolution image
+            sums, row_counts, column_counts = np.asarray(image_array), np.ones(image_array.shape[0], int), np.ones(image_array.shape[1], int)
+            factor = binning
+        else:
+            factor = binning // previous
+        sums = bin_sums(sums, factor, accumulator)
+        row_counts = np.add.reduceat(row_counts, np.arange(0, len(row_counts), factor))
+        column_counts = np.add.reduceat(column_counts, np.arange(0, len(column_counts), factor))
+        previews[binning] = (sums / np.outer(row_counts, column_counts)).astype('float32')
+        previous = binning
+    return previews
+
+def save_previews(output_filepath: str, name: str, preview_arrays: dict):
+    '''Save the preview levels of an image, each to its 'preview_bin{N}/' folder inside the
+    output folder with the same name as the full resolution image.
+
+    :param output_filepath: output path of the full resolution image.
+    :param name: file name of the full resolution image, such as '103828_summed1.tiff'.
+    :param preview_arrays: dictionary of binning factor to preview array, as returned by bin_images.
+    '''
+    for binning, preview_array in preview_arrays.items():
+        preview_folder = get_preview_folder(output_filepath, binning)
+        os.makedirs(preview_folder, exist_ok=True)
+        with timing.stage("save") as save_stage:
+            frame_reader.write_tiff(f"{preview_folder}{name}", preview_array)
+            save_stage.written(f"{preview_folder}{name}")
+
+class PreviewStackWriter:
+    '''Write the preview levels of each image written to a tiff stack, as the pages of
+    stacks with the same name in the 'preview_bin{N}/' folders next to it.'''
+    def __init__(self, stack_filepath: str, names: List[str], binnings: List[int], compression_workers: int = None):
+        '''
+        :param stack_filepath: path of the full resolution tiff stack.
+        :param names: file names of the original images, in the order they are written.
+        :param binnings: binning factors, such as (2, 4, 8).
+        :param compression_workers: number of threads used to compress each page, all cores if None.
+        '''
+        folder, name = os.path.split(stack_filepath)
+        folder = f"{folder}/" if folder else ""
+        self.binnings = binnings
+        self.writers = {}
+        for binning in binnings:
+            os.makedirs(get_preview_folder(folder, binning), exist_ok=True)
+            self.writers[binning] = stack.TiffStackWriter(f"{get_preview_folder(folder, binning)}{name}", names,
+                                                          compression_workers)
+
+    def write(self, image_array: np.ndarray):
+        '''Append the preview levels of the next image to the preview stacks.'''
+        with timing.stage("preview"):
+            preview_arrays = bin_images(image_array, self.binnings)
+        with timing.stage("save"):
+            for binning, preview_array in preview_arrays.items():
+                self.writers[binning].write(preview_array)
+
+    def close(self):
+        errors = []
+        for writer in self.writers.values():
+            try:
+                writer.close()
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            raise errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+
+def select_binning(full_shape: tuple, binnings: List[int], display_size: int = PREVIEW_DISPLAY_SIZE) -> int:
+    '''Return the coarsest binning whose longest side still fills a display, or 1 for the
+    full resolution image if none of the preview levels do.
+
+    :param full_shape: shape of the full resolution image.
+    :param binnings: binning factors of the available preview levels.
+    :param display_size: longest side of the display in pixels.
+    '''
+    longest = max(full_shape)
+    fitting = [binning for binning in binnings if -(-longest // binning) >= display_size]
+    return max(fitting, default=1)
+
+def plot_preview(image_array: np.ndarray, preview_arrays: dict, v_max: int, display_size: int = None):
+    '''Plot the smallest preview level of an image that fills a display, or the full resolution
+    image if there are none. The axes are kept in full resolution pixels.
+
+    :param image_array: full resolution diffraction pattern intensity array.
+    :param preview_arrays: dictionary of binning factor to preview array, as returned by bin_images.
+    :param v_max: intensity maxima for plotting the diffraction pattern image.
+    :param display_size: longest side of the display in pixels, that of the current figure by default.
+    '''
+    # imported when needed, as matplotlib is slow to import
+    import matplotlib.pyplot as plt
+
+    if display_size is None:
+        figure = plt.gcf()
+        display_size = int(max(figure.get_size_inches()) * figure.dpi)
+    binning = select_binning(image_array.shape, preview_arrays, display_size)
+    display_array = preview_arrays[binning] if binning > 1 else image_array
+    rows, columns = image_array.shape
+    plt.imshow(display_array, cmap='gray', vmin = 0, vmax = v_max, extent = (-0.5, columns - 0.5, rows - 0.5, -0.5))
+
+def get_preview_filepath(image_filepath: str, display_size: int = PREVIEW_DISPLAY_SIZE):
+    '''Return the path of the smallest preview level of a saved image or tiff stack that fills
+    a display, or of the full resolution file if it has no previews or the display is larger than them.
+
+    :param image_filepath: path of the full resolution tiff image or stack, such as '{output_filepath}103828_summed1.tiff'.
+    :param display_size: longest side of the display in pixels.
+
+    :return: path of the preview and its binning factor.
+    '''
+    folder, name = os.path.split(image_filepath)
+    folder = f"{folder}/" if folder else ""
+    binnings = []
+    with os.scandir(folder or ".") as entries:
+        for entry in entries:
+            suffix = entry.name[len("preview_bin"):]
+            if entry.name.startswith("preview_bin") and suffix.isdigit() and os.path.isfile(os.path.join(entry.path, name)):
+                binnings.append(int(suffix))
+
+    # only the header of the full resolution image is read
+    with tifffile.TiffFile(image_filepath) as tiff:
+        full_shape = tiff.pages[0].shape
+    binning = select_binning(full_shape, binnings, display_size)
+    if binning == 1:
+        return image_filepath, 1
+    return f"{get_preview_folder(folder, binning)}{name}", binning
+
+def load_preview(image_filepath: str, display_size: int = PREVIEW_DISPLAY_SIZE):
+    '''Load the smallest preview level of a saved image that fills a display, falling back
+    to the full resolution image if it has no previews or the display is larger than them.
+
+    :param image_filepath: path of the full resolution tiff image, such as '{output_filepath}103828_summed1.tiff'.
+    :param display_size: longest side of the display in pixels.
+
+    :return: average intensity array and its binning factor.
+    '''
+    preview_filepath, binning = get_preview_filepath(image_filepath, display_size)
+    return np.asarray(frame_reader.read_frame(preview_filepath)), binning
@@ -0,0 +1,108 @@
+import numpy as np
+import mmap
+import os
+import tifffile
+from tqdm import tqdm
+from typing import List
+
+import sxrd_tiff_manifest_functions as frame_manifest
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_stack_functions as stack
+import sxrd_tiff_timing_functions as timing
+
+def list_frames(input_filepath, pattern: str) -> list:
+    '''Return the sorted list of images in an experiment, from a folder of tiff images,
+    a tiff stack, or any object with an 'image_list' method (such as a TiffStack).
+
+    :param input_filepath: input path to the series of tiff images, or to a tiff stack.
+    :param pattern: glob pattern selecting the images in a folder, such as '0*.tiff'.
+
+    :return: list of image paths, or of references to the images in a stack.
+    '''
+    with timing.stage("list"):
+        if hasattr(input_filepath, "image_list"):
+            return input_filepath.image_list(pattern)
+        if stack.is_tiff_stack(input_filepath):
+            return stack.open_tiff_stack(input_filepath).image_list(pattern)
+        return frame_manifest.list_tiff_images(input_filepath, pattern)
+
+def read_frame(image_path) -> np.ndarray:
+    '''Read the intensity array of a single image, from an image path
+    or a reference to an image with a 'read' method (such as a StackFrame).
+
+    :param image_path: path of the tiff image, or a reference to the image.
+    '''
+    with timing.stage("read") as read_stage:
+        if hasattr(image_path, "read"):
+            image_array = image_path.read()
+        else:
+            image_array = read_tiff(image_path)
+        read_stage.read(image_array)
+    return image_array
+
+def load_frame(image_path) -> np.ndarray:
+    '''Read the intensity array of a single image, without timing it, for reading frames ahead
+    on a background thread. A byte of each page of a memory-mapped image is touched, so its
+    pixels are read from disk by the calling thread rather than when they are first used,
+    and are then used from the page cache without copying.
+
+    :param image_path: path of the tiff image, or a reference to the image.
+    '''
+    image_array = image_path.read() if hasattr(image_path, "read") else read_tiff(image_path)
+    if isinstance(image_array, np.memmap):
+        np.frombuffer(image_array, dtype=np.uint8)[::mmap.PAGESIZE].sum()
+    return image_array
+
+def read_tiff(image_path) -> np.ndarray:
+    '''Read the intensity array of a single tiff image. The pixel data of an uncompressed
+    single page image is memory-mapped and returned as a read-only view, without copying,
+    so reductions read directly from the page cache. Compressed images are decoded
+    with tifffile, and other images fall back to scikit-image.
+
+    :param image_path: path of the tiff image.
+    '''
+    try:
+        with tifffile.TiffFile(image_path) as tiff:
+            if len(tiff.pages) == 1:
+                page = tiff.pages[0]
+                if page.is_memmappable:
+                    dtype = np.dtype(page.dtype).newbyteorder(tiff.byteorder)
+                    return np.memmap(image_path, dtype=dtype, mode='r', offset=page.dataoffsets[0], shape=page.shape)
+                return page.asarray()
+    except tifffile.TiffFileError:
+        pass
+    # only imported for images tifffile cannot read, as scikit-image is slow to import
+    from skimage import io
+    return io.imread(image_path)
+
+def write_tiff(image_path, image_array: np.ndarray):
+    '''Save an intensity array as a single tiff image. For greyscale detector images this
+    writes the same file as skimage.io.imsave, without the cost of importing scikit-image.
+
+    :param image_path: path of the tiff image to write.
+    :param image_array: intensity array to save.
+    '''
+    tifffile.imwrite(image_path, image_array)
+
+def get_frame_statistics(input_filepath, pattern: str, statistics: List[str] = ("max", "mean")) -> dict:
+    '''Return per-frame statistics for the images in an experiment. The statistics of
+    a folder of tiff images are cached in its frame manifest, so only new or changed
+    images are read, while the images of a stack are always read.
+
+    :param input_filepath: input path to the series of tiff images, or to a tiff stack.
+    :param pattern: glob pattern selecting the images in a folder, such as '0*.tif*'.
+    :param statistics: statistics to return, from 'max' and 'mean'.
+
+    :return: dictionary of statistic name to a list of values, in the order of the images.
+    '''
+    if isinstance(input_filepath, (str, os.PathLike)) and os.path.isdir(input_filepath):
+        manifest = frame_manifest.get_manifest(input_filepath)
+        return manifest.frame_statistics(manifest.image_list(pattern), statistics)
+
+    values = {statistic: [] for statistic in statistics}
+    image_list = list_frames(input_filepath, pattern)
+    for image_path, image_array in tqdm(prefetch.prefetch_frames(image_list), total=len(image_list)):
+        with timing.stage("statistics"):
+            for statistic in statistics:
+                values[statistic].append(frame_manifest.FRAME_STATISTICS[statistic](image_array))
+    return values
@@ -0,0 +1,173 @@
+import numpy as np
+from typing import Iterable
+
+STATISTICS = ("sum", "max", "min", "variance")
+
+class ImageReducer:
+    '''Streaming reduction of a series of diffraction pattern images.
+    Images are added one at a time and accumulated in place, so a single read of
+    the data gives the sum, mean, per-pixel maximum and minimum and the variance.
+
+    Integer images are summed in int64 and float images in float64, which avoids
+    the overflow of an int32 running sum over long series of high count images.
+    The variance uses Welford's algorithm, with Chan's formula for merging the
+    reducers of separate chunks of a series.
+    '''
+    def __init__(self, statistics: Iterable[str] = STATISTICS):
+        '''
+        :param statistics: statistics to track, from 'sum', 'max', 'min' and 'variance'.
+        The sum and count are always tracked, as they are needed for the mean.
+        '''
+        statistics = set(statistics)
+        unknown = statistics.difference(STATISTICS)
+        if unknown:
+            raise ValueError(f"Unknown statistics {sorted(unknown)}, choose from {STATISTICS}.")
+        self.statistics = statistics
+        self.count = 0
+        self.sum = None
+        self.max = None
+        self.min = None
+        self._mean = None
+        self._m2 = None
+        self._delta = None
+        self._scratch = None
+
+    def _allocate(self, image: np.ndarray):
+        '''Create the accumulators, using a wide dtype for the running sum.'''
+        sum_dtype = 'float64' if np.issubdtype(image.dtype, np.floating) else 'int64'
+        self.sum = np.zeros(shape=np.shape(image), dtype=sum_dtype)
+        if "max" in self.statistics:
+            self.max = np.array(image, copy=True)
+        if "min" in self.statistics:
+            self.min = np.array(image, copy=True)
+        if "variance" in self.statistics:
+            self._mean = np.zeros(shape=np.shape(image), dtype='float64')
+            self._m2 = np.zeros(shape=np.shape(image), dtype='float64')
+
+    def _allocate_scratch(self):
+        '''Create the scratch arrays of the variance updates, which are not kept when the reducer is pickled.'''
+        if self._delta is None:
+            self._delta = np.empty(shape=self._m2.shape, dtype='float64')
+            self._scratch = np.empty(shape=self._m2.shape, dtype='float64')
+
+    def __getstate__(self) -> dict:
+        # the scratch arrays are as large as the accumulators, so they are not sent between processes
+        state = self.__dict__.copy()
+        state["_delta"] = None
+        state["_scratch"] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+
+    def update(self, image: np.ndarray):
+        '''Add a single image to the accumulators, without allocating new arrays.
+
+        :param image: diffraction pattern intensity array.
+        '''
+        image = np.asarray(image)
+        if self.sum is None:
+            self._allocate(image)
+        elif np.shape(image) != self.sum.shape:
+            raise ValueError(f"Image shape {np.shape(image)} does not match the series shape {self.sum.shape}.")
+
+        self.count += 1
+        np.add(self.sum, image, out=self.sum, casting='unsafe')
+        if self.max is not None:
+            np.maximum(self.max, image, out=self.max, casting='unsafe')
+        if self.min is not None:
+            np.minimum(self.min, image, out=self.min, casting='unsafe')
+        if self._m2 is not None:
+            self._allocate_scratch()
+            # welford update: mean += delta / n, m2 += delta * (x - new mean)
+            np.subtract(image, self._mean, out=self._delta)
+            np.divide(self._delta, self.count, out=self._scratch)
+            np.add(self._mean, self._scratch, out=self._mean)
+            np.subtract(image, self._mean, out=self._scratch)
+            np.multiply(self._scratch, self._delta, out=self._scratch)
+            np.add(self._m2, self._scratch, out=self._m2)
+
+    def merge(self, other: "ImageReducer"):
+        '''Merge the accumulators of another reducer into this one, in place.
+        The sum, maximum and minimum are exact, so merging the reducers of separate
+        chunks gives the same result as reducing the whole series in one go.
+
+        :param other: reducer of another part of the same series.
+        '''
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return
+        if self.sum.shape != other.sum.shape:
+            raise ValueError(f"Cannot merge series of shape {other.sum.shape} into {self.sum.shape}.")
+
+        count = self.count + other.count
+        np.add(self.sum, other.sum, out=self.sum, casting='unsafe')
+        if self.max is not None and other.max is not None:
+            np.maximum(self.max, other.max, out=self.max)
+        else:
+            self.max = None
+        if self.min is not None and other.min is not None:
+            np.minimum(self.min, other.min, out=self.min)
+        else:
+            self.min = None
+        if self._m2 is not None and other._m2 is not None:
+            self._allocate_scratch()
+            # chan's parallel formula for combining two partial variances
+            np.subtract(other._mean, self._mean, out=self._delta)
+            np.multiply(self._delta, other.count / count, out=self._scratch)
+            np.add(self._mean, self._scratch, out=self._mean)
+            np.multiply(self._delta, self._delta, out=self._delta)
+            np.multiply(self._delta, self.count * other.count / count, out=self._delta)
+            np.add(self._m2, other._m2, out=self._m2)
+            np.add(self._m2, self._delta, out=self._m2)
+        else:
+            self._m2 = None
+        self.count = count
+
+    def mean(self) -> np.ndarray:
+        '''Return the mean intensity of the series, as a float64 array.'''
+        self._check_count()
+        return self.sum / self.count
+
+    def variance(self, ddof: int = 0) -> np.ndarray:
+        '''Return the per-pixel variance of the series, as a float64 array.
+
+        :param ddof: delta degrees of freedom, 0 for the population variance.
+        '''
+        self._check_count()
+        if self._m2 is None:
+            raise ValueError("The variance was not tracked by this reducer.")
+        return self._m2 / (self.count - ddof)
+
+    def result(self, statistic: str) -> np.ndarray:
+        '''Return a named statistic of the series.
+
+        :param statistic: one of 'mean', 'sum', 'max', 'min' or 'variance'.
+        '''
+        self._check_count()
+        if statistic == "mean":
+            return self.mean()
+        if statistic == "variance":
+            return self.variance()
+        if statistic in ("sum", "max", "min") and getattr(self, statistic) is not None:
+            return getattr(self, statistic)
+        raise ValueError(f"The statistic '{statistic}' was not tracked by this reducer.")
+
+    def _check_count(self):
+        if self.count == 0:
+            raise ValueError("No images have been added to the reducer.")
+
+def reduce_images(images: Iterable[np.ndarray], statistics: Iterable[str] = STATISTICS) -> ImageReducer:
+    '''Reduce an iterable of images in a single pass.
+
+    :param images: iterable of diffraction pattern intensity arrays.
+    :param statistics: statistics to track, from 'sum', 'max', 'min' and 'variance'.
+
+    :return: reducer holding the accumulated statistics.
+    '''
+    reducer = ImageReducer(statistics)
+    for image in images:
+        reducer.update(image)
+    return reducer
@@ -0,0 +1,144 @@
+import numpy as np
+from tqdm import tqdm
+from typing import List
+
+import sxrd_tiff_summer_functions as analysis
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_timing_functions as timing
+from sxrd_tiff_manifest_functions import FRAME_STATISTICS
+
+REGION_TYPES = ("rectangle", "ring", "mask")
+
+def extract_region_input(config_path: str):
+    """Extract the optional detector regions from yaml configuration file.
+    If the configuration has no 'regions' block, None is returned and the
+    intensity maps are made from the whole detector.
+
+    :param config_path: path to the configuration file.
+
+    :return: list of region dictionaries, or None.
+    """
+    config = analysis.get_config(config_path)
+    regions = config.get("regions")
+    if regions:
+        print("The detector regions for the intensity maps are :", *[region["name"] for region in regions], sep = '\n', end = '\n\n')
+    return regions or None
+
+def make_region_mask(shape: tuple, region: dict) -> np.ndarray:
+    '''Return a boolean mask of the detector pixels in a single region.
+
+    :param shape: shape of the diffraction pattern images in rows and columns.
+    :param region: dictionary with a 'name' and a 'type' of
+        'rectangle', with 'x' and 'y' ranges of columns and rows [start, end),
+        'ring', with a beam 'centre' [x, y] and a 'radius' range [inner, outer) in pixels, or
+        'mask', with the 'path' of a tiff image whose non-zero pixels are in the region.
+    '''
+    region_type = region.get("type")
+    if region_type == "rectangle":
+        mask = np.zeros(shape, dtype=bool)
+        mask[region["y"][0]:region["y"][1], region["x"][0]:region["x"][1]] = True
+        return mask
+    if region_type == "ring":
+        rows, columns = np.ogrid[:shape[0], :shape[1]]
+        radius = np.hypot(columns - region["centre"][0], rows - region["centre"][1])
+        return (radius >= region["radius"][0]) & (radius < region["radius"][1])
+    if region_type == "mask":
+        mask = np.asarray(frame_reader.read_frame(region["path"])) != 0
+        if mask.shape != tuple(shape):
+            raise ValueError(f"The mask for region '{region['name']}' has shape {mask.shape}, not {tuple(shape)}.")
+        return mask
+    raise ValueError(f"Unknown region type '{region_type}' for region '{region.get('name')}', choose from {REGION_TYPES}.")
+
+def make_label_image(shape: tuple, regions: List[dict]) -> np.ndarray:
+    '''Combine a list of detector regions into a single label image, where each pixel
+    holds the number of its region from 1, or 0 if it is in no region. Where regions
+    overlap, the pixels belong to the later region in the list.
+
+    :param shape: shape of the diffraction pattern images in rows and columns.
+    :param regions: list of region dictionaries, as described in make_region_mask.
+
+    :return: int32 label image.
+    '''
+    label_image = np.zeros(shape, dtype='int32')
+    for label, region in enumerate(regions, start=1):
+        label_image[make_region_mask(shape, region)] = label
+    return label_image
+
+class RegionStatistics:
+    '''Per-region sum, mean and maximum intensity of diffraction pattern images, for a label image.
+    The pixel order grouping each region is computed once, so the statistics of every region
+    of a frame come from a single gather of the labelled pixels and one reduction per statistic,
+    whatever the number of regions.
+    '''
+    def __init__(self, label_image: np.ndarray, names: List[str]):
+        '''
+        :param label_image: image holding the number of the region of each pixel from 1, or 0 for none.
+        :param names: name of each region, in label order.
+        '''
+        self.names = list(names)
+        self.shape = label_image.shape
+        labels = label_image.ravel()
+        counts = np.bincount(labels, minlength=len(self.names) + 1)[1:]
+        # pixels of each region, grouped by label and in increasing order within each region
+        order = np.argsort(labels, kind='stable')
+        self.order = order[np.count_nonzero(labels == 0):]
+        self.counts = counts
+        # a region with no pixels has no statistics, so it is left out of the reductions
+        self.present = counts > 0
+        self.starts = np.concatenate(([0], np.cumsum(counts[self.present])[:-1]))
+
+    def __call__(self, image_array: np.ndarray) -> dict:
+        '''Return the statistics of every region of a single image.
+
+        :param image_array: diffraction pattern intensity array.
+
+        :return: dictionary of 'sum', 'mean' and 'max' to an array of values, one per region,
+        with NaN for regions with no pixels.
+        '''
+        if image_array.shape != self.shape:
+            raise ValueError(f"Image of shape {image_array.shape} does not match the regions of shape {self.shape}.")
+        values = np.asarray(image_array).ravel()[self.order]
+        accumulator = np.float64 if values.dtype.kind == 'f' else np.int64
+        statistics = {statistic: np.full(len(self.names), np.nan) for statistic in ("sum", "mean", "max")}
+        if len(values):
+            sums = np.add.reduceat(values, self.starts, dtype=accumulator)
+            statistics["sum"][self.present] = sums
+            statistics["mean"][self.present] = sums / self.counts[self.present]
+            statistics["max"][self.present] = np.maximum.reduceat(values, self.starts)
+        return statistics
+
+def get_region_statistics(shape: tuple, regions: List[dict]) -> RegionStatistics:
+    '''Precompute the label image of a list of detector regions for images of a given shape.'''
+    return RegionStatistics(make_label_image(shape, regions), [region["name"] for region in regions])
+
+def get_region_intensity_lists(input_filepath, pattern: str, regions: List[dict]):
+    '''Read each diffraction pattern image once and return the maximum and average intensity
+    of the whole detector and of each detector region.
+
+    :param input_filepath: input path to the series of tiff images, or to a tiff stack.
+    :param pattern: glob pattern selecting the images in a folder, such as '0*.tif*'.
+    :param regions: list of region dictionaries, as described in make_region_mask.
+
+    :return: lists of the whole detector maximum and average intensity of each image,
+    and arrays of the maximum and average intensity of each region, with one row per image.
+    '''
+    max_list = []
+    avg_list = []
+    region_max = []
+    region_avg = []
+    region_statistics = None
+
+    image_list = frame_reader.list_frames(input_filepath, pattern)
+    for image_path, image_array in tqdm(prefetch.prefetch_frames(image_list), total=len(image_list)):
+        if region_statistics is None:
+            region_statistics = get_region_statistics(image_array.shape, regions)
+        with timing.stage("statistics"):
+            max_list.append(FRAME_STATISTICS["max"](image_array))
+            avg_list.append(FRAME_STATISTICS["mean"](image_array))
+            statistics = region_statistics(image_array)
+        region_max.append(statistics["max"])
+        region_avg.append(statistics["mean"])
+
+    shape = (len(region_max), len(regions))
+    return max_list, avg_list, np.reshape(region_max, shape), np.reshape(region_avg, shape)
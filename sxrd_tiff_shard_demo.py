@@ -0,0 +1,89 @@
+'''Check the sharded mode on one machine, by running several worker processes on a job folder
+in a temporary directory, as the processes of a batch job on several nodes would.
+
+    python sxrd_tiff_shard_demo.py --experiments 8 --workers 4
+
+Each experiment is a short synthetic series of images, summed with avg_tiff_images. The first
+worker crashes part way through its first experiment, so that experiment is only completed once
+its claim has not been refreshed for the lease timeout and another worker retries it. The summed
+image of every experiment is then compared with the average of the images written.
+'''
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+import tifffile
+
+import sxrd_tiff_synthetic_functions as synthetic
+import sxrd_tiff_shard_functions as shard
+
+def run_worker(worker_index: int, job_filepath: str, data_filepath: str, experiment_numbers: list,
+               lease_timeout: float, heartbeat_interval: float):
+    '''Run a single worker process, the first of which crashes during its first experiment.'''
+    os.environ["TQDM_DISABLE"] = "1"
+    import sxrd_tiff_summer_functions as analysis
+
+    def run_experiment(experiment_number: str):
+        if worker_index == 0:
+            # stop the process without releasing the claim, as a crashed node would
+            os._exit(1)
+        analysis.avg_tiff_images(experiment_number, f"{data_filepath}{experiment_number}/", f"{data_filepath}output/{experiment_number}/",
+                                 500, plot = False)
+
+    shard.run_shard_worker(job_filepath, experiment_numbers, run_experiment, lease_timeout, heartbeat_interval,
+                           poll_interval = heartbeat_interval, worker_name = f"worker-{worker_index}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--experiments", type=int, default=8, help="number of experiments in the job")
+    parser.add_argument("--frames", type=int, default=6, help="number of images in each experiment")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--lease-timeout", type=float, default=2.0, help="seconds before a crashed worker's claim is retried")
+    arguments = parser.parse_args()
+
+    experiment_numbers = list(range(100001, 100001 + arguments.experiments))
+    shape = (128, 128)
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        data_filepath = os.path.join(temporary_directory, "data") + "/"
+        job_filepath = os.path.join(temporary_directory, "job")
+        for seed, experiment_number in enumerate(experiment_numbers):
+            synthetic.write_synthetic_series(f"{data_filepath}{experiment_number}/", arguments.frames, shape, ".tiff", seed=seed)
+
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=run_worker, args=(worker_index, job_filepath, data_filepath, experiment_numbers,
+                                                              arguments.lease_timeout, arguments.lease_timeout / 4))
+                     for worker_index in range(arguments.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        status = shard.ShardJob(job_filepath, experiment_numbers, arguments.lease_timeout).status()
+        matches = 0
+        for seed, experiment_number in enumerate(experiment_numbers):
+            image_paths = sorted(glob.glob(f"{data_filepath}{experiment_number}/*.tiff"))
+            expected = np.mean([tifffile.imread(image_path) for image_path in image_paths], axis=0).astype('int32')
+            summed_filepath = f"{data_filepath}output/{experiment_number}/{experiment_number}_summed1.tiff"
+            if os.path.isfile(summed_filepath) and np.array_equal(tifffile.imread(summed_filepath), expected):
+                matches += 1
+        retried = []
+        for done_filepath in glob.glob(os.path.join(job_filepath, "*.done")):
+            with open(done_filepath) as done_file:
+                done = json.load(done_file)
+            if done["attempt"] > 1:
+                retried.append(os.path.basename(done_filepath).split(".")[0])
+
+        print(f"Experiments done: {len(status['done'])} of {len(experiment_numbers)}, retried after a crash: {retried}")
+        print(f"Summed images matching the series: {matches} of {len(experiment_numbers)}")
+        if len(status["done"]) == len(experiment_numbers) and matches == len(experiment_numbers) and retried:
+            print("PASS: every experiment was completed once, including the one abandoned by the crashed worker.")
+        else:
+            print("FAIL: the sharded job did not complete every experiment.")
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from typing import Callable, List
+
+# default time in seconds after which a claim that has not been refreshed is treated as abandoned
+LEASE_TIMEOUT = 600.0
+# default time in seconds between refreshes of a claim, while its experiment is being processed
+HEARTBEAT_INTERVAL = 30.0
+# default number of times an experiment is attempted before it is left as failed
+MAX_ATTEMPTS = 3
+JOB_NAME = "job.json"
+
+def get_worker_name() -> str:
+    '''Return a name for this worker process, unique across the nodes sharing a job folder.'''
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def write_exclusive(path: str, contents: dict) -> bool:
+    '''Atomically create a file holding a JSON dictionary, if it does not already exist.
+
+    :return: True if this call created the file.
+    '''
+    try:
+        file_descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(file_descriptor, 'w') as output_file:
+        json.dump(contents, output_file)
+    return True
+
+class Heartbeat:
+    '''Refresh the modification time of a claim file at a fixed interval on a background
+    thread, so other workers can tell the claim apart from one abandoned by a crashed worker.'''
+    def __init__(self, claim_path: str, interval: float):
+        self.claim_path = claim_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.claim_path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+class ShardJob:
+    '''A folder on a shared filesystem through which any number of worker processes, on any
+    number of nodes, share the experiments of a job without a scheduler service.
+
+    Each attempt at an experiment is claimed by atomically creating '{experiment}.{attempt}.claim'.
+    The claim is refreshed while the experiment is processed, and '{experiment}.done' is written
+    when it completes, or '{experiment}.{attempt}.failed' if it raises an error. An attempt whose
+    claim has not been refreshed within the lease timeout, or which failed, is retried by claiming
+    the next attempt, up to the maximum number of attempts. As only one worker can create each
+    claim file, every attempt is run by a single worker.
+    '''
+    def __init__(self, job_filepath: str, experiment_numbers: List[int], lease_timeout: float = LEASE_TIMEOUT,
+                 max_attempts: int = MAX_ATTEMPTS):
+        '''
+        :param job_filepath: path to the job folder, on a filesystem shared by all of the workers.
+        :param experiment_numbers: experiment numbers making up the job.
+        :param lease_timeout: time in seconds after which an unrefreshed claim is treated as abandoned.
+        :param max_attempts: number of times an experiment is attempted before it is left as failed.
+        '''
+        self.folder = job_filepath
+        self.experiment_numbers = [str(experiment_number) for experiment_number in experiment_numbers]
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        os.makedirs(self.folder, exist_ok=True)
+        self._check_job()
+
+    def _check_job(self):
+        '''Record the experiment numbers of the job, or check they match those already recorded,
+        so that workers started with a different configuration cannot share the folder.'''
+        job_path = os.path.join(self.folder, JOB_NAME)
+        if write_exclusive(job_path, {"experiment_numbers": self.experiment_numbers}):
+            return
+        for _ in range(10):
+            try:
+                with open(job_path) as job_file:
+                    recorded = json.load(job_file)["experiment_numbers"]
+                break
+            except (json.JSONDecodeError, KeyError):
+                # the first worker is still writing the file
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f"Could not read the job file '{job_path}'.")
+        if recorded != self.experiment_numbers:
+            raise ValueError(f"The job folder '{self.folder}' belongs to a job with different experiment numbers.")
+
+    def _path(self, experiment_number: str, attempt: int = None, suffix: str = "claim") -> str:
+        name = f"{experiment_number}.{suffix}" if attempt is None else f"{experiment_number}.{attempt}.{suffix}"
+        return os.path.join(self.folder, name)
+
+    def scan(self) -> dict:
+        '''List the job folder once and return the state of each experiment.
+
+        :return: dictionary of experiment number to a dictionary of 'done', the latest 'attempt'
+        number, whether that attempt has 'failed', and the modification time of its claim.
+        '''
+        states = {experiment_number: {"done": False, "attempt": 0, "failed": False, "claim_mtime": None}
+                  for experiment_number in self.experiment_numbers}
+        failed = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                parts = entry.name.split(".")
+                state = states.get(parts[0])
+                if state is None:
+                    continue
+                if parts[1:] == ["done"]:
+                    state["done"] = True
+                elif len(parts) == 3 and parts[1].isdigit() and parts[2] in ("claim", "failed"):
+                    attempt = int(parts[1])
+                    if parts[2] == "failed":
+                        failed.add((parts[0], attempt))
+                    elif attempt > state["attempt"]:
+                        try:
+                            state["claim_mtime"] = entry.stat().st_mtime
+                        except FileNotFoundError:
+                            continue
+                        state["attempt"] = attempt
+        for experiment_number, state in states.items():
+            state["failed"] = (experiment_number, state["attempt"]) in failed
+        return states
+
+    def status(self) -> dict:
+        '''Return the experiment numbers that are done, running, failed (after the final attempt)
+        and pending.'''
+        status = {"done": [], "running": [], "failed": [], "pending": []}
+        now = time.time()
+        for experiment_number, state in self.scan().items():
+            if state["done"]:
+                status["done"].append(experiment_number)
+            elif state["attempt"] == 0:
+                status["pending"].append(experiment_number)
+            elif state["failed"] or now - state["claim_mtime"] > self.lease_timeout:
+                key = "failed" if state["attempt"] >= self.max_attempts else "pending"
+                status[key].append(experiment_number)
+            else:
+                status["running"].append(experiment_number)
+        return status
+
+    def claim(self, experiment_number: str, state: dict, worker_name: str):
+        '''Try to claim the next attempt at an experiment, if it is not done and not claimed
+        by a live worker.
+
+        :return: the attempt number claimed, or None.
+        '''
+        attempt = state["attempt"]
+        if state["done"]:
+            return None
+        if attempt > 0:
+            abandoned = time.time() - state["claim_mtime"] > self.lease_timeout
+            if not (state["failed"] or abandoned) or attempt >= self.max_attempts:
+                return None
+        contents = {"worker": worker_name, "claimed_at": time.time()}
+        if write_exclusive(self._path(experiment_number, attempt + 1), contents):
+            return attempt + 1
+        return None
+
+    def mark_done(self, experiment_number: str, attempt: int, worker_name: str, seconds: float):
+        '''Record that an experiment has completed.'''
+        contents = {"worker": worker_name, "attempt": attempt, "seconds": seconds, "completed_at": time.time()}
+        temporary_path = f"{self._path(experiment_number, attempt, 'done')}.tmp"
+        with open(temporary_path, 'w') as done_file:
+            json.dump(contents, done_file)
+        os.replace(temporary_path, self._path(experiment_number, suffix="done"))
+
+    def mark_failed(self, experiment_number: str, attempt: int, worker_name: str, error: Exception):
+        '''Record that an attempt at an experiment raised an error.'''
+        contents = {"worker": worker_name, "error": repr(error),
+                    "traceback": traceback.format_exception(type(error), error, error.__traceback__)}
+        write_exclusive(self._path(experiment_number, attempt, "failed"), contents)
+
+def run_shard_worker(job_filepath: str, experiment_numbers: List[int], experiment_function: Callable[[str], None],
+                     lease_timeout: float = LEASE_TIMEOUT, heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                     max_attempts: int = MAX_ATTEMPTS, poll_interval: float = None, worker_name: str = None) -> dict:
+    '''Process the experiments of a job shared with other workers through a job folder.
+    Start the same call on as many processes and nodes as needed: each claims experiments
+    that are not done or claimed by another worker, in order, and carries on until every
+    experiment is done or has failed its final attempt, retrying those abandoned by crashed workers.
+
+    :param job_filepath: path to the job folder, on a filesystem shared by all of the workers.
+    :param experiment_numbers: experiment numbers making up the job.
+    :param experiment_function: function processing a single experiment, called with the experiment number as a string.
+    :param lease_timeout: time in seconds after which an unrefreshed claim is treated as abandoned.
+    :param heartbeat_interval: time in seconds between refreshes of the claim being processed.
+    :param max_attempts: number of times an experiment is attempted before it is left as failed.
+    :param poll_interval: time in seconds between checks for abandoned claims once every experiment is claimed, heartbeat_interval by default.
+    :param worker_name: name recorded in the claims, the host name and process id by default.
+
+    :return: dictionary of the experiment numbers this worker completed ('done'), and those of the
+    job whose final attempt failed ('failed'), whichever worker made it.
+    '''
+    if heartbeat_interval >= lease_timeout:
+        raise ValueError("The heartbeat interval must be shorter than the lease timeout.")
+    job = ShardJob(job_filepath, experiment_numbers, lease_timeout, max_attempts)
+    worker_name = worker_name or get_worker_name()
+    poll_interval = heartbeat_interval if poll_interval is None else poll_interval
+    processed = {"done": [], "failed": []}
+
+    while True:
+        states = job.scan()
+        claimed = None
+        for experiment_number, state in states.items():
+            attempt = job.claim(experiment_number, state, worker_name)
+            if attempt is not None:
+                claimed = experiment_number
+                break
+
+        if claimed is None:
+            status = job.status()
+            if not status["running"] and not status["pending"]:
+                break
+            # wait for the running experiments to complete, or for their claims to become abandoned
+            time.sleep(poll_interval)
+            continue
+
+        print(f"Worker {worker_name} claimed experiment {claimed} (attempt {attempt} of {max_attempts}).")
+        start = time.monotonic()
+        try:
+            with Heartbeat(job._path(claimed, attempt), heartbeat_interval):
+                experiment_function(claimed)
+        except Exception as error:
+            job.mark_failed(claimed, attempt, worker_name, error)
+            print(f"Experiment {claimed} failed: {error!r}")
+            continue
+        job.mark_done(claimed, attempt, worker_name, time.monotonic() - start)
+        processed["done"].append(claimed)
+        print(f"Experiment {claimed} complete.")
+
+    status = job.status()
+    print(f"Job '{job_filepath}': {len(status['done'])} experiment(s) done, {len(status['failed'])} failed.")
+    # an experiment that failed an attempt but was completed by a later one has not failed
+    processed["failed"] = status["failed"]
+    return processed
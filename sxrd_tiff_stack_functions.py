@@ -0,0 +1,278 @@
+import numpy as np
+import pathlib
+import os
+import json
+import queue
+import tifffile
+import threading
+from dataclasses import dataclass
+from typing import List
+
+import sxrd_tiff_manifest_functions as frame_manifest
+
+# tile shape and compression of each page in a stack, so that tiles are compressed in parallel
+STACK_TILE = (256, 256)
+STACK_COMPRESSION = "zlib"
+STACK_COMPRESSION_LEVEL = 6
+# number of stacks kept open for random access in each process
+OPEN_STACK_LIMIT = 8
+# number of images waiting to be compressed by a stack writer
+STACK_QUEUE_FRAMES = 2
+
+_open_stacks = {}
+_open_stacks_pid = None
+
+@dataclass(frozen=True)
+class StackFrame:
+    '''Reference to a single diffraction pattern image stored as a page of a tiff stack.
+    Used in place of an image path, so a stack can be read wherever a folder of images is.'''
+    stack_filepath: str
+    index: int
+    name: str
+
+    @property
+    def stem(self) -> str:
+        '''File name of the original image, without the suffix.'''
+        return pathlib.Path(self.name).stem
+
+    def read(self) -> np.ndarray:
+        '''Read the intensity array of the image from the stack.'''
+        return open_tiff_stack(self.stack_filepath).read_index(self.index)
+
+    def read_rows(self, row_start: int, row_end: int) -> np.ndarray:
+        '''Read the intensity array of a range of rows of the image from the stack.'''
+        return open_tiff_stack(self.stack_filepath).read_rows(self.index, row_start, row_end)
+
+    def __str__(self) -> str:
+        return f"{self.stack_filepath}[{self.name}]"
+
+class TiffStackWriter:
+    '''Write a series of diffraction pattern images as a single tiled and compressed (BigTIFF)
+    tiff stack, of shape (number of images, rows, columns), which other tiff readers such as
+    scikit-image and tifffile read in full. The names and frame numbers of the original images
+    are stored once, in the metadata of the series, so they must be known before it is written.
+    The images are compressed and written by a background thread as they are added.
+
+        with TiffStackWriter(stack_filepath, [image_path.name for image_path in image_list]) as writer:
+            for image_path, image_array in prefetch_frames(image_list):
+                writer.write(image_array)
+    '''
+    def __init__(self, stack_filepath: str, names: List[str], compression_workers: int = None,
+                 compression_level: int = STACK_COMPRESSION_LEVEL):
+        '''
+        :param stack_filepath: path of the tiff stack to write.
+        :param names: file names of the original images, such as '00012.tif', in the order they are written.
+        :param compression_workers: number of threads used to compress the tiles of each page, all cores if None.
+        :param compression_level: zlib compression level, from 1 (fastest) to 9 (smallest).
+        '''
+        self.stack_filepath = stack_filepath
+        self.names = [str(name) for name in names]
+        self.compression_workers = compression_workers or os.cpu_count()
+        self.compression_level = compression_level
+        self.number_of_images = 0
+        self._writer = tifffile.TiffWriter(stack_filepath, bigtiff=True)
+        self._images = queue.Queue(maxsize=STACK_QUEUE_FRAMES)
+        self._thread = None
+        self._error = None
+
+    def write(self, image_array: np.ndarray):
+        '''Append the next image to the stack, in the order of the names.
+
+        :param image_array: diffraction pattern intensity array, of the same shape and type as the first image.
+        '''
+        if self.number_of_images >= len(self.names):
+            raise ValueError(f"All {len(self.names)} images have already been written to '{self.stack_filepath}'.")
+        if self._thread is None:
+            shape = (len(self.names),) + image_array.shape
+            self._thread = threading.Thread(target=self._write_series, args=(shape, image_array.dtype),
+                                            name="sxrd-stack-writer", daemon=True)
+            self._thread.start()
+        # wait for room in the queue, unless the background thread has stopped with an error
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                self._images.put(image_array, timeout=1.0)
+                break
+            except queue.Full:
+                continue
+        self.number_of_images += 1
+
+    def _write_series(self, shape: tuple, dtype):
+        '''Compress and write every image of the series, from the tiles of the queued images.'''
+        metadata = {'names': self.names, 'frame_numbers': [frame_manifest.get_frame_number(name) for name in self.names]}
+        try:
+            self._writer.write(self._iter_tiles(shape[0]), shape=shape, dtype=dtype, photometric='minisblack',
+                               tile=STACK_TILE, compression=STACK_COMPRESSION,
+                               compressionargs={'level': self.compression_level},
+                               maxworkers=self.compression_workers, metadata=metadata)
+        except BaseException as error:
+            self._error = error
+
+    def _iter_tiles(self, number_of_images: int):
+        '''Yield the tiles of each queued image in turn, in row order, stopping early if the stack is closed.'''
+        for _ in range(number_of_images):
+            image_array = self._images.get()
+            if image_array is None:
+                return
+            for row in range(0, image_array.shape[0], STACK_TILE[0]):
+                for column in range(0, image_array.shape[1], STACK_TILE[1]):
+                    yield image_array[row:row + STACK_TILE[0], column:column + STACK_TILE[1]]
+
+    def close(self):
+        '''Wait for every image to be written and close the stack. Raises an error if fewer
+        images were written than there are names.'''
+        try:
+            if self._thread is not None:
+                # stop the series early, unless the background thread has already stopped with an error
+                while self.number_of_images < len(self.names) and self._thread.is_alive():
+                    try:
+                        self._images.put(None, timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+                self._thread.join()
+        finally:
+            self._writer.close()
+        if self.number_of_images != len(self.names):
+            raise ValueError(f"Only {self.number_of_images} of {len(self.names)} images were written to '{self.stack_filepath}'.")
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # an error writing the stack is only raised if it was not caused by an earlier one
+            if exc_type is None:
+                raise
+
+class TiffStack:
+    '''Random access reader for a tiff stack written by TiffStackWriter.
+    Iterating over the stack yields the intensity arrays in the order they were written,
+    and indexing the stack by frame number returns a single intensity array.
+    '''
+    def __init__(self, stack_filepath: str):
+        '''
+        :param stack_filepath: path of the tiff stack.
+        '''
+        self.stack_filepath = str(stack_filepath)
+        self._tiff = tifffile.TiffFile(self.stack_filepath)
+        self._lock = threading.Lock()
+        metadata = self._tiff.shaped_metadata[0] if self._tiff.shaped_metadata else {}
+        number_of_images = len(self._tiff.pages)
+        if "names" in metadata:
+            self.names = list(metadata["names"])
+            self.frame_numbers = list(metadata["frame_numbers"])
+        else:
+            # stacks written with the name and frame number in the description of each page
+            self.names = []
+            self.frame_numbers = []
+            for page in self._tiff.pages:
+                description = json.loads(page.description) if page.description.startswith("{") else {}
+                self.names.append(description.get("name", f"{len(self.names):05}.tif"))
+                self.frame_numbers.append(description.get("frame_number"))
+        if len(self.names) != number_of_images:
+            raise ValueError(f"The stack '{self.stack_filepath}' has {number_of_images} pages but {len(self.names)} names.")
+        self._index = {frame_number: index for index, frame_number in enumerate(self.frame_numbers)
+                       if frame_number is not None}
+
+    def image_list(self, pattern: str = None) -> List[StackFrame]:
+        '''Return a reference to every image in the stack, in the order they were written.
+        The images were selected by pattern when the stack was written, so the pattern is ignored.'''
+        return [StackFrame(self.stack_filepath, index, name) for index, name in enumerate(self.names)]
+
+    def read_index(self, index: int) -> np.ndarray:
+        '''Read the intensity array of the image at a position in the stack.'''
+        # pages share a single file handle, so are read one at a time
+        with self._lock:
+            return self._tiff.pages[index].asarray()
+
+    def segment_rows(self, index: int) -> int:
+        '''Return the number of rows in each tile or strip of the page at a position in the stack,
+        1 for an uncompressed page, or None if the rows of the page cannot be read on their own.'''
+        page = self._tiff.pages[index]
+        if len(page.shape) != 2:
+            return None
+        if page.is_memmappable:
+            return 1
+        return page.tilelength if page.is_tiled else page.rowsperstrip
+
+    def read_rows(self, index: int, row_start: int, row_end: int) -> np.ndarray:
+        '''Read the intensity array of a range of rows of the image at a position in the stack,
+        reading and decoding only the tiles or strips that hold the rows.'''
+        with self._lock:
+            page = self._tiff.pages[index]
+            filehandle = self._tiff.filehandle
+            columns = page.shape[1]
+            if page.is_memmappable:
+                dtype = np.dtype(page.dtype).newbyteorder(self._tiff.byteorder)
+                filehandle.seek(page.dataoffsets[0] + row_start * columns * dtype.itemsize)
+                data = filehandle.read((row_end - row_start) * columns * dtype.itemsize)
+                return np.frombuffer(data, dtype=dtype).reshape(row_end - row_start, columns)
+            segment_length = page.tilelength if page.is_tiled else page.rowsperstrip
+            segments_across = -(-columns // page.tilewidth) if page.is_tiled else 1
+            segments = []
+            for segment_row in range(row_start // segment_length, -(-row_end // segment_length)):
+                for segment_index in range(segment_row * segments_across, (segment_row + 1) * segments_across):
+                    filehandle.seek(page.dataoffsets[segment_index])
+                    segments.append((segment_index, filehandle.read(page.databytecounts[segment_index])))
+
+        # the segments are decoded outside the lock, so other threads can read in the meantime
+        rows_array = np.empty((row_end - row_start, columns), dtype=page.dtype)
+        for segment_index, data in segments:
+            segment, (_, _, top, left, _), _ = page.decode(data, segment_index)
+            # edge segments are padded to the full tile size
+            segment = segment[0, :, :, 0]
+            first, last = max(row_start, top), min(row_end, top + segment.shape[0])
+            width = min(segment.shape[1], columns - left)
+            rows_array[first - row_start:last - row_start, left:left + width] = segment[first - top:last - top, :width]
+        return rows_array
+
+    def __getitem__(self, frame_number: int) -> np.ndarray:
+        '''Read the intensity array of the image with a given frame number.'''
+        if frame_number not in self._index:
+            raise KeyError(f"Frame number {frame_number} is not in the stack '{self.stack_filepath}'.")
+        return self.read_index(self._index[frame_number])
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.read_index(index)
+
+    def close(self):
+        self._tiff.close()
+
+def is_tiff_stack(input_filepath) -> bool:
+    '''Return True if the input path is a tiff stack file, rather than a folder of images.'''
+    return isinstance(input_filepath, (str, os.PathLike)) and os.path.isfile(input_filepath) \
+        and str(input_filepath).lower().endswith((".tif", ".tiff"))
+
+def open_tiff_stack(stack_filepath: str) -> TiffStack:
+    '''Return an open reader for a tiff stack, reusing a reader already opened by this process
+    unless the stack has been modified since.
+
+    :param stack_filepath: path of the tiff stack.
+    '''
+    global _open_stacks_pid
+    stack_filepath = str(stack_filepath)
+    # readers inherited from a parent process share its file offsets, so are not reused
+    if _open_stacks_pid != os.getpid():
+        _open_stacks.clear()
+        _open_stacks_pid = os.getpid()
+    stat = os.stat(stack_filepath)
+    key = (stack_filepath, stat.st_size, stat.st_mtime_ns)
+    stack = _open_stacks.get(stack_filepath)
+    if stack is not None and stack[0] == key:
+        return stack[1]
+    if stack is not None:
+        stack[1].close()
+    elif len(_open_stacks) >= OPEN_STACK_LIMIT:
+        _open_stacks.pop(next(iter(_open_stacks)))[1].close()
+    _open_stacks[stack_filepath] = (key, TiffStack(stack_filepath))
+    return _open_stacks[stack_filepath][1]
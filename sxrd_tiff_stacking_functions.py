@@ -0,0 +1,286 @@
+import numpy as np
+import os
+import tempfile
+from dataclasses import dataclass
+from tqdm import tqdm
+from typing import List
+
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_stack_functions as stack
+import sxrd_tiff_summer_functions as analysis
+import sxrd_tiff_timing_functions as timing
+
+# methods of combining a series of images into a single summed/averaged image
+STACKING_METHODS = ("mean", "median", "sigma_clip")
+# default memory in bytes for the tile of rows from every image held by a process at once
+STACKING_MEMORY = 1024 * 2**20
+# default number of standard deviations from the mean beyond which a pixel value is clipped
+SIGMA = 3.0
+# default maximum number of clipping iterations
+MAX_ITERATIONS = 5
+# working memory per pixel value of a tile, in bytes on top of the value itself, for each method
+TILE_WORKING_BYTES = {"median": 8, "sigma_clip": 14}
+# default folder of the temporary file images are spilled to, the system temporary folder (set by TMPDIR) if None
+SPILL_DIRECTORY = None
+
+def check_method(method: str, statistics: List[str] = ()):
+    '''Raise an error if the stacking method is not recognised, or if additional statistic
+    images are requested with a method other than the mean.'''
+    if method not in STACKING_METHODS:
+        raise ValueError(f"Unknown stacking method '{method}', choose from {STACKING_METHODS}.")
+    if method != "mean" and statistics:
+        raise ValueError(f"Additional statistic images are only saved with the 'mean' stacking method, not '{method}'.")
+
+@dataclass(frozen=True)
+class TileFrame:
+    '''Reference to a range of rows of a single diffraction pattern image, read on their own
+    from a frame of a tiff stack, or a background subtracted frame of one.'''
+    image_path: object
+    row_start: int
+    row_end: int
+
+    def read(self) -> np.ndarray:
+        '''Read the intensity array of the rows from the image.'''
+        return self.image_path.read_rows(self.row_start, self.row_end)
+
+def get_stack_frame(image_path):
+    '''Return the frame of a tiff stack an image is read from, directly or through a background
+    subtracted frame, or None for an image file.'''
+    while not isinstance(image_path, stack.StackFrame):
+        if not hasattr(image_path, "image_path"):
+            return None
+        image_path = image_path.image_path
+    return image_path
+
+def get_segment_rows(image_list: list) -> int:
+    '''Return the number of rows in each tile or strip of the images, if every image is a page
+    of the same tiff stack and its rows can be read on their own, or None otherwise. The rows
+    of separate image files are not read a tile at a time, as every tile would open every file again.
+
+    :param image_list: list of paths to the tiff images, or of references to the images.
+    '''
+    stack_frames = [get_stack_frame(image_path) for image_path in image_list]
+    if None in stack_frames or not all(hasattr(image_path, "read_rows") for image_path in image_list):
+        return None
+    if len({stack_frame.stack_filepath for stack_frame in stack_frames}) != 1:
+        return None
+    tiff_stack = stack.open_tiff_stack(stack_frames[0].stack_filepath)
+    segment_rows = {tiff_stack.segment_rows(stack_frame.index) for stack_frame in stack_frames}
+    if len(segment_rows) != 1:
+        return None
+    return segment_rows.pop()
+
+def get_tile_rows(number_of_images: int, shape: tuple, itemsize: int, method: str, memory_limit: int = STACKING_MEMORY) -> int:
+    '''Return the number of rows in each tile, so that a tile of rows from every image,
+    with the working memory of the stacking method, fits within a memory limit.
+
+    :param number_of_images: number of images in the series.
+    :param shape: shape of the diffraction pattern images in rows and columns.
+    :param itemsize: size in bytes of each pixel value of the images.
+    :param method: stacking method, 'median' or 'sigma_clip'.
+    :param memory_limit: memory in bytes for a tile.
+    '''
+    row_bytes = number_of_images * int(np.prod(shape[1:])) * (itemsize + TILE_WORKING_BYTES[method])
+    if row_bytes > memory_limit:
+        raise ValueError(f"A single row of {number_of_images} images needs {row_bytes / 2**20:.1f} MB to stack by {method}, "
+                          f"more than the stacking memory of {memory_limit / 2**20:.1f} MB per process.")
+    return int(min(shape[0], memory_limit // row_bytes))
+
+def sigma_clipped_mean(tile: np.ndarray, sigma: float = SIGMA, max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    '''Return the per-pixel mean of a tile of images, leaving out values further than a
+    number of standard deviations from the mean of the values kept. The clipping is repeated
+    until no more values are clipped, or for a maximum number of iterations.
+
+    :param tile: intensity arrays of the same rows of every image, stacked along the first axis.
+    :param sigma: number of standard deviations from the mean beyond which a value is clipped.
+    :param max_iterations: maximum number of clipping iterations.
+
+    :return: float64 array of the clipped mean of each pixel.
+    '''
+    # detector counts are exact as float32, and the sums are accumulated as float64
+    data = tile.astype(np.float32)
+    keep = np.ones(data.shape, dtype=bool)
+    deviation = np.empty_like(data)
+    squares = np.empty_like(data)
+    # at least one value of each pixel lies within a standard deviation of the mean, so none are emptied
+    count = np.full(data.shape[1:], data.shape[0])
+
+    for _ in range(max_iterations):
+        mean = np.multiply(data, keep, out=squares).sum(axis=0, dtype=np.float64) / count
+        np.subtract(data, mean.astype(np.float32), out=deviation)
+        np.abs(deviation, out=deviation)
+        np.multiply(deviation, deviation, out=squares)
+        squares *= keep
+        limit = sigma * np.sqrt(squares.sum(axis=0, dtype=np.float64) / count)
+        clipped = keep & (deviation > limit.astype(np.float32))
+        if not clipped.any():
+            break
+        keep &= ~clipped
+        count = keep.sum(axis=0)
+
+    return np.multiply(data, keep, out=squares).sum(axis=0, dtype=np.float64) / count
+
+def stack_tile(tile: np.ndarray, method: str, sigma: float = SIGMA, max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    '''Combine a tile of images into the rows of a single image, by the median or sigma-clipped mean.'''
+    if method == "median":
+        return np.median(tile, axis=0)
+    return sigma_clipped_mean(tile, sigma, max_iterations)
+
+def read_tile(image_list: list) -> np.ndarray:
+    '''Read a list of images, or of ranges of rows of images, into a single array stacked along the first axis.'''
+    tile = None
+    for position, (_, image_array) in enumerate(prefetch.prefetch_frames(image_list)):
+        if tile is None:
+            tile = np.empty((len(image_list),) + image_array.shape, dtype=image_array.dtype)
+        tile[position] = image_array
+    return tile
+
+def stack_tile_rows(image_list: list, row_start: int, row_end: int, method: str,
+                    sigma: float = SIGMA, max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    '''Read a range of rows from every image of a tiff stack and combine them by a stacking method.
+
+    :param image_list: list of references to the images in the stack.
+    :param row_start: first row of the tile.
+    :param row_end: row after the last row of the tile.
+    :param method: stacking method, 'median' or 'sigma_clip'.
+    :param sigma: number of standard deviations from the mean beyond which a value is clipped.
+    :param max_iterations: maximum number of clipping iterations.
+
+    :return: float64 array of the stacked rows.
+    '''
+    tile = read_tile([TileFrame(image_path, row_start, row_end) for image_path in image_list])
+    with timing.stage("reduce"):
+        return stack_tile(tile, method, sigma, max_iterations)
+
+def spill_frames(image_list: list, frame_start: int, spill_filepath: str, spill_shape: tuple, dtype) -> int:
+    '''Read a chunk of a series of images once and write them to a spill file, which holds
+    every row of every image in row order, so the tile of each range of rows is contiguous.
+
+    :param image_list: list of paths to the tiff images in the chunk, or of references to the images.
+    :param frame_start: position of the first image of the chunk in the series.
+    :param spill_filepath: path of the spill file.
+    :param spill_shape: shape of the spill file, in rows, images and columns.
+    :param dtype: data type of the pixel values in the spill file.
+
+    :return: number of images written.
+    '''
+    spill = np.memmap(spill_filepath, dtype=dtype, mode="r+", shape=spill_shape)
+    image_shape = spill_shape[:1] + spill_shape[2:]
+    for position, (image_path, image_array) in enumerate(prefetch.prefetch_frames(image_list), frame_start):
+        if image_array.shape != image_shape:
+            raise ValueError(f"Image '{image_path}' of shape {image_array.shape} does not match the first image of shape {image_shape}.")
+        with timing.stage("spill"):
+            spill[:, position] = image_array
+    spill.flush()
+    del spill
+    return len(image_list)
+
+def stack_spilled_rows(spill_filepath: str, spill_shape: tuple, dtype, row_start: int, row_end: int, method: str,
+                       sigma: float = SIGMA, max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    '''Read the tile of a range of rows from a spill file and combine it by a stacking method.
+
+    :param spill_filepath: path of the spill file, written by spill_frames.
+    :param spill_shape: shape of the spill file, in rows, images and columns.
+    :param dtype: data type of the pixel values in the spill file.
+    :param row_start: first row of the tile.
+    :param row_end: row after the last row of the tile.
+    :param method: stacking method, 'median' or 'sigma_clip'.
+    :param sigma: number of standard deviations from the mean beyond which a value is clipped.
+    :param max_iterations: maximum number of clipping iterations.
+
+    :return: float64 array of the stacked rows.
+    '''
+    spill = np.memmap(spill_filepath, dtype=dtype, mode="r", shape=spill_shape)
+    with timing.stage("read") as read_stage:
+        tile = np.array(spill[row_start:row_end])
+        read_stage.read(tile)
+    del spill
+    with timing.stage("reduce"):
+        # the images are along the second axis of the spilled rows
+        return stack_tile(np.moveaxis(tile, 1, 0), method, sigma, max_iterations)
+
+def run_chunks(experiment_number: str, worker_function, chunk_arguments: list, workers: int) -> list:
+    '''Call a function with each argument tuple, on a pool of worker processes if there is
+    more than one worker, and return the results in order.'''
+    if workers > 1:
+        for _, results in analysis.run_parallel_chunks({experiment_number: chunk_arguments}, worker_function, workers):
+            if isinstance(results, Exception):
+                raise results
+        return results
+    return [worker_function(*arguments) for arguments in tqdm(chunk_arguments)]
+
+def stack_tiff_images(experiment_number: str, image_list: list, method: str, memory_limit: int = None, workers: int = 1,
+                      sigma: float = SIGMA, max_iterations: int = MAX_ITERATIONS, spill_directory: str = None) -> np.ndarray:
+    '''Combine a series of tiff images into a single image by the per-pixel median or
+    sigma-clipped mean, which are not skewed by a few images with detector glitches or
+    strong single-grain spots. The detector is processed in tiles of rows, holding the
+    tile of every image at once, with the number of rows chosen to fit the memory limit.
+
+    Every image is read once, so the run time grows linearly with the number of images.
+    A series fitting the memory limit is stacked as a single tile. Otherwise, the tiles
+    of a tiff stack are read from it directly, decoding only the tiles or strips of each
+    page holding their rows, and any other series is first spilled to a temporary file
+    in row order, so each tile is read back with a single contiguous read. The spill
+    file is as large as the series, and is deleted when the image is stacked.
+
+    :param experiment_number: input experiment number, recording the timings of the worker processes.
+    :param image_list: list of paths to the tiff images, or of references to the images.
+    :param method: stacking method, 'median' or 'sigma_clip'.
+    :param memory_limit: memory in bytes for the tiles, split between the worker processes, STACKING_MEMORY by default.
+    :param workers: number of worker processes the images and tiles are split between.
+    :param sigma: number of standard deviations from the mean beyond which a value is clipped.
+    :param max_iterations: maximum number of clipping iterations.
+    :param spill_directory: folder of the temporary spill file, SPILL_DIRECTORY by default.
+
+    :return: float64 array of the stacked image.
+    '''
+    if not image_list:
+        raise FileNotFoundError("No diffraction pattern images to stack.")
+    memory_limit = STACKING_MEMORY if memory_limit is None else memory_limit
+    spill_directory = SPILL_DIRECTORY if spill_directory is None else spill_directory
+    workers = max(1, workers)
+    number_of_images = len(image_list)
+    first_image = frame_reader.read_frame(image_list[0])
+    shape, dtype = first_image.shape, first_image.dtype
+
+    if get_tile_rows(number_of_images, shape, dtype.itemsize, method, memory_limit) == shape[0]:
+        print(f"Stacking {number_of_images} images by {method} in a single tile.")
+        tile = read_tile(image_list)
+        with timing.stage("reduce"):
+            return stack_tile(tile, method, sigma, max_iterations)
+
+    tile_rows = get_tile_rows(number_of_images, shape, dtype.itemsize, method, memory_limit // workers)
+    segment_rows = get_segment_rows(image_list)
+    image_array = np.empty(shape, dtype=np.float64)
+
+    if segment_rows is not None and segment_rows <= tile_rows:
+        # each tile or strip of a page is decoded for a single tile of rows
+        tile_rows -= tile_rows % segment_rows
+        tiles = [(row_start, min(row_start + tile_rows, shape[0])) for row_start in range(0, shape[0], tile_rows)]
+        print(f"Stacking {number_of_images} images by {method} in {len(tiles)} tile(s) of {tile_rows} row(s), read from the stack.")
+        tile_arrays = run_chunks(experiment_number, stack_tile_rows,
+                                 [(image_list, row_start, row_end, method, sigma, max_iterations) for row_start, row_end in tiles], workers)
+    else:
+        tiles = [(row_start, min(row_start + tile_rows, shape[0])) for row_start in range(0, shape[0], tile_rows)]
+        spill_shape = (shape[0], number_of_images) + shape[1:]
+        if spill_directory is not None:
+            os.makedirs(spill_directory, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="sxrd_stacking_", dir=spill_directory) as spill_folder:
+            spill_filepath = os.path.join(spill_folder, "spill.raw")
+            print(f"Spilling {number_of_images} images ({number_of_images * first_image.nbytes / 2**30:.2f} GB) to '{spill_folder}', "
+                  f"to stack them by {method} in {len(tiles)} tile(s) of {tile_rows} row(s).")
+            with open(spill_filepath, "wb") as spill_file:
+                spill_file.truncate(number_of_images * first_image.nbytes)
+
+            chunks = analysis.split_image_list(image_list, workers)
+            frame_starts = np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]])
+            run_chunks(experiment_number, spill_frames,
+                       [(chunk, int(frame_start), spill_filepath, spill_shape, dtype) for chunk, frame_start in zip(chunks, frame_starts)], workers)
+            tile_arrays = run_chunks(experiment_number, stack_spilled_rows,
+                                     [(spill_filepath, spill_shape, dtype, row_start, row_end, method, sigma, max_iterations)
+                                      for row_start, row_end in tiles], workers)
+
+    for (row_start, row_end), tile_array in zip(tiles, tile_arrays):
+        image_array[row_start:row_end] = tile_array
+    return image_array
@@ -0,0 +1,139 @@
+import numpy as np
+import pathlib
+from dataclasses import dataclass, field
+from typing import List
+
+import sxrd_tiff_manifest_functions as frame_manifest
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_stack_functions as stack
+import sxrd_tiff_summer_functions as analysis
+from sxrd_tiff_manifest_functions import get_frame_number
+
+# glob pattern selecting the images when iterating over or indexing a dataset without a pattern of its own
+DATASET_PATTERN = "0*.tif*"
+
+@dataclass(frozen=True)
+class SubtractedFrame:
+    '''Reference to a single diffraction pattern image whose background is subtracted as it is read.
+    Used in place of an image path, so a subtracted dataset can be read wherever a folder of images is.'''
+    image_path: object
+    dataset: "SubtractedDataset" = field(compare=False, repr=False)
+
+    @property
+    def name(self) -> str:
+        '''File name of the original image.'''
+        return self.image_path.name
+
+    @property
+    def stem(self) -> str:
+        '''File name of the original image, without the suffix.'''
+        return pathlib.Path(self.name).stem
+
+    def read(self) -> np.ndarray:
+        '''Read the original image and return its intensity array with the background subtracted.'''
+        if hasattr(self.image_path, "read"):
+            image_array = self.image_path.read()
+        else:
+            image_array = frame_reader.read_tiff(self.image_path)
+        return self.dataset.subtract(image_array)
+
+    def read_rows(self, row_start: int, row_end: int) -> np.ndarray:
+        '''Read a range of rows of the original image and return their intensity array with the
+        same rows of the background subtracted. Only the rows are read from a tiff stack.'''
+        if hasattr(self.image_path, "read_rows"):
+            image_array = self.image_path.read_rows(row_start, row_end)
+        elif hasattr(self.image_path, "read"):
+            image_array = self.image_path.read()[row_start:row_end]
+        else:
+            image_array = frame_reader.read_tiff(self.image_path)[row_start:row_end]
+        return self.dataset.subtract(image_array, row_start)
+
+    def __str__(self) -> str:
+        return str(self.image_path)
+
+class SubtractedDataset:
+    '''Background subtracted view of the diffraction pattern images of an experiment.
+    The scaled background scattering image is held once, and subtracted from each image
+    when it is read, giving the same intensities as the images saved by subtract_tiff_images
+    without writing them. The dataset can be used as the input path of the summing and mapping
+    functions. Iterating over the dataset yields the subtracted intensity arrays in order,
+    and indexing it by frame number returns a single subtracted intensity array.
+
+    As the subtraction happens as each image is read, its time is recorded in the 'read' stage.
+    '''
+    def __init__(self, input_filepath, subtract_image_array: np.ndarray, pattern: str = None):
+        '''
+        :param input_filepath: input path to the series of tiff images, or to a tiff stack.
+        :param subtract_image_array: scaled background scattering intensity array to subtract.
+        :param pattern: glob pattern selecting the images in the folder, such as '0*.tif', in place of that of the function reading the dataset.
+        '''
+        self.input_filepath = input_filepath
+        self.subtract_image_array = subtract_image_array
+        self.pattern = pattern
+        self._index = None
+
+    def image_list(self, pattern: str = None) -> List[SubtractedFrame]:
+        '''Return a reference to every image in the experiment, in order.
+
+        :param pattern: glob pattern selecting the images in a folder, used if the dataset has no pattern of its own.
+        '''
+        pattern = self.pattern or pattern
+        if stack.is_tiff_stack(self.input_filepath):
+            image_list = stack.open_tiff_stack(self.input_filepath).image_list(pattern)
+        else:
+            image_list = frame_manifest.list_tiff_images(self.input_filepath, pattern)
+        return [SubtractedFrame(image_path, self) for image_path in image_list]
+
+    def subtract(self, image_array: np.ndarray, row_start: int = 0) -> np.ndarray:
+        '''Subtract the scaled background from a diffraction pattern image, or from a range of its rows.
+
+        :param image_array: intensity array of the image, or of a range of its rows.
+        :param row_start: first row of the range, for an intensity array of a range of rows.
+
+        :return: subtracted intensity array, as integer 32 bit.
+        '''
+        subtract_image_array = self.subtract_image_array
+        if row_start or len(image_array) != len(subtract_image_array):
+            subtract_image_array = subtract_image_array[row_start:row_start + len(image_array)]
+        if image_array.shape != subtract_image_array.shape:
+            raise ValueError(f"Image of shape {image_array.shape} does not match the background of shape {self.subtract_image_array.shape}.")
+        new_image_array = image_array - subtract_image_array
+        # convert to integer 32 bit array
+        return new_image_array.astype('int32')
+
+    def __getitem__(self, frame_number: int) -> np.ndarray:
+        '''Read the subtracted intensity array of the image with a given frame number.'''
+        if self._index is None:
+            self._index = {get_frame_number(frame.name): frame for frame in self.image_list(DATASET_PATTERN)}
+        if frame_number not in self._index:
+            raise KeyError(f"Frame number {frame_number} is not in '{self.input_filepath}'.")
+        return self._index[frame_number].read()
+
+    def __len__(self) -> int:
+        return len(self.image_list(DATASET_PATTERN))
+
+    def __iter__(self):
+        for frame in self.image_list(DATASET_PATTERN):
+            yield frame.read()
+
+    def __getstate__(self) -> dict:
+        # the frame number index is rebuilt by each process, rather than copied to it
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+    def __str__(self) -> str:
+        return f"{self.input_filepath} (background subtracted)"
+
+def open_subtracted_dataset(input_filepath, background_scatter_filepath: str, background_scatter_multiple: int,
+                            pattern: str = None) -> SubtractedDataset:
+    '''Return a background subtracted view of the images of an experiment, scaling the
+    background scattering image once.
+
+    :param input_filepath: input path to the series of tiff images, or to a tiff stack.
+    :param background_scatter_filepath: path of the tiff image to subtract (such as an background scattering image).
+    :param background_scatter_multiple: value to multiply the background scatter intensity, to match the acquisition frequency of the data.
+    :param pattern: glob pattern selecting the images in the folder, such as '0*.tif', in place of that of the function reading the dataset.
+    '''
+    subtract_image_array = analysis.get_subtract_image_array(background_scatter_filepath, background_scatter_multiple)
+    return SubtractedDataset(input_filepath, subtract_image_array, pattern)
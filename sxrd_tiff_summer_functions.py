@@ -1,15 +1,22 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import warnings
 warnings.simplefilter('ignore')
-from skimage import io
 import pathlib
 from tqdm import tqdm
 import os
 import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Tuple
 from typing import List
 
+import sxrd_tiff_prefetch_functions as prefetch
+import sxrd_tiff_preview_functions as preview
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_stack_functions as stack
+import sxrd_tiff_stacking_functions as stacking
+import sxrd_tiff_timing_functions as timing
+from sxrd_tiff_reducer_functions import ImageReducer
+
 def get_config(path: str) -> dict:
     """Open a yaml file and return the contents."""
     with open(path) as input_file:
@@ -51,8 +58,152 @@ def extract_input(config_path: str):
     print("The value to multiply the background scatter intensity, to match the acquisition frequency of the data, is :", background_scatter_multiple, sep = '\n', end = '\n\n')
     
     return experiment_numbers, input_path, output_path, background_scatter_path, background_scatter_multiple
+
+def extract_processing_input(config_path: str) -> int:
+    """Extract the optional processing settings from yaml configuration file.
+    If the configuration has no 'processing' block the images are processed serially.
+    
+    :param config_path: path to the configuration file.
+    
+    :return: number of worker processes, as an integer.
+    """
+    config = get_config(config_path)
+    processing = config.get("processing") or {}
+    workers = processing.get("workers", 1)
+    
+    # an empty value uses every available core
+    if workers is None:
+        workers = os.cpu_count()
+    print("The number of worker processes is :", workers, sep = '\n', end = '\n\n')
+    
+    return workers
+
+def split_image_list(image_list: list, number_of_chunks: int) -> List[list]:
+    '''Split a list of image paths into contiguous chunks of near equal length,
+    keeping the original order of the images.
+    
+    :param image_list: list of image paths.
+    :param number_of_chunks: maximum number of chunks to return.
+    
+    :return: list of non-empty image path lists.
+    '''
+    number_of_chunks = max(1, min(number_of_chunks, len(image_list)))
+    chunk_size, remainder = divmod(len(image_list), number_of_chunks)
+    chunks = []
+    start = 0
+    for i in range(number_of_chunks):
+        end = start + chunk_size + (1 if i < remainder else 0)
+        chunks.append(image_list[start:end])
+        start = end
+    return chunks
+
+def reduce_tiff_images(image_list: list, statistics: List[str] = ()) -> ImageReducer:
+    '''Accumulate the intensities of a list of tiff images in a single pass.
+    Integer addition is associative, so the reducers of several chunks of integer
+    detector images merge to exactly the same sum as reducing the whole list.
+    
+    :param image_list: list of paths to the tiff images.
+    :param statistics: additional statistics to track, from 'sum', 'max', 'min' and 'variance'.
     
-def avg_tiff_images(experiment_number: str, input_filepath: str, output_filepath: str, v_max: int):
+    :return: reducer holding the summed intensity and statistics.
+    '''
+    reducer = ImageReducer(statistics)
+    for image_path, image_array in prefetch.prefetch_frames(image_list):
+        with timing.stage("reduce"):
+            reducer.update(image_array)
+    return reducer
+
+def run_parallel_chunks(tasks: dict, worker_function, workers: int, merge_function = None):
+    '''Run chunks of work for several experiments on a pool of worker processes.
+    Results are yielded per experiment, in chunk order, as soon as all of the chunks
+    for that experiment have completed. An experiment with a failed chunk is reported
+    and yielded with the exception in place of its results. When stage timings are
+    being recorded, the timings of each chunk are returned from its worker and merged.
+
+    With a merge function, such as merge_reducers, the result of each chunk is folded into
+    a running result as soon as every earlier chunk of the experiment has completed, so only
+    the chunks that finish out of order are held, and the running result is yielded in place
+    of the list. The chunks are always folded in chunk order, so the result does not depend
+    on the order in which they complete.
+    
+    :param tasks: dictionary of experiment number to a list of argument tuples, one per chunk.
+    :param worker_function: module level function called with each argument tuple.
+    :param workers: number of worker processes.
+    :param merge_function: optional function called with the running result and the result of the next chunk, returning the new running result.
+    
+    :return: generator of (experiment number, list of chunk results, merged result or exception).
+    '''
+    timed = timing.is_enabled()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        results = {}
+        merged = {}
+        next_chunk = {}
+        remaining = {}
+        for experiment_number, chunk_arguments in tasks.items():
+            results[experiment_number] = {} if merge_function is not None else [None] * len(chunk_arguments)
+            next_chunk[experiment_number] = 0
+            remaining[experiment_number] = len(chunk_arguments)
+            for chunk_number, arguments in enumerate(chunk_arguments):
+                if timed:
+                    future = executor.submit(timing.call_with_timing, experiment_number, worker_function, *arguments)
+                else:
+                    future = executor.submit(worker_function, *arguments)
+                futures[future] = (experiment_number, chunk_number)
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            experiment_number, chunk_number = futures.pop(future)
+            if experiment_number not in remaining:
+                # the experiment has already failed
+                continue
+            try:
+                result = future.result()
+                if timed:
+                    result, chunk_timings = result
+                    timing.merge(chunk_timings)
+                results[experiment_number][chunk_number] = result
+                if merge_function is not None:
+                    # fold the completed chunks that follow on from those already merged
+                    chunk_results = results[experiment_number]
+                    timing.set_experiment(experiment_number)
+                    with timing.stage("reduce"):
+                        while next_chunk[experiment_number] in chunk_results:
+                            result = chunk_results.pop(next_chunk[experiment_number])
+                            if next_chunk[experiment_number] == 0:
+                                merged[experiment_number] = result
+                            else:
+                                merged[experiment_number] = merge_function(merged[experiment_number], result)
+                            next_chunk[experiment_number] += 1
+            except Exception as error:
+                del remaining[experiment_number]
+                results.pop(experiment_number)
+                merged.pop(experiment_number, None)
+                print(f"Experiment {experiment_number} failed: {error!r}")
+                yield experiment_number, error
+                continue
+            remaining[experiment_number] -= 1
+            if remaining[experiment_number] == 0:
+                del remaining[experiment_number]
+                chunk_results = results.pop(experiment_number)
+                yield experiment_number, merged.pop(experiment_number) if merge_function is not None else chunk_results
+
+def merge_reducers(reducer: ImageReducer, chunk_reducer: ImageReducer) -> ImageReducer:
+    '''Merge the reducer of the next chunk of a series into the running reducer, for run_parallel_chunks.'''
+    reducer.merge(chunk_reducer)
+    return reducer
+
+def raise_failed_experiments(failed: dict):
+    '''Raise a single error listing every experiment that failed in a parallel run.
+    
+    :param failed: dictionary of experiment number to the exception raised.
+    '''
+    if failed:
+        summary = ", ".join(f"{number} ({error!r})" for number, error in failed.items())
+        raise RuntimeError(f"{len(failed)} experiment(s) failed: {summary}")
+
+def avg_tiff_images(experiment_number: str, input_filepath: str, output_filepath: str, v_max: int,
+                    workers: int = 1, statistics: List[str] = (), plot: bool = True, previews: List[int] = (),
+                    method: str = "mean", stacking_memory: int = None, spill_directory: str = None):
     '''Sum up the intensities of all the tiff images contained in the input folder
     and save a single average tiff image to the output folder.
     
@@ -60,20 +211,107 @@ def avg_tiff_images(experiment_number: str, input_filepath: str, output_filepath
     :param input_filepath: input path to the series of tiff images.
     :param output_filepath: output path to save the single summed/averaged tiff image.
     :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param workers: number of worker processes, splitting the series into chunks when greater than one.
+    :param statistics: additional images to save from the same pass, from 'sum', 'max', 'min' and 'variance'.
+    :param plot: plot the summed/averaged image, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged image, such as (2, 4, 8).
+    :param method: per-pixel average of the images, from 'mean', 'median' and 'sigma_clip'.
+    :param stacking_memory: memory in bytes for the tiles of rows held by the 'median' and 'sigma_clip' methods, 1 GiB by default.
+    :param spill_directory: folder of the temporary file a series larger than the stacking memory is copied to by the 'median' and 'sigma_clip' methods, the output folder by default.
+    '''
+    stacking.check_method(method, statistics)
+    timing.set_experiment(experiment_number)
+    image_list = frame_reader.list_frames(input_filepath, "0*.tiff")
+    
+    if method != "mean":
+        # spill to the output folder, as the system temporary folder can be held in memory on cluster nodes
+        spill_directory = output_filepath if spill_directory is None else spill_directory
+        image_array = stacking.stack_tiff_images(experiment_number, image_list, method, stacking_memory, workers,
+                                                 spill_directory = spill_directory)
+        # convert to integer 32 bit array
+        save_summed_image(experiment_number, image_array.astype('int32'), output_filepath, v_max, plot, previews)
+        return
+
+    if workers > 1:
+        tasks = {experiment_number: [(chunk, statistics) for chunk in split_image_list(image_list, workers)]}
+        failed = {}
+        for number, reducer in run_parallel_chunks(tasks, reduce_tiff_images, workers, merge_reducers):
+            if isinstance(reducer, Exception):
+                failed[number] = reducer
+            else:
+                save_avg_tiff_image(experiment_number, [reducer], output_filepath, v_max, statistics, plot, previews)
+        raise_failed_experiments(failed)
+        return
+    
+    reducer = ImageReducer(statistics)
+
+    for image_path, image_array in tqdm(prefetch.prefetch_frames(image_list), total=len(image_list)):
+        with timing.stage("reduce"):
+            reducer.update(image_array)
+
+    save_avg_tiff_image(experiment_number, [reducer], output_filepath, v_max, statistics, plot, previews)
+
+def save_statistic_images(experiment_number: str, reducer: ImageReducer, statistics: List[str], output_filepath: str):
+    '''Save the additional statistics of a series of tiff images to the output folder,
+    named after the statistic, such as '{experiment_number}_max1.tiff'.
+    
+    :param experiment_number: input experiment number.
+    :param reducer: reducer holding the accumulated statistics.
+    :param statistics: statistics to save, from 'sum', 'max', 'min' and 'variance'.
+    :param output_filepath: output path to save the statistic tiff images.
     '''
-    image_list = sorted(pathlib.Path(input_filepath).glob("0*.tiff"))
+    for statistic in statistics:
+        with timing.stage("save") as save_stage:
+            frame_reader.write_tiff(f"{output_filepath}{experiment_number}_{statistic}1.tiff", reducer.result(statistic))
+            save_stage.written(f"{output_filepath}{experiment_number}_{statistic}1.tiff")
+        print(f"Written {statistic} .tiff image to: '{output_filepath}'.")
+
+def save_avg_tiff_image(experiment_number: str, reducers: List[ImageReducer], output_filepath: str, v_max: int,
+                        statistics: List[str] = (), plot: bool = True, previews: List[int] = ()):
+    '''Merge the reducers of a series of tiff images, divide the summed intensity by the
+    number of images and save a single average tiff image to the output folder.
     
-    # set the image arrays to zero to prevent unusual memory allocation
-    image_example = io.imread(image_list[1])
-    image_array = np.zeros(shape=np.shape(image_example), dtype='int32')
+    :param experiment_number: input experiment number.
+    :param reducers: list of reducers, one per chunk of the series.
+    :param output_filepath: output path to save the single summed/averaged tiff image.
+    :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param statistics: additional statistic images to save, from 'sum', 'max', 'min' and 'variance'.
+    :param plot: plot the summed/averaged image, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged image, such as (2, 4, 8).
+    '''
+    with timing.stage("reduce"):
+        reducer = reducers[0]
+        for chunk_reducer in reducers[1:]:
+            reducer.merge(chunk_reducer)
+
+        image_array = reducer.mean()
+        # convert to integer 32 bit array
+        image_array = image_array.astype('int32')
+
+    save_summed_image(experiment_number, image_array, output_filepath, v_max, plot, previews)
 
-    for image_path in tqdm(image_list):
-        image_array = image_array + np.array(io.imread(image_path))
+    save_statistic_images(experiment_number, reducer, statistics, output_filepath)
 
-    image_array = image_array / len(image_list)
-    # convert to integer 32 bit array
-    image_array = image_array.astype('int32')
-    plt.imshow(image_array, cmap='gray', vmin = 0, vmax = v_max)
+def save_summed_image(experiment_number: str, image_array: np.ndarray, output_filepath: str, v_max: int,
+                      plot: bool = True, previews: List[int] = ()):
+    '''Plot a summed/averaged image and save it to the output folder as '{experiment_number}_summed1.tiff',
+    with its preview levels.
+    
+    :param experiment_number: input experiment number.
+    :param image_array: integer 32 bit summed/averaged intensity array.
+    :param output_filepath: output path to save the single summed/averaged tiff image.
+    :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param plot: plot the summed/averaged image, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the summed/averaged image, such as (2, 4, 8).
+    '''
+    preview_arrays = {}
+    if previews:
+        with timing.stage("preview"):
+            preview_arrays = preview.bin_images(image_array, previews)
+
+    if plot:
+        with timing.stage("plot"):
+            preview.plot_preview(image_array, preview_arrays, v_max)
     
     # check if the output directory exists and if not create it
     CHECK_FOLDER = os.path.isdir(f"{output_filepath}")
@@ -86,11 +324,18 @@ def avg_tiff_images(experiment_number: str, input_filepath: str, output_filepath
         print(f"'{output_filepath}' folder already exists.")
 
     # save the image
-    io.imsave(f"{output_filepath}{experiment_number}_summed1.tiff", image_array)
+    with timing.stage("save") as save_stage:
+        frame_reader.write_tiff(f"{output_filepath}{experiment_number}_summed1.tiff", image_array)
+        save_stage.written(f"{output_filepath}{experiment_number}_summed1.tiff")
+    
+    preview.save_previews(output_filepath, f"{experiment_number}_summed1.tiff", preview_arrays)
     
     print(f"Written .tiff image to: '{output_filepath}'.")
     
-def multiple_avg_tiff_images(experiment_numbers: List[int], input_path: str, output_path: str, v_max: int):
+def multiple_avg_tiff_images(experiment_numbers: List[int], input_path: str, output_path: str, v_max: int,
+                             workers: int = 1, statistics: List[str] = (), timing_filepath: str = None,
+                             plot: bool = True, previews: List[int] = (), method: str = "mean",
+                             stacking_memory: int = None, spill_directory: str = None):
     '''Create input and output file paths for a list of experiments. 
     Sum up the intensities of all the tiff images contained in the input folders
     and save single average tiff images to the output folder.
@@ -99,15 +344,202 @@ def multiple_avg_tiff_images(experiment_numbers: List[int], input_path: str, out
     :param input_filepath: input path to the series of tiff images.
     :param output_filepath: output path to save the single summed/averaged tiff image.
     :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param workers: number of worker processes, spread across the experiments and chunks of each series.
+    :param statistics: additional images to save from the same pass, from 'sum', 'max', 'min' and 'variance'.
+    :param timing_filepath: optional path to save a JSON summary of the time spent in each stage of each experiment.
+    :param plot: plot each summed/averaged image, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside each summed/averaged image, such as (2, 4, 8).
+    :param method: per-pixel average of the images, from 'mean', 'median' and 'sigma_clip'.
+    :param stacking_memory: memory in bytes for the tiles of rows held by the 'median' and 'sigma_clip' methods, 1 GiB by default.
+    :param spill_directory: folder of the temporary file a series larger than the stacking memory is copied to by the 'median' and 'sigma_clip' methods, the output folder of each experiment by default.
     '''
-    for experiment_number in experiment_numbers:
+    stacking.check_method(method, statistics)
+    with timing.TimedRun("multiple_avg_tiff_images", timing_filepath):
+        # the 'median' and 'sigma_clip' methods split each experiment into tiles of rows rather than chunks of images
+        if workers > 1 and method == "mean":
+            tasks = {}
+            failed = {}
+            for experiment_number in experiment_numbers:
+                experiment_number = str(experiment_number)
+                input_filepath = input_path.format(experiment_number = experiment_number)
+                timing.set_experiment(experiment_number)
+                image_list = frame_reader.list_frames(input_filepath, "0*.tiff")
+                if not image_list:
+                    failed[experiment_number] = FileNotFoundError(f"No .tiff images found in '{input_filepath}'.")
+                    print(f"Experiment {experiment_number} failed: {failed[experiment_number]!r}")
+                    continue
+                tasks[experiment_number] = [(chunk, statistics) for chunk in split_image_list(image_list, workers)]
+
+            for experiment_number, reducer in run_parallel_chunks(tasks, reduce_tiff_images, workers, merge_reducers):
+                if isinstance(reducer, Exception):
+                    failed[experiment_number] = reducer
+                    continue
+                output_filepath = output_path.format(experiment_number = experiment_number)
+                timing.set_experiment(experiment_number)
+                save_avg_tiff_image(experiment_number, [reducer], output_filepath, v_max, statistics, plot, previews)
+                print(f"Experiment {experiment_number} complete.")
+            raise_failed_experiments(failed)
+            return
+
+        for experiment_number in experiment_numbers:
         
-        experiment_number = str(experiment_number)
-        input_filepath = input_path.format(experiment_number = experiment_number)
-        output_filepath = output_path.format(experiment_number = experiment_number) 
-        avg_tiff_images(experiment_number, input_filepath, output_filepath, v_max)
+            experiment_number = str(experiment_number)
+            input_filepath = input_path.format(experiment_number = experiment_number)
+            output_filepath = output_path.format(experiment_number = experiment_number) 
+            avg_tiff_images(experiment_number, input_filepath, output_filepath, v_max, workers, statistics, plot, previews,
+                            method, stacking_memory, spill_directory)
                
-def subtract_tiff_images(experiment_number: str, background_scatter_filepath: str, background_scatter_multiple: int, input_filepath: str, output_filepath: str, v_max: int):
+def subtract_tiff_chunk(experiment_number: str, subtract_image_array: np.ndarray, image_list: list, output_filepath: str,
+                        previews: List[int] = ()):
+    '''Subtract a scaled background image from each tiff image in a list
+    and save the subtracted tiff images to the output folder.
+    
+    :param experiment_number: input experiment number.
+    :param subtract_image_array: scaled background scattering intensity array to subtract.
+    :param image_list: list of paths to the tiff images.
+    :param output_filepath: output path to save the series of subtracted tiff images.
+    :param previews: binning factors of preview levels to save alongside each subtracted image, such as (2, 4, 8).
+    
+    :return: the final image in the list, before and after subtraction.
+    '''
+    image_array = new_image_array = None
+    # the next images are read while each subtracted image is saved
+    with prefetch.FrameWriter() as writer:
+        for image_path, image_array in prefetch.prefetch_frames(image_list):
+            
+            new_image_array = subtract_image(image_array, subtract_image_array)
+            writer.submit(save_subtracted_image, experiment_number, image_path, new_image_array, output_filepath, previews)
+
+    return image_array, new_image_array
+
+def subtract_image(image_array: np.ndarray, subtract_image_array: np.ndarray) -> np.ndarray:
+    '''Subtract the scaled background scattering intensity from a diffraction pattern image.
+    
+    :param image_array: diffraction pattern intensity array.
+    :param subtract_image_array: scaled background scattering intensity array to subtract.
+    
+    :return: subtracted intensity array, as integer 32 bit.
+    '''
+    with timing.stage("subtract"):
+        new_image_array = image_array - subtract_image_array
+
+        # convert to integer 32 bit array
+        new_image_array = new_image_array.astype('int32')
+    return new_image_array
+
+def save_subtracted_image(experiment_number: str, image_path, new_image_array: np.ndarray, output_filepath: str,
+                          previews: List[int] = ()):
+    '''Save a single subtracted image to the output folder, named after the original image.
+    
+    :param experiment_number: input experiment number.
+    :param image_path: path of the original tiff image.
+    :param new_image_array: subtracted intensity array.
+    :param output_filepath: output path to save the series of subtracted tiff images.
+    :param previews: binning factors of preview levels to save alongside the subtracted image, such as (2, 4, 8).
+    '''
+    output_stem = image_path.stem if hasattr(image_path, "stem") else pathlib.Path(image_path).stem
+    with timing.stage("save") as save_stage:
+        frame_reader.write_tiff(f"{output_filepath}{experiment_number}_subtracted_{output_stem}.tif", new_image_array)
+        save_stage.written(f"{output_filepath}{experiment_number}_subtracted_{output_stem}.tif")
+
+    if previews:
+        with timing.stage("preview"):
+            preview_arrays = preview.bin_images(new_image_array, previews)
+        preview.save_previews(output_filepath, f"{experiment_number}_subtracted_{output_stem}.tif", preview_arrays)
+
+def get_stack_filepath(experiment_number: str, output_filepath: str) -> str:
+    '''Return the path of the tiff stack of subtracted images for an experiment.'''
+    return f"{output_filepath}{experiment_number}_subtracted_stack.tif"
+
+def subtract_tiff_stack(experiment_number: str, subtract_image_array: np.ndarray, image_list: list, output_filepath: str,
+                        compression_workers: int = None, previews: List[int] = ()):
+    '''Subtract a scaled background image from each tiff image in a list and save the
+    subtracted images as a single tiled and compressed tiff stack.
+    The stack can be used as the input path of the summing and mapping functions.
+    
+    :param experiment_number: input experiment number.
+    :param subtract_image_array: scaled background scattering intensity array to subtract.
+    :param image_list: list of paths to the tiff images.
+    :param output_filepath: output path to save the tiff stack of subtracted images.
+    :param compression_workers: number of threads used to compress each image, all cores if None.
+    :param previews: binning factors of preview stacks to save alongside the stack, such as (2, 4, 8).
+    
+    :return: the final image in the list, before and after subtraction.
+    '''
+    stack_filepath = get_stack_filepath(experiment_number, output_filepath)
+    names = [image_path.name for image_path in image_list]
+    preview_writer = preview.PreviewStackWriter(stack_filepath, names, previews, compression_workers) if previews else None
+    
+    try:
+        with stack.TiffStackWriter(stack_filepath, names, compression_workers) as writer, prefetch.FrameWriter() as frame_writer:
+            for image_path, image_array in tqdm(prefetch.prefetch_frames(image_list), total=len(image_list)):
+                
+                new_image_array = subtract_image(image_array, subtract_image_array)
+
+                # save the image, in the order of the names recorded in the stack
+                frame_writer.submit(save_stack_image, writer, preview_writer, new_image_array)
+    finally:
+        if preview_writer is not None:
+            preview_writer.close()
+
+    # the pages are compressed as they are written, so count the size of the finished stack
+    with timing.stage("save") as save_stage:
+        save_stage.written(stack_filepath)
+
+    return image_array, new_image_array
+
+def save_stack_image(writer: stack.TiffStackWriter, preview_writer, new_image_array: np.ndarray):
+    '''Append the next subtracted image to a tiff stack, and its preview levels to the preview stacks.
+    
+    :param writer: writer of the tiff stack.
+    :param preview_writer: writer of the preview stacks, or None.
+    :param new_image_array: subtracted intensity array.
+    '''
+    with timing.stage("save"):
+        writer.write(new_image_array)
+    if preview_writer is not None:
+        preview_writer.write(new_image_array)
+
+def plot_subtracted_images(subtract_image_array: np.ndarray, image_array: np.ndarray, new_image_array: np.ndarray, v_max: int):
+    '''Plot the background scatter image, along with the before / after subtraction images.
+    
+    :param subtract_image_array: scaled background scattering intensity array.
+    :param image_array: diffraction pattern image before subtraction.
+    :param new_image_array: diffraction pattern image after subtraction.
+    :param v_max: intensity maxima for plotting the subtracted diffraction pattern image.
+    '''
+    print(f"The BACKGROUND SCATTER image, along with the BEFORE / AFTER subtraction images for the final image in the series, are shown below...", sep = '\n', end = '\n\n')
+
+    # imported when needed, as matplotlib is slow to import
+    import matplotlib.pyplot as plt
+
+    with timing.stage("plot"):
+        plt.subplot(1, 3, 1)
+        plt.imshow(subtract_image_array, cmap='gray', vmin = 0, vmax = v_max)
+        plt.subplot(1, 3, 2)
+        plt.imshow(image_array, cmap='gray', vmin = 0, vmax = v_max)
+        plt.subplot(1, 3, 3)
+        plt.imshow(new_image_array, cmap='gray', vmin = 0, vmax = v_max)
+        plt.show()
+
+def check_output_format(output_format: str):
+    '''Raise an error if the output format of the subtracted images is not recognised.'''
+    if output_format not in ("tif", "stack"):
+        raise ValueError(f"Unknown output format '{output_format}', choose from 'tif' or 'stack'.")
+
+def get_subtract_image_array(background_scatter_filepath: str, background_scatter_multiple: int) -> np.ndarray:
+    '''Load the background scattering image and scale it to match the acquisition frequency of the data.
+    
+    :param background_scatter_filepath: path of the tiff image to subtract (such as an background scattering image).
+    :param background_scatter_multiple: value to multiply the background scatter intensity, to match the acquisition frequency of the data.
+    
+    :return: scaled background scattering intensity array.
+    '''
+    background_scatter_image_array = frame_reader.read_frame(background_scatter_filepath)
+    return background_scatter_multiple * background_scatter_image_array
+
+def subtract_tiff_images(experiment_number: str, background_scatter_filepath: str, background_scatter_multiple: int, input_filepath: str, output_filepath: str, v_max: int,
+                         workers: int = 1, output_format: str = "tif", plot: bool = True, previews: List[int] = ()):
     '''Subtract a tiff image (such as an background scattering image) 
     from each of the tiff images contained in the input folder
     and save the subtracted tiff images to the output folder.
@@ -118,51 +550,46 @@ def subtract_tiff_images(experiment_number: str, background_scatter_filepath: st
     :param input_filepath: input path to the series of tiff images.
     :param output_filepath: output path to save the series of subtracted tiff images.
     :param v_max: intensity maxima for plotting the subtracted diffraction pattern image.
+    :param workers: number of worker processes splitting the series into chunks, or of compression threads for a stack.
+    :param output_format: 'tif' to save one tiff image per input image, or 'stack' to save a single compressed tiff stack.
+    :param plot: plot the final image before and after subtraction, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the subtracted images, such as (2, 4, 8).
     '''
-    image_list = sorted(pathlib.Path(input_filepath).glob("0*.tif"))
+    check_output_format(output_format)
+    timing.set_experiment(experiment_number)
+    image_list = frame_reader.list_frames(input_filepath, "0*.tif")
     number_of_images = len(image_list)
     
-    # set the image arrays to zero to prevent unusual memory allocation
-    image_example = io.imread(image_list[0])
-    image_array = np.zeros(shape=np.shape(image_example), dtype='int32')
-    background_scatter_image_array = np.zeros(shape=np.shape(image_example), dtype='int32')
-    subtract_image_array = np.zeros(shape=np.shape(image_example), dtype='int32')
-    new_image_array = np.zeros(shape=np.shape(image_example), dtype='int32')
-    
-    background_scatter_image_array = np.array(io.imread(background_scatter_filepath))
-    subtract_image_array = background_scatter_multiple * background_scatter_image_array
-
-    for image_path in tqdm(image_list):
-        
-        image_array = np.array(io.imread(image_path))
-        new_image_array = image_array - subtract_image_array
+    subtract_image_array = get_subtract_image_array(background_scatter_filepath, background_scatter_multiple)
 
-        # convert to integer 32 bit array
-        new_image_array = new_image_array.astype('int32')
-    
-        # check if the output directory exists and if not create it
-        CHECK_FOLDER = os.path.isdir(f"{output_filepath}")
+    # check if the output directory exists and if not create it
+    CHECK_FOLDER = os.path.isdir(f"{output_filepath}")
 
-        if not CHECK_FOLDER:
-            os.makedirs(f"{output_filepath}")
-            print(f"Created folder : '{output_filepath}'.")
+    if not CHECK_FOLDER and image_list:
+        os.makedirs(f"{output_filepath}")
+        print(f"Created folder : '{output_filepath}'.")
 
-        # save the image
-        output_stem = pathlib.Path(image_path).stem
-        io.imsave(f"{output_filepath}{experiment_number}_subtracted_{output_stem}.tif", new_image_array)
+    if output_format == "stack":
+        image_array, new_image_array = subtract_tiff_stack(experiment_number, subtract_image_array, image_list, output_filepath,
+                                                           compression_workers = workers, previews = previews)
+        output_filepath = get_stack_filepath(experiment_number, output_filepath)
+    elif workers > 1:
+        chunks = split_image_list(image_list, workers)
+        tasks = {experiment_number: [(experiment_number, subtract_image_array, chunk, output_filepath, previews) for chunk in chunks]}
+        for number, last_images in run_parallel_chunks(tasks, subtract_tiff_chunk, workers):
+            if isinstance(last_images, Exception):
+                raise_failed_experiments({number: last_images})
+        image_array, new_image_array = last_images[-1]
+    else:
+        image_array, new_image_array = subtract_tiff_chunk(experiment_number, subtract_image_array, tqdm(image_list), output_filepath, previews)
 
     print(f"Written {number_of_images} tiff images to: '{output_filepath}'.", sep = '\n', end = '\n\n')
-    print(f"The BACKGROUND SCATTER image, along with the BEFORE / AFTER subtraction images for the final image in the series, are shown below...", sep = '\n', end = '\n\n')
-
-    plt.subplot(1, 3, 1)
-    plt.imshow(subtract_image_array, cmap='gray', vmin = 0, vmax = v_max)
-    plt.subplot(1, 3, 2)
-    plt.imshow(image_array, cmap='gray', vmin = 0, vmax = v_max)
-    plt.subplot(1, 3, 3)
-    plt.imshow(new_image_array, cmap='gray', vmin = 0, vmax = v_max)
-    plt.show()
+    if plot:
+        plot_subtracted_images(subtract_image_array, image_array, new_image_array, v_max)
     
-def multiple_subtract_tiff_images(experiment_numbers: List[int], background_scatter_filepath: str, background_scatter_multiple: int, input_path: str, output_path: str, v_max: int):
+def multiple_subtract_tiff_images(experiment_numbers: List[int], background_scatter_filepath: str, background_scatter_multiple: int, input_path: str, output_path: str, v_max: int,
+                                  workers: int = 1, output_format: str = "tif", timing_filepath: str = None,
+                                  plot: bool = True, previews: List[int] = ()):
     '''Create input and output file paths for a list of experiments. 
     Subtract a tiff image (such as an background scattering image) 
     from each of the tiff images contained in the input folder
@@ -174,11 +601,58 @@ def multiple_subtract_tiff_images(experiment_numbers: List[int], background_scat
     :param input_filepath: input path to the series of tiff images.
     :param output_filepath: output path to save the series of subtracted tiff images.
     :param v_max: intensity maxima for plotting the subtracted diffraction pattern image.
+    :param workers: number of worker processes, spread across the experiments and chunks of each series.
+    :param output_format: 'tif' to save one tiff image per input image, or 'stack' to save a single compressed tiff stack per experiment.
+    :param timing_filepath: optional path to save a JSON summary of the time spent in each stage of each experiment.
+    :param plot: plot the final image before and after subtraction, which can be turned off for batch runs.
+    :param previews: binning factors of preview levels to save alongside the subtracted images, such as (2, 4, 8).
     '''
-    for experiment_number in experiment_numbers:
+    with timing.TimedRun("multiple_subtract_tiff_images", timing_filepath):
+        check_output_format(output_format)
+        if workers > 1:
+            subtract_image_array = get_subtract_image_array(background_scatter_filepath, background_scatter_multiple)
+            tasks = {}
+            image_counts = {}
+            failed = {}
+            for experiment_number in experiment_numbers:
+                experiment_number = str(experiment_number)
+                input_filepath = input_path.format(experiment_number = experiment_number)
+                output_filepath = output_path.format(experiment_number = experiment_number)
+                timing.set_experiment(experiment_number)
+                image_list = frame_reader.list_frames(input_filepath, "0*.tif")
+                if not image_list:
+                    failed[experiment_number] = FileNotFoundError(f"No .tif images found in '{input_filepath}'.")
+                    print(f"Experiment {experiment_number} failed: {failed[experiment_number]!r}")
+                    continue
+                os.makedirs(output_filepath, exist_ok=True)
+                image_counts[experiment_number] = len(image_list)
+                if output_format == "stack":
+                    # each stack is written by a single process, sharing the remaining cores for compression
+                    compression_workers = max(1, workers // len(experiment_numbers))
+                    tasks[experiment_number] = [(experiment_number, subtract_image_array, image_list, output_filepath, compression_workers, previews)]
+                else:
+                    chunks = split_image_list(image_list, workers)
+                    tasks[experiment_number] = [(experiment_number, subtract_image_array, chunk, output_filepath, previews) for chunk in chunks]
+
+            worker_function = subtract_tiff_stack if output_format == "stack" else subtract_tiff_chunk
+            for experiment_number, last_images in run_parallel_chunks(tasks, worker_function, workers):
+                if isinstance(last_images, Exception):
+                    failed[experiment_number] = last_images
+                    continue
+                output_filepath = output_path.format(experiment_number = experiment_number)
+                print(f"Experiment {experiment_number} complete. Written {image_counts[experiment_number]} tiff images to: '{output_filepath}'.")
+                last_image_array, last_new_image_array = last_images[-1]
+        
+            if plot and tasks.keys() - failed.keys():
+                plot_subtracted_images(subtract_image_array, last_image_array, last_new_image_array, v_max)
+            raise_failed_experiments(failed)
+            return
+
+        for experiment_number in experiment_numbers:
         
-        experiment_number = str(experiment_number)
-        input_filepath = input_path.format(experiment_number = experiment_number)
-        output_filepath = output_path.format(experiment_number = experiment_number)
+            experiment_number = str(experiment_number)
+            input_filepath = input_path.format(experiment_number = experiment_number)
+            output_filepath = output_path.format(experiment_number = experiment_number)
         
-        subtract_tiff_images(experiment_number, background_scatter_filepath, background_scatter_multiple, input_filepath, output_filepath,  v_max)        
\ No newline at end of file
+            subtract_tiff_images(experiment_number, background_scatter_filepath, background_scatter_multiple, input_filepath, output_filepath,  v_max,
+                                 output_format = output_format, plot = plot, previews = previews)
\ No newline at end of file
@@ -0,0 +1,97 @@
+import numpy as np
+import io
+import os
+import time
+import tifffile
+
+# shape of a Pilatus 2M diffraction pattern image, in rows and columns
+PILATUS_SHAPE = (1679, 1475)
+
+def make_synthetic_frame(frame_number: int, shape: tuple = PILATUS_SHAPE, seed: int = 0) -> np.ndarray:
+    '''Make a synthetic int32 diffraction pattern image, with a set of Debye-Scherrer
+    rings around the centre of the detector on a noisy background. The ring intensities
+    vary with the frame number, so images from different measurement points differ.
+
+    :param frame_number: frame number of the image, also used to seed the noise.
+    :param shape: shape of the image in rows and columns.
+    :param seed: seed added to the frame number for the random noise.
+
+    :return: int32 intensity array.
+    '''
+    rng = np.random.default_rng(seed + frame_number)
+    rows, columns = np.ogrid[:shape[0], :shape[1]]
+    radius = np.hypot(rows - shape[0] / 2, columns - shape[1] / 2)
+    image_array = np.zeros(shape, dtype='float64')
+    for ring, ring_radius in enumerate((150, 260, 340, 480, 610)):
+        intensity = 200 * (1 + 0.5 * np.sin(frame_number / (ring + 3)))
+        image_array += intensity * np.exp(-0.5 * ((radius - ring_radius) / 4) ** 2)
+    image_array += 20
+    return rng.poisson(image_array).astype('int32')
+
+def write_synthetic_frame(image_path: str, image_array: np.ndarray, chunks: int = 1, delay: float = 0):
+    '''Write a synthetic image as an uncompressed tiff, optionally in several chunks
+    with a delay between them, to imitate a detector that is still writing the file.
+
+    :param image_path: path of the tiff image to write.
+    :param image_array: intensity array to write.
+    :param chunks: number of chunks to write the file in.
+    :param delay: delay in seconds between writing each chunk.
+    '''
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, image_array)
+    data = buffer.getvalue()
+    chunk_size = -(-len(data) // chunks)
+    with open(image_path, 'wb') as image_file:
+        for start in range(0, len(data), chunk_size):
+            image_file.write(data[start:start + chunk_size])
+            image_file.flush()
+            if delay:
+                time.sleep(delay)
+
+def write_synthetic_series(output_filepath: str, number_of_frames: int, shape: tuple = PILATUS_SHAPE,
+                           suffix: str = ".tif", first_frame: int = 1, seed: int = 0) -> list:
+    '''Write a series of synthetic diffraction pattern images, named in the detector
+    naming scheme '00001.tif', '00002.tif', ... to the output folder.
+
+    :param output_filepath: output path to save the series of tiff images.
+    :param number_of_frames: number of images to write.
+    :param shape: shape of each image in rows and columns.
+    :param suffix: file suffix, '.tif' or '.tiff'.
+    :param first_frame: frame number of the first image.
+    :param seed: seed for the random noise.
+
+    :return: list of paths of the images written.
+    '''
+    os.makedirs(output_filepath, exist_ok=True)
+    image_paths = []
+    for frame_number in range(first_frame, first_frame + number_of_frames):
+        image_path = os.path.join(output_filepath, f"{frame_number:05}{suffix}")
+        tifffile.imwrite(image_path, make_synthetic_frame(frame_number, shape, seed))
+        image_paths.append(image_path)
+    return image_paths
+
+def write_synthetic_experiment(output_filepath: str, shape_x: int, shape_y: int, shape: tuple = PILATUS_SHAPE,
+                               number_of_frames: int = None, seed: int = 0) -> dict:
+    '''Write a synthetic experiment for benchmarking, in the layout the functions expect:
+    a grid of '.tiff' images for summing and mapping, the same grid as '.tif' images for
+    background subtraction, and a background scatter image.
+
+    :param output_filepath: output path to save the synthetic experiment.
+    :param shape_x: number of diffraction measurement points along X.
+    :param shape_y: number of diffraction measurement points along Y.
+    :param shape: shape of each image in rows and columns.
+    :param number_of_frames: number of images to write, shape_x * shape_y by default.
+    :param seed: seed for the random noise.
+
+    :return: dictionary of the 'tiff' and 'tif' input paths and the 'background' image path.
+    '''
+    if number_of_frames is None:
+        number_of_frames = shape_x * shape_y
+    tiff_filepath = os.path.join(output_filepath, "tiff") + "/"
+    tif_filepath = os.path.join(output_filepath, "tif") + "/"
+    background_filepath = os.path.join(output_filepath, "background.tif")
+    write_synthetic_series(tiff_filepath, number_of_frames, shape, ".tiff", seed=seed)
+    write_synthetic_series(tif_filepath, number_of_frames, shape, ".tif", seed=seed)
+    rng = np.random.default_rng(seed)
+    tifffile.imwrite(background_filepath, rng.poisson(10, size=shape).astype('int32'))
+    return {"tiff": tiff_filepath, "tif": tif_filepath, "background": background_filepath}
@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+
+# stage timings being recorded, or None when timing is turned off
+_timings = None
+# stages can be recorded by the threads saving images as well as the main thread
+_lock = threading.Lock()
+
+class StageTimings:
+    '''Wall time, bytes read and written and frame counts of each stage of each experiment.
+
+    The 'read' stage times the wait for each image read ahead on background threads, so it
+    is the storage latency that was not hidden behind processing. When images are read
+    serially, it times opening and decoding each image, and as a memory-mapped image is only
+    read from disk when its pixels are first used, most of its read time is recorded by the
+    stage that first uses it, such as 'reduce'. The stages of chunks run on worker
+    processes are merged in, so their seconds are summed across the processes.
+    '''
+    def __init__(self):
+        self.experiment_number = None
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float = 0, frames: int = 0, bytes_read: int = 0, bytes_written: int = 0,
+            calls: int = 1, experiment_number: str = None):
+        '''Add the time and counts of a stage to the current (or the given) experiment.'''
+        if experiment_number is None:
+            experiment_number = self.experiment_number
+        key = (experiment_number, stage)
+        record = self.stages.setdefault(key, {"seconds": 0.0, "calls": 0, "frames": 0, "bytes_read": 0, "bytes_written": 0})
+        record["seconds"] += seconds
+        record["calls"] += calls
+        record["frames"] += frames
+        record["bytes_read"] += bytes_read
+        record["bytes_written"] += bytes_written
+
+    def merge(self, other: "StageTimings"):
+        '''Add the stages recorded by another set of timings, such as a worker process.'''
+        for (experiment_number, stage), record in other.stages.items():
+            self.add(stage, experiment_number=experiment_number, **record)
+
+    def summary(self) -> dict:
+        '''Return the timings as a dictionary of experiment number to stage records,
+        along with the totals of each stage over all of the experiments.'''
+        experiments = {}
+        totals = StageTimings()
+        for (experiment_number, stage), record in self.stages.items():
+            # stages outside any experiment, such as reading a background image shared by all of them
+            experiment_number = "shared" if experiment_number is None else str(experiment_number)
+            experiments.setdefault(experiment_number, {})[stage] = get_throughput(record)
+            totals.add(stage, experiment_number="total", **record)
+        stages = {stage: get_throughput(record) for (_, stage), record in totals.stages.items()}
+        return {"experiments": experiments, "stages": stages}
+
+def get_throughput(record: dict) -> dict:
+    '''Return a copy of a stage record with its frames per second and megabytes per second.'''
+    record = dict(record)
+    seconds = record["seconds"]
+    record["frames_per_second"] = record["frames"] / seconds if seconds and record["frames"] else None
+    megabytes = (record["bytes_read"] + record["bytes_written"]) / 1e6
+    record["megabytes_per_second"] = megabytes / seconds if seconds and megabytes else None
+    return record
+
+class Stage:
+    '''Time a block of code as a stage of the current experiment, with optional counts.'''
+    __slots__ = ("timings", "name", "start", "frames", "bytes_read", "bytes_written")
+
+    def __init__(self, timings: StageTimings, name: str):
+        self.timings = timings
+        self.name = name
+        self.frames = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            self.timings.add(self.name, seconds, self.frames, self.bytes_read, self.bytes_written)
+        return False
+
+    def read(self, image_array):
+        '''Count an image read in this stage.'''
+        self.frames += 1
+        self.bytes_read += image_array.nbytes
+
+    def written(self, output_filepath: str):
+        '''Count the size of a file written in this stage.'''
+        self.bytes_written += os.path.getsize(output_filepath)
+
+class NullStage:
+    '''Stage used when timing is turned off, doing nothing.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def read(self, image_array):
+        pass
+
+    def written(self, output_filepath: str):
+        pass
+
+NULL_STAGE = NullStage()
+
+def stage(name: str):
+    '''Return a context manager timing a block of code as a stage of the current experiment.
+    When timing is turned off the same do-nothing stage is returned, so the cost is a single call.
+
+    :param name: name of the stage, such as 'list', 'read', 'reduce', 'save' or 'plot'.
+    '''
+    if _timings is None:
+        return NULL_STAGE
+    return Stage(_timings, name)
+
+def set_experiment(experiment_number: str):
+    '''Record the following stages against an experiment number.'''
+    if _timings is not None:
+        _timings.experiment_number = str(experiment_number)
+
+def is_enabled() -> bool:
+    '''Return True if stage timings are being recorded.'''
+    return _timings is not None
+
+def enable_timing() -> StageTimings:
+    '''Start recording stage timings, returning the new set of timings.'''
+    global _timings
+    _timings = StageTimings()
+    return _timings
+
+def disable_timing() -> StageTimings:
+    '''Stop recording stage timings, returning those recorded.'''
+    global _timings
+    timings, _timings = _timings, None
+    return timings
+
+def merge(timings: StageTimings):
+    '''Merge the timings of a worker process into those being recorded.'''
+    if _timings is not None and timings is not None:
+        _timings.merge(timings)
+
+def call_with_timing(experiment_number: str, worker_function, *arguments):
+    '''Call a function on a worker process, recording the stage timings of the call.
+
+    :return: the result of the function and its stage timings.
+    '''
+    timings = enable_timing()
+    set_experiment(experiment_number)
+    try:
+        return worker_function(*arguments), timings
+    finally:
+        disable_timing()
+
+class TimedRun:
+    '''Record the stage timings of a run of one of the summing or mapping functions,
+    and save a JSON summary to a file at the end. Does nothing if the file path is None.
+
+        with TimedRun("multiple_avg_tiff_images", "timings.json"):
+            ...
+    '''
+    def __init__(self, name: str, timing_filepath: str = None):
+        '''
+        :param name: name of the run, recorded in the summary.
+        :param timing_filepath: path of the JSON summary to write, or None to turn timing off.
+        '''
+        self.name = name
+        self.timing_filepath = timing_filepath
+
+    def __enter__(self):
+        if self.timing_filepath is not None:
+            self.start = time.perf_counter()
+            self.timings = enable_timing()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timing_filepath is None:
+            return False
+        wall_seconds = time.perf_counter() - self.start
+        disable_timing()
+        summary = {"function": self.name, "wall_seconds": wall_seconds, "completed": exc_info[0] is None}
+        summary.update(self.timings.summary())
+        save_summary(summary, self.timing_filepath)
+        print_summary(summary)
+        print(f"Written timing summary to: '{self.timing_filepath}'.")
+        return False
+
+def save_summary(summary: dict, timing_filepath: str):
+    '''Save a timing summary as a JSON file, creating its folder if needed.'''
+    folder = os.path.dirname(timing_filepath)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(timing_filepath, 'w') as timing_file:
+        json.dump(summary, timing_file, indent=2)
+
+def print_summary(summary: dict):
+    '''Print the total time, frames and throughput of each stage in a timing summary.'''
+    print(f"Timings of {summary['function']}, {summary['wall_seconds']:.2f} s in total:")
+    for name, record in summary["stages"].items():
+        frames_per_second = f"{record['frames_per_second']:.1f} frames/s" if record["frames_per_second"] else ""
+        megabytes_per_second = f"{record['megabytes_per_second']:.1f} MB/s" if record["megabytes_per_second"] else ""
+        print(f"    {name:<10} {record['seconds']:8.2f} s {frames_per_second:>16} {megabytes_per_second:>12}")
@@ -0,0 +1,80 @@
+'''Check the watch mode without a detector, by writing synthetic diffraction pattern
+images into a temporary folder while a watcher folds them into its running outputs.
+
+    python sxrd_tiff_watch_demo.py --shape-x 6 --shape-y 4
+
+Each image is written in several chunks with a delay between them, as a detector would,
+so the watcher must wait for each image to be complete. The summed/averaged image from
+the watcher is then compared with the average of all of the images written, and its
+intensity maps with those of grid_tiff_intensity.
+'''
+import argparse
+import os
+import tempfile
+import threading
+import time
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from skimage import io
+
+import sxrd_tiff_reader_functions as frame_reader
+import sxrd_tiff_synthetic_functions as synthetic
+import sxrd_tiff_watch_functions as watch
+
+def write_images(input_filepath: str, number_of_frames: int, shape: tuple, frame_interval: float):
+    '''Write synthetic images to the input folder, one every frame interval, in chunks.'''
+    for frame_number in range(1, number_of_frames + 1):
+        image_path = os.path.join(input_filepath, f"{frame_number:05}.tif")
+        image_array = synthetic.make_synthetic_frame(frame_number, shape)
+        synthetic.write_synthetic_frame(image_path, image_array, chunks=4, delay=frame_interval / 8)
+        time.sleep(frame_interval / 2)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape-x", type=int, default=6, help="number of measurement points along X")
+    parser.add_argument("--shape-y", type=int, default=4, help="number of measurement points along Y")
+    parser.add_argument("--rows", type=int, default=256, help="number of rows in each image")
+    parser.add_argument("--columns", type=int, default=256, help="number of columns in each image")
+    parser.add_argument("--frame-interval", type=float, default=0.2, help="seconds between images")
+    parser.add_argument("--refresh-interval", type=float, default=1.0, help="seconds between output refreshes")
+    arguments = parser.parse_args()
+
+    number_of_frames = arguments.shape_x * arguments.shape_y
+    shape = (arguments.rows, arguments.columns)
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        input_filepath = os.path.join(temporary_directory, "rawdata") + "/"
+        output_filepath = os.path.join(temporary_directory, "output") + "/"
+        os.makedirs(input_filepath)
+
+        writer = threading.Thread(target=write_images, args=(input_filepath, number_of_frames, shape, arguments.frame_interval))
+        writer.start()
+        watcher = watch.watch_experiment("000001", input_filepath, output_filepath, 500,
+                                         arguments.shape_x, arguments.shape_y,
+                                         poll_interval=arguments.frame_interval / 4,
+                                         refresh_interval=arguments.refresh_interval,
+                                         settle_time=arguments.frame_interval / 4,
+                                         idle_timeout=10 * arguments.frame_interval + 5)
+        writer.join()
+
+        expected = np.mean([synthetic.make_synthetic_frame(frame_number, shape)
+                            for frame_number in range(1, number_of_frames + 1)], axis=0).astype('int32')
+        summed = io.imread(f"{output_filepath}000001_summed1.tiff")
+        maps = sorted(os.listdir(f"{output_filepath}{watch.INTENSITY_MAP_FOLDER}"))
+        # the intensity maps are placed in the same order as grid_tiff_intensity
+        frame_statistics = frame_reader.get_frame_statistics(input_filepath, "0*.tif*", ["max", "mean"])
+        max_list, avg_list = watcher.intensity_lists()
+        maps_match = np.allclose(max_list, frame_statistics["max"]) and np.allclose(avg_list, frame_statistics["mean"])
+
+        print(f"Images collected: {watcher.reducer.count} of {number_of_frames}")
+        print(f"Intensity maps: {maps}")
+        if (watcher.reducer.count == number_of_frames and np.array_equal(summed, expected) and len(maps) == 2
+                and maps_match):
+            print("PASS: the watched outputs match the complete series.")
+        else:
+            print("FAIL: the watched outputs do not match the complete series.")
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
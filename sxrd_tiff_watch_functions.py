@@ -0,0 +1,329 @@
+import numpy as np
+import bisect
+import pathlib
+import os
+import time
+import pickle
+import fnmatch
+import tifffile
+from typing import List
+
+import sxrd_tiff_summer_functions as analysis
+import sxrd_tiff_mapper_functions as grid_analysis
+import sxrd_tiff_prefetch_functions as prefetch
+from sxrd_tiff_manifest_functions import FRAME_STATISTICS, MTIME_MARGIN_NS, get_frame_number
+from sxrd_tiff_pipeline_functions import INTENSITY_MAP_FOLDER
+from sxrd_tiff_reducer_functions import ImageReducer
+
+# default minimum time in seconds between full listings of the input folder, when the next images are not found by name
+LISTING_INTERVAL = 30.0
+
+def is_complete_tiff(image_path: str, size: int) -> bool:
+    '''Return True if a tiff image can be parsed and all of its pixel data
+    lies within the file, so the detector has finished writing it.
+
+    :param image_path: path of the tiff image.
+    :param size: size of the file in bytes.
+    '''
+    try:
+        with tifffile.TiffFile(image_path) as tiff:
+            page = tiff.pages[0]
+            data_end = max(offset + count for offset, count in zip(page.dataoffsets, page.databytecounts))
+            return data_end <= size
+    except Exception:
+        return False
+
+class ExperimentWatcher:
+    '''Fold the diffraction pattern images of an experiment into running accumulators
+    as they are written. Each poll looks for the next images by the name following the
+    highest frame number so far, only stats the images that are not yet complete and only
+    reads the images that have become complete, so the work of each poll and refresh
+    depends on the new images, not on the number collected so far. The intensity maps are
+    updated in place with the statistics of each new image. The folder is only
+    listed in full at the start, and when the next images are not found by name (such as
+    after a gap in the frame numbers), no more than once per listing interval.
+    '''
+    def __init__(self, experiment_number: str, input_filepath: str, output_filepath: str, v_max: int,
+                 shape_x: int = None, shape_y: int = None, c_map: str = "Reds", pattern: str = "0*.tif*",
+                 subtract_image_array: np.ndarray = None, settle_time: float = 1.0, statistics: List[str] = (),
+                 listing_interval: float = LISTING_INTERVAL):
+        '''
+        :param experiment_number: input experiment number.
+        :param input_filepath: input path to the series of tiff images being written.
+        :param output_filepath: output path to save the summed/averaged image and intensity maps.
+        :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+        :param shape_x: number of diffraction measurement points along X, or None to skip the intensity maps.
+        :param shape_y: number of diffraction measurement points along Y, or None to skip the intensity maps.
+        :param c_map: colour scale for the intensity maps.
+        :param pattern: glob pattern selecting the images in the input folder.
+        :param subtract_image_array: scaled background scattering intensity array to subtract, or None.
+        :param settle_time: time in seconds an image must be unchanged before it is read.
+        :param statistics: additional images to save, from 'sum', 'max', 'min' and 'variance'.
+        :param listing_interval: minimum time in seconds between full listings of the input folder.
+        '''
+        self.experiment_number = experiment_number
+        self.folder = pathlib.Path(input_filepath)
+        self.output_filepath = output_filepath
+        self.v_max = v_max
+        self.shape_x = shape_x
+        self.shape_y = shape_y
+        self.c_map = c_map
+        self.pattern = pattern
+        self.subtract_image_array = subtract_image_array
+        self.settle_time_ns = int(settle_time * 1e9)
+        self.statistics = statistics
+        self.reducer = ImageReducer(statistics)
+        self.frame_statistics = {}
+        self.processed = set()
+        # sorted names of the images read so far, and the intensity maps of the measurement points
+        self.frame_names = []
+        self.max_grid = None
+        self.avg_grid = None
+        self._reset_grids()
+        self.pending = {}
+        self.directory_mtime_ns = None
+        self.listing_interval = listing_interval
+        self.listed_at = None
+        # zero padded width and suffix of the image names, and the frame number expected next
+        self.name_format = None
+        self.next_frame_number = None
+        self.frames_since_refresh = 0
+
+    def _reset_grids(self):
+        '''Place the statistics of every image read so far in new intensity maps, with NaN
+        for the points not yet measured.'''
+        self.frame_names = sorted(self.frame_statistics)
+        if self.shape_x is None or self.shape_y is None:
+            return
+        number_of_points = self.shape_x * self.shape_y
+        self.max_grid = np.full(number_of_points, np.nan)
+        self.avg_grid = np.full(number_of_points, np.nan)
+        for position, name in enumerate(self.frame_names[:number_of_points]):
+            self.max_grid[position], self.avg_grid[position] = self.frame_statistics[name]
+
+    def _place_frame(self, name: str):
+        '''Place the statistics of a new image in the intensity maps, at its position in the
+        sorted list of images, as in grid_tiff_intensity.'''
+        position = bisect.bisect(self.frame_names, name)
+        self.frame_names.insert(position, name)
+        if self.max_grid is None or position >= len(self.max_grid):
+            return
+        if position < len(self.frame_names) - 1:
+            # an image that sorts before those already read moves the later ones along by one point
+            self.max_grid[position + 1:] = self.max_grid[position:-1].copy()
+            self.avg_grid[position + 1:] = self.avg_grid[position:-1].copy()
+        self.max_grid[position], self.avg_grid[position] = self.frame_statistics[name]
+
+    def _add_pending(self, name: str):
+        '''Add an image to the pending images, and expect the frame after it next.'''
+        self.pending[name] = None
+        self._expect_after(name)
+
+    def _expect_after(self, name: str):
+        '''Expect the frame after an image next, if it has the highest frame number so far.'''
+        frame_number = get_frame_number(name)
+        if frame_number is not None and (self.next_frame_number is None or frame_number >= self.next_frame_number):
+            digits = len(name) - len(name.lstrip("0123456789"))
+            self.name_format = (digits, name[digits:])
+            self.next_frame_number = frame_number + 1
+
+    def _find_next_images(self) -> int:
+        '''Add the images following the highest frame number so far to the pending images,
+        looking them up by name, until an image is missing.
+
+        :return: number of images added.
+        '''
+        if self.name_format is None:
+            return 0
+        width, suffix = self.name_format
+        found = 0
+        while True:
+            name = f"{self.next_frame_number:0{width}d}{suffix}"
+            if name in self.processed or name in self.pending:
+                self.next_frame_number += 1
+                continue
+            if not fnmatch.fnmatchcase(name, self.pattern) or not os.path.isfile(self.folder / name):
+                return found
+            self._add_pending(name)
+            found += 1
+
+    def _list_new_images(self):
+        '''Add new images in the input folder to the pending images. The next images are
+        looked up by name, and the folder is only listed when none are found, it has been
+        modified and the listing interval has passed since it was last listed. Processed
+        images are skipped.'''
+        if self._find_next_images():
+            return
+        # images without frame numbers are only found by listing the folder
+        if (self.name_format is not None and self.listed_at is not None
+                and time.monotonic() - self.listed_at < self.listing_interval):
+            return
+        try:
+            directory_mtime_ns = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            return
+        listed_at_ns = time.time_ns()
+        if directory_mtime_ns == self.directory_mtime_ns:
+            return
+        self.listed_at = time.monotonic()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name in self.processed or entry.name in self.pending:
+                    continue
+                if fnmatch.fnmatchcase(entry.name, self.pattern) and entry.is_file():
+                    self._add_pending(entry.name)
+        # an image created in the same clock tick as the listing may be missed, so list again next time
+        if directory_mtime_ns < listed_at_ns - MTIME_MARGIN_NS:
+            self.directory_mtime_ns = directory_mtime_ns
+
+    def _find_complete_images(self) -> List[str]:
+        '''Return the pending images whose size and modification time have not changed
+        since the previous poll, and which have settled and can be parsed completely.'''
+        complete = []
+        now = time.time_ns()
+        for name, previous in list(self.pending.items()):
+            image_path = self.folder / name
+            try:
+                stat = os.stat(image_path)
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if (current == previous and now - stat.st_mtime_ns >= self.settle_time_ns
+                    and is_complete_tiff(image_path, stat.st_size)):
+                complete.append(name)
+                del self.pending[name]
+            else:
+                self.pending[name] = current
+        return sorted(complete)
+
+    def poll(self) -> int:
+        '''Fold every newly completed image into the running accumulators.
+
+        :return: number of images added.
+        '''
+        self._list_new_images()
+        complete = self._find_complete_images()
+        for image_path, image_array in prefetch.prefetch_frames([self.folder / name for name in complete]):
+            name = image_path.name
+            if self.subtract_image_array is not None:
+                image_array = analysis.subtract_image(image_array, self.subtract_image_array)
+            self.reducer.update(image_array)
+            self.frame_statistics[name] = (FRAME_STATISTICS["max"](image_array), FRAME_STATISTICS["mean"](image_array))
+            self._place_frame(name)
+            self.processed.add(name)
+        self.frames_since_refresh += len(complete)
+        return len(complete)
+
+    def intensity_lists(self):
+        '''Return the maximum and average intensity of each measurement point in the grid,
+        placed in the sorted order of the images, with NaN for the points not yet measured.'''
+        return self.max_grid, self.avg_grid
+
+    def refresh_outputs(self):
+        '''Save the summed/averaged image and the intensity maps of the images collected so far.'''
+        if self.reducer.count == 0:
+            return
+        os.makedirs(self.output_filepath, exist_ok=True)
+        # the image is only saved, as the figures are closed straight away
+        analysis.save_avg_tiff_image(self.experiment_number, [self.reducer], self.output_filepath, self.v_max, self.statistics,
+                                     plot = False)
+
+        if self.shape_x is not None and self.shape_y is not None:
+            output_filepath_maps = f"{self.output_filepath}{INTENSITY_MAP_FOLDER}"
+            os.makedirs(output_filepath_maps, exist_ok=True)
+            max_list, avg_list = self.intensity_lists()
+            grid_analysis.plot_intensity_maps(self.experiment_number, output_filepath_maps, max_list, avg_list,
+                                              self.shape_x, self.shape_y, self.c_map)
+        # release the figures, as the outputs are refreshed many times
+        import matplotlib.pyplot as plt
+        plt.close('all')
+        self.frames_since_refresh = 0
+        print(f"Refreshed outputs from {self.reducer.count} diffraction pattern images.")
+
+    def save_state(self, state_filepath: str):
+        '''Save the running accumulators, so a restarted watcher can carry on from them.'''
+        state = {"reducer": self.reducer, "frame_statistics": self.frame_statistics, "processed": self.processed}
+        temporary_filepath = f"{state_filepath}.tmp"
+        with open(temporary_filepath, 'wb') as state_file:
+            pickle.dump(state, state_file)
+        os.replace(temporary_filepath, state_filepath)
+
+    def load_state(self, state_filepath: str):
+        '''Load the running accumulators saved by a previous watcher of the same experiment.'''
+        with open(state_filepath, 'rb') as state_file:
+            state = pickle.load(state_file)
+        self.reducer = state["reducer"]
+        self.frame_statistics = state["frame_statistics"]
+        self.processed = state["processed"]
+        self._reset_grids()
+        for name in self.processed:
+            self._expect_after(name)
+
+def watch_experiment(experiment_number: str, input_filepath: str, output_filepath: str, v_max: int,
+                     shape_x: int = None, shape_y: int = None, c_map: str = "Reds", pattern: str = "0*.tif*",
+                     subtract_image_array: np.ndarray = None, poll_interval: float = 1.0,
+                     refresh_interval: float = 30.0, settle_time: float = 1.0, idle_timeout: float = None,
+                     expected_frames: int = None, state_filepath: str = None,
+                     listing_interval: float = LISTING_INTERVAL) -> ExperimentWatcher:
+    '''Watch the input folder of an experiment while the images are being written, folding
+    each completed image into running accumulators and refreshing the summed/averaged image
+    and intensity maps at a fixed interval. Stops after the expected number of images, after
+    no new images for the idle timeout, or on a keyboard interrupt, refreshing the outputs a final time.
+
+    :param experiment_number: input experiment number.
+    :param input_filepath: input path to the series of tiff images being written.
+    :param output_filepath: output path to save the summed/averaged image and intensity maps.
+    :param v_max: intensity maxima for plotting the summed/averaged diffraction pattern image.
+    :param shape_x: number of diffraction measurement points along X, or None to skip the intensity maps.
+    :param shape_y: number of diffraction measurement points along Y, or None to skip the intensity maps.
+    :param c_map: colour scale for the intensity maps.
+    :param pattern: glob pattern selecting the images in the input folder.
+    :param subtract_image_array: scaled background scattering intensity array to subtract, or None.
+    :param poll_interval: time in seconds between polls of the input folder.
+    :param refresh_interval: time in seconds between refreshes of the outputs.
+    :param settle_time: time in seconds an image must be unchanged before it is read.
+    :param idle_timeout: stop after this many seconds without a new image, or None to carry on.
+    :param expected_frames: stop once this many images have been added, shape_x * shape_y by default.
+    :param state_filepath: optional path to save the running accumulators to, and resume them from.
+    :param listing_interval: minimum time in seconds between full listings of the input folder, when the next images are not found by name.
+
+    :return: the watcher, holding the running accumulators.
+    '''
+    watcher = ExperimentWatcher(experiment_number, input_filepath, output_filepath, v_max, shape_x, shape_y,
+                                c_map, pattern, subtract_image_array, settle_time, listing_interval = listing_interval)
+    if state_filepath is not None and os.path.isfile(state_filepath):
+        watcher.load_state(state_filepath)
+        print(f"Resumed from {watcher.reducer.count} diffraction pattern images in '{state_filepath}'.")
+    if expected_frames is None and shape_x is not None and shape_y is not None:
+        expected_frames = shape_x * shape_y
+
+    last_image_time = time.monotonic()
+    last_refresh_time = time.monotonic()
+    try:
+        while True:
+            if watcher.poll():
+                last_image_time = time.monotonic()
+
+            if watcher.frames_since_refresh and time.monotonic() - last_refresh_time >= refresh_interval:
+                watcher.refresh_outputs()
+                if state_filepath is not None:
+                    watcher.save_state(state_filepath)
+                last_refresh_time = time.monotonic()
+
+            if expected_frames is not None and watcher.reducer.count >= expected_frames:
+                print(f"All {expected_frames} diffraction pattern images have been collected.")
+                break
+            if idle_timeout is not None and time.monotonic() - last_image_time >= idle_timeout:
+                print(f"No new diffraction pattern images for {idle_timeout} seconds.")
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        if watcher.frames_since_refresh:
+            watcher.refresh_outputs()
+            if state_filepath is not None:
+                watcher.save_state(state_filepath)
+
+    return watcher